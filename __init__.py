@@ -1,2 +1,4 @@
 from .client import PortForwardClient
 from .server import PortForwardServer
+from .transport import MemoryChannel, MemoryPipe
+from .capture import CaptureWriter, CaptureReader
@@ -0,0 +1,150 @@
+"""Connection-rate benchmark for public forward listeners.
+
+Runs a server and a client as subprocesses in front of a local echo backend and
+measures how fast new public connections are accepted and served:
+
+    burst      opens --burst connections at once and waits for every echo
+    sustained  --workers threads connect, echo and close for --duration seconds
+
+    python bench/accept.py --burst 2000 --duration 10 --backlog 4096
+"""
+import os
+import json
+import time
+import errno
+import socket
+import argparse
+import selectors
+import threading
+
+from soak import EchoBackend, RaiseFdLimit, Soak
+
+def Burst(port, count, timeout):
+    selector = selectors.DefaultSelector()
+    pending = {}
+    failures = {}
+    started = time.monotonic()
+    for _ in range(count):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+        result = conn.connect_ex(('127.0.0.1', port))
+        if result not in (0, errno.EINPROGRESS):
+            failures[errno.errorcode.get(result, result)] = failures.get(errno.errorcode.get(result, result), 0) + 1
+            conn.close()
+            continue
+        pending[conn] = b''
+        selector.register(conn, selectors.EVENT_WRITE)
+    latencies = []
+    deadline = started + timeout
+    while pending and time.monotonic() < deadline:
+        for key, events in selector.select(0.2):
+            conn = key.fileobj
+            try:
+                if events & selectors.EVENT_WRITE:
+                    error = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error:
+                        raise OSError(error, os.strerror(error))
+                    conn.send(b'ping')
+                    selector.modify(conn, selectors.EVENT_READ)
+                    continue
+                data = conn.recv(16)
+                if not data:
+                    raise ConnectionError(errno.ECONNRESET, 'closed')
+                pending[conn] += data
+                if pending[conn] != b'ping':
+                    continue
+                latencies.append(time.monotonic() - started)
+            except OSError as e:
+                name = errno.errorcode.get(e.errno, type(e).__name__)
+                failures[name] = failures.get(name, 0) + 1
+            selector.unregister(conn)
+            del pending[conn]
+            conn.close()
+    if pending:
+        failures['timeout'] = len(pending)
+        for conn in pending:
+            conn.close()
+    elapsed = (max(latencies) if latencies else time.monotonic() - started)
+    latencies.sort()
+    return {
+        'connections': count,
+        'completed': len(latencies),
+        'failures': failures,
+        'elapsed': round(elapsed, 3),
+        'connections_per_second': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        'p50': round(latencies[len(latencies) // 2], 3) if latencies else None,
+        'p99': round(latencies[int(len(latencies) * 0.99)], 3) if latencies else None,
+    }
+
+def Sustained(port, workers, duration, timeout):
+    counts = {'completed': 0, 'failures': 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def Work():
+        completed = failures = 0
+        while time.monotonic() < stop:
+            try:
+                conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+                conn.sendall(b'ping')
+                if conn.recv(16) != b'ping':
+                    raise ConnectionError('echo mismatch')
+                conn.close()
+                completed += 1
+            except OSError:
+                failures += 1
+        with lock:
+            counts['completed'] += completed
+            counts['failures'] += failures
+
+    threads = [threading.Thread(target=Work) for _ in range(workers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    counts['elapsed'] = round(elapsed, 3)
+    counts['connections_per_second'] = round(counts['completed'] / elapsed, 1)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp accept-rate benchmark')
+    parser.add_argument('--burst', type=int, default=1000, help='connections opened at once (0 to skip)')
+    parser.add_argument('--workers', type=int, default=8, help='threads for the sustained phase')
+    parser.add_argument('--duration', type=float, default=10, help='sustained phase length (0 to skip)')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--backlog', type=int, default=1024, help='AcceptBacklog passed to the server')
+    parser.add_argument('--defer-accept', type=int, default=0, help='DeferAccept passed to the server')
+    parser.add_argument('--fast-open', type=int, default=0, help='FastOpen passed to the server')
+    parser.add_argument('--base-port', type=int, default=21500)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+    RaiseFdLimit()
+
+    # Reuse the soak harness to launch one server and one client with a single forward
+    args.clients, args.forwards = 1, 1
+    stack = Soak(args)
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    serverConfig = {'AcceptBacklog': args.backlog, 'DeferAccept': args.defer_accept, 'FastOpen': args.fast_open}
+    results = {'config': serverConfig}
+    try:
+        stack.StartStack(backend.Port, serverConfig)
+        port = stack.Ports[0]
+        if args.burst:
+            results['burst'] = Burst(port, args.burst, args.timeout)
+            print(f"burst: {json.dumps(results['burst'])}", flush=True)
+        if args.duration:
+            results['sustained'] = Sustained(port, args.workers, args.duration, args.timeout)
+            print(f"sustained: {json.dumps(results['sustained'])}", flush=True)
+    finally:
+        backend.Running = False
+        stack.Shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
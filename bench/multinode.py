@@ -0,0 +1,140 @@
+"""Multi-node cluster check on one machine.
+
+Starts --nodes server processes that share the same ports but bind different
+loopback addresses (127.0.0.1, 127.0.0.2, ...), connects one client process to
+each node with its own forward, and echoes through every forward on every node.
+Then it stops the last node and checks that its forward is withdrawn from the
+others while the remaining forwards keep working.
+
+    python bench/multinode.py --nodes 3 --bytes 1048576
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+from soak import EchoBackend, Soak
+
+def Echo(host, port, size, timeout):
+    payload = os.urandom(size)
+    started = time.monotonic()
+    try:
+        conn = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        return {'ok': False, 'error': e.strerror or str(e)}
+    try:
+        sender = threading.Thread(target=conn.sendall, args=(payload,), daemon=True)
+        sender.start()
+        received = bytearray()
+        while len(received) < size:
+            data = conn.recv(65536)
+            if not data:
+                break
+            received += data
+        ok = bytes(received) == payload
+    except OSError as e:
+        return {'ok': False, 'error': e.strerror or str(e)}
+    finally:
+        conn.close()
+    return {'ok': ok, 'seconds': round(time.monotonic() - started, 3)}
+
+def WaitFor(check, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.2)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp multi-node cluster check')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--bytes', type=int, default=262144, help='payload echoed through each node')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--base-port', type=int, default=21800)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    args.clients, args.forwards = args.nodes, 1
+    stack = Soak(args)
+    nodes = [(chr(ord('a') + index), f'127.0.0.{index + 1}') for index in range(args.nodes)]
+    clusterPort = args.base_port + args.nodes + 1
+    ports = [args.base_port + 1 + index for index in range(args.nodes)]
+    results = {'nodes': dict(nodes), 'echo': {}, 'after_stop': {}}
+    stopped = nodes[-1][0]
+    try:
+        for name, address in nodes:
+            stack.Launch(f'node-{name}', 'server.py', {
+                'InternalDataPort': args.base_port,
+                'AllowedPortRange': f'{ports[0]}-{ports[-1]}',
+                'Key': args.key,
+                'BindAddress': address,
+                'Cluster': {'node_id': name, 'port': clusterPort,
+                            'peers': {peer: f'{peerAddress}:{clusterPort}' for peer, peerAddress in nodes if peer != name}},
+            })
+        time.sleep(1)
+        for (name, address), port in zip(nodes, ports):
+            stack.Launch(f'client-{name}', 'client.py', {
+                'ServerDomain': address, 'ServerPort': args.base_port, 'Key': args.key,
+                'Forwards': [{'forward_domain': '127.0.0.1', 'forward_port': backend.Port, 'target_port': port}],
+            })
+        reachable = lambda: all(Echo(address, port, 16, 2)['ok'] for _, address in nodes for port in ports)
+        if not WaitFor(reachable, 30):
+            print(f"cluster never converged, see logs in {stack.Workdir}")
+        for (owner, _), port in zip(nodes, ports):
+            for name, address in nodes:
+                result = Echo(address, port, args.bytes, args.timeout)
+                result['relayed'] = name != owner
+                results['echo'][f'{owner}:{port}@{name}'] = result
+                print(f"forward of node {owner} via node {name}: {json.dumps(result)}", flush=True)
+
+        # Stop the last node: its forward must disappear everywhere, the rest must keep working
+        for processName, process, log in stack.Processes:
+            if processName == f'node-{stopped}':
+                process.stdin.write(b'exit\n')
+                process.stdin.flush()
+                process.wait(10)
+        alive = nodes[:-1]
+        WaitFor(lambda: not any(Echo(address, ports[-1], 16, 1)['ok'] for _, address in alive), 10)
+        for (owner, _), port in zip(nodes, ports):
+            for name, address in alive:
+                result = Echo(address, port, 16, args.timeout)
+                results['after_stop'][f'{owner}:{port}@{name}'] = result
+                print(f"after stopping node {stopped}, forward of node {owner} via node {name}: {json.dumps(result)}", flush=True)
+    finally:
+        backend.Running = False
+        for name, process, log in stack.Processes:
+            if process.poll() is not None:
+                continue
+            if name.startswith('node-'):
+                process.stdin.write(b'exit\n')
+                process.stdin.flush()
+            else:
+                process.terminate()
+        for name, process, log in stack.Processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+    passed = all(result['ok'] for result in results['echo'].values())
+    for key, result in results['after_stop'].items():
+        expected = not key.startswith(f'{stopped}:')
+        passed = passed and result['ok'] == expected
+    results['passed'] = passed
+    print('PASS' if passed else 'FAIL')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
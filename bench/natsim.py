@@ -0,0 +1,208 @@
+"""Simulated NAT for exercising P2P direct mode on loopback.
+
+SimulatedNat hands out UDP socket stand-ins (pass nat.Socket as a client's
+UdpFactory). Outbound datagrams leave through real loopback sockets that play
+the NAT's public mappings, and inbound datagrams are filtered the way the
+chosen NAT type would filter them:
+
+    full_cone        one mapping per socket, anyone may send to it
+    restricted       one mapping per socket, only IPs it has sent to
+    port_restricted  one mapping per socket, only ip:port pairs it has sent to
+    symmetric        a new mapping per destination, only that destination
+
+Run without arguments to try every combination end to end and report whether
+each one went direct or fell back to the relay:
+
+    python bench/natsim.py
+    python bench/natsim.py --service-nat port_restricted --visitor-nat symmetric --loss 0.02
+"""
+import os
+import sys
+import time
+import json
+import random
+import socket
+import argparse
+import threading
+import contextlib
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import PortForwardServer
+from client import PortForwardClient
+from soak import EchoBackend
+
+NatKinds = ('full_cone', 'restricted', 'port_restricted', 'symmetric')
+
+class SimulatedNat:
+    def __init__(self, Kind, Loss=0.0):
+        if Kind not in NatKinds:
+            raise ValueError(f"Unknown NAT type {Kind}")
+        self.Kind = Kind
+        self.Loss = Loss
+        self.Filtered = 0
+        self.Lost = 0
+
+    def Socket(self):
+        return NatSocket(self)
+
+class NatSocket:
+    def __init__(self, Nat):
+        self.Nat = Nat
+        self.Mappings = {}
+        self.Allowed = {}
+        self.Chunks = deque()
+        self.Condition = threading.Condition()
+        self.Timeout = None
+        self.Closed = False
+
+    def Mapping(self, dest):
+        key = dest if self.Nat.Kind == 'symmetric' else None
+        with self.Condition:
+            public = self.Mappings.get(key)
+            if public is None:
+                public = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                public.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304)
+                public.bind(('127.0.0.1', 0))
+                self.Mappings[key] = public
+                self.Allowed[key] = set()
+                threading.Thread(target=self.Pump, args=(public, key), daemon=True).start()
+            self.Allowed[key].add(dest)
+        return public
+
+    def Admits(self, key, source):
+        if self.Nat.Kind == 'full_cone':
+            return True
+        allowed = self.Allowed[key]
+        if self.Nat.Kind == 'restricted':
+            return any(source[0] == dest[0] for dest in allowed)
+        return source in allowed
+
+    def Pump(self, public, key):
+        public.settimeout(0.2)
+        while not self.Closed:
+            try:
+                data, source = public.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self.Condition:
+                if not self.Admits(key, source):
+                    self.Nat.Filtered += 1
+                    continue
+                if random.random() < self.Nat.Loss:
+                    self.Nat.Lost += 1
+                    continue
+                self.Chunks.append((data, source))
+                self.Condition.notify_all()
+
+    def sendto(self, data, dest):
+        dest = (socket.gethostbyname(dest[0]), dest[1])
+        public = self.Mapping(dest)
+        if random.random() < self.Nat.Loss:
+            self.Nat.Lost += 1
+            return len(data)
+        return public.sendto(data, dest)
+
+    def recvfrom(self, bufsize):
+        with self.Condition:
+            deadline = None if self.Timeout is None else time.monotonic() + self.Timeout
+            while not self.Chunks:
+                if self.Closed:
+                    raise OSError('socket closed')
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout('timed out')
+                self.Condition.wait(remaining)
+            return self.Chunks.popleft()
+
+    def settimeout(self, timeout):
+        self.Timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        with self.Condition:
+            self.Closed = True
+            self.Condition.notify_all()
+        for public in self.Mappings.values():
+            public.close()
+
+def Exchange(port, size, timeout=60):
+    payload = os.urandom(size)
+    conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    started = time.monotonic()
+    sender = threading.Thread(target=conn.sendall, args=(payload,))
+    sender.start()
+    received = bytearray()
+    while len(received) < size:
+        data = conn.recv(65536)
+        if not data:
+            break
+        received += data
+    sender.join()
+    elapsed = time.monotonic() - started
+    conn.close()
+    return bytes(received) == payload, elapsed
+
+def RunScenario(args, serviceNat, visitorNat, basePort):
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    server = PortForwardServer(InternalDataPort=basePort, AllowedPortRange=f"{basePort + 1}-{basePort + 2}",
+                               Key=args.key, RendezvousPort=basePort)
+    natA = SimulatedNat(serviceNat, args.loss) if serviceNat != 'none' else None
+    natB = SimulatedNat(visitorNat, args.loss) if visitorNat != 'none' else None
+    service = PortForwardClient(ServerPort=basePort, Key=args.key, UdpFactory=natA and natA.Socket, Forwards=[
+        {'mode': 'P2P', 'name': 'echo', 'secret': 'natsim', 'forward_port': backend.Port, 'punch_timeout': args.punch_timeout}])
+    visitor = PortForwardClient(ServerPort=basePort, Key=args.key, UdpFactory=natB and natB.Socket, Visitors=[
+        {'name': 'echo', 'secret': 'natsim', 'bind_port': basePort + 3, 'punch_timeout': args.punch_timeout}])
+    result = {'service_nat': serviceNat, 'visitor_nat': visitorNat}
+    try:
+        server.Serve()
+        service.Connect()
+        time.sleep(0.3)
+        visitor.Connect()
+        ok, elapsed = Exchange(basePort + 3, args.bytes)
+        stats = visitor.GetStats()
+        result['mode'] = 'direct' if stats.get('p2p_direct') else 'relay'
+        result['ok'] = ok
+        result['seconds'] = round(elapsed, 2)
+        result['filtered'] = sum(nat.Filtered for nat in (natA, natB) if nat)
+        result['lost'] = sum(nat.Lost for nat in (natA, natB) if nat)
+    finally:
+        visitor.Stop()
+        service.Stop()
+        server.Stop()
+        backend.Running = False
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='P2P direct mode through simulated NATs')
+    parser.add_argument('--service-nat', choices=('none',) + NatKinds)
+    parser.add_argument('--visitor-nat', choices=('none',) + NatKinds)
+    parser.add_argument('--loss', type=float, default=0.0, help='datagram loss rate inside each NAT')
+    parser.add_argument('--bytes', type=int, default=1048576, help='payload echoed through the visitor')
+    parser.add_argument('--punch-timeout', type=float, default=2)
+    parser.add_argument('--base-port', type=int, default=21700)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    kinds = ('none',) + NatKinds
+    pairs = [(a, b) for a in kinds for b in kinds]
+    if args.service_nat or args.visitor_nat:
+        pairs = [(args.service_nat or 'none', args.visitor_nat or 'none')]
+    failed = False
+    for index, (serviceNat, visitorNat) in enumerate(pairs):
+        basePort = args.base_port + index * 4
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w')):
+            result = RunScenario(args, serviceNat, visitorNat, basePort)
+            # Let connection threads finish their shutdown messages while output is still redirected
+            time.sleep(0.5)
+        failed = failed or not result['ok']
+        print(json.dumps(result), flush=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
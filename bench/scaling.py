@@ -0,0 +1,109 @@
+"""Throughput against concurrent streams, per interpreter.
+
+Runs the server and one client under each interpreter given with --python,
+then pushes the same total payload through one forward over 1, 2, 4, ...
+parallel streams. Every stream is a pair of threads on each side, so on a
+free-threaded build (python3.13t, GIL disabled) throughput should keep rising
+with the stream count up to the core count, while a standard build flattens
+out near one core:
+
+    python bench/scaling.py --python python3.13 python3.13t --threads 1,2,4,8,16
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+from soak import EchoBackend, Soak, Ping
+
+def Describe(python):
+    probe = "import sys, platform; print(platform.python_version(), int(getattr(sys, '_is_gil_enabled', lambda: True)()))"
+    version, gil = subprocess.check_output([python, '-c', probe], text=True).split()
+    return {'python': python, 'version': version, 'gil': gil == '1'}
+
+def Echo(port, size, timeout, results, index):
+    payload = os.urandom(size)
+    try:
+        conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        sender = threading.Thread(target=conn.sendall, args=(payload,), daemon=True)
+        sender.start()
+        received = bytearray()
+        while len(received) < size:
+            data = conn.recv(262144)
+            if not data:
+                break
+            received += data
+        sender.join()
+        conn.close()
+        results[index] = bytes(received) == payload
+    except OSError:
+        results[index] = False
+
+def RunPython(args, python, basePort, backendPort):
+    stack = Soak(args)
+    info = Describe(python)
+    info['runs'] = []
+    try:
+        stack.Launch('server', 'server.py', {'InternalDataPort': basePort, 'AllowedPortRange': f'{basePort + 1}-{basePort + 2}',
+                                             'Key': args.key}, python)
+        time.sleep(0.5)
+        stack.Launch('client0', 'client.py', {'ServerDomain': '127.0.0.1', 'ServerPort': basePort, 'Key': args.key, 'Forwards': [
+            {'forward_domain': '127.0.0.1', 'forward_port': backendPort, 'target_port': basePort + 1, 'mode': 'TCP'}]}, python)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                Ping(basePort + 1, b'ready', 2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'forward under {python} never came up, see logs in {stack.Workdir}')
+                time.sleep(0.2)
+        for count in [int(value) for value in args.threads.split(',')]:
+            size = args.bytes // count
+            results = [None] * count
+            workers = [threading.Thread(target=Echo, args=(basePort + 1, size, args.timeout, results, index))
+                       for index in range(count)]
+            started = time.monotonic()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.monotonic() - started
+            run = {'streams': count, 'ok': all(results), 'mb_per_s': round(size * count / elapsed / 1048576, 1)}
+            info['runs'].append(run)
+            print(json.dumps(dict(run, python=python)), flush=True)
+    finally:
+        stack.Shutdown()
+    return info
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp throughput against thread count')
+    parser.add_argument('--python', nargs='+', default=[sys.executable], help='interpreters to run the server and client under')
+    parser.add_argument('--threads', default='1,2,4,8', help='comma-separated parallel stream counts')
+    parser.add_argument('--bytes', type=int, default=16777216, help='total payload per run, split across the streams')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--base-port', type=int, default=21650)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    results = {'cpus': os.cpu_count(), 'interpreters': []}
+    for index, python in enumerate(args.python):
+        results['interpreters'].append(RunPython(args, python, args.base_port + index * 3, backend.Port))
+    print(f"{'python':<24} {'gil':<5} " + ' '.join(f"{run['streams']:>8}" for run in results['interpreters'][0]['runs']))
+    for info in results['interpreters']:
+        print(f"{os.path.basename(info['python']) + ' ' + info['version']:<24} {'on' if info['gil'] else 'off':<5} "
+              + ' '.join(f"{run['mb_per_s']:>8}" for run in info['runs']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(run['ok'] for info in results['interpreters'] for run in info['runs']) else 1)
+
+if __name__ == '__main__':
+    main()
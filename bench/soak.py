@@ -0,0 +1,339 @@
+"""Scale and soak harness for PyFrp.
+
+Starts a server and one or more clients as subprocesses, ramps up mostly-idle
+public connections while churn workers open and close short-lived ones, and
+samples RSS, threads, open fds and CPU of every process from /proc. Exits with
+status 1 when the per-connection memory or error-rate budget is exceeded.
+
+    python bench/soak.py --connections 10000 --clients 2 --forwards 4 --duration 120
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import selectors
+import resource
+import tempfile
+import threading
+import subprocess
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ClockTicks = os.sysconf('SC_CLK_TCK')
+PageSize = os.sysconf('SC_PAGE_SIZE')
+
+def RaiseFdLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+class ProcessProbe:
+    def __init__(self, Name, Pid):
+        self.Name = Name
+        self.Pid = Pid
+        self.LastCpu = None
+        self.LastTime = None
+
+    def Sample(self):
+        try:
+            with open(f'/proc/{self.Pid}/statm') as f:
+                rss = int(f.read().split()[1]) * PageSize
+            with open(f'/proc/{self.Pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            threads = int(fields[17])
+            cpu = (int(fields[11]) + int(fields[12])) / ClockTicks
+            fds = len(os.listdir(f'/proc/{self.Pid}/fd'))
+        except (OSError, IndexError, ValueError):
+            return None
+        now = time.monotonic()
+        percent = 0.0
+        if self.LastCpu is not None and now > self.LastTime:
+            percent = 100.0 * (cpu - self.LastCpu) / (now - self.LastTime)
+        self.LastCpu, self.LastTime = cpu, now
+        return {'rss': rss, 'threads': threads, 'fds': fds, 'cpu': round(percent, 1)}
+
+class EchoBackend:
+    """Single-threaded echo server so the backend does not skew thread counts."""
+
+    def __init__(self, Port):
+        self.Selector = selectors.DefaultSelector()
+        self.Listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.Listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.Listener.bind(('127.0.0.1', Port))
+        self.Listener.listen(4096)
+        self.Listener.setblocking(False)
+        self.Selector.register(self.Listener, selectors.EVENT_READ)
+        self.Port = self.Listener.getsockname()[1]
+        self.Running = True
+
+    def Run(self):
+        while self.Running:
+            for key, _ in self.Selector.select(0.5):
+                if key.fileobj is self.Listener:
+                    try:
+                        conn, _ = self.Listener.accept()
+                    except OSError:
+                        continue
+                    conn.setblocking(False)
+                    self.Selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                    if data:
+                        conn.send(data)
+                        continue
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    pass
+                self.Selector.unregister(conn)
+                conn.close()
+
+class Counters:
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Opened = 0
+        self.Churned = 0
+        self.Errors = 0
+        self.Attempts = 0
+
+    def Add(self, **amounts):
+        with self.Lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+def Ping(port, payload, timeout):
+    conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    try:
+        conn.sendall(payload)
+        received = b''
+        while len(received) < len(payload):
+            data = conn.recv(65536)
+            if not data:
+                raise ConnectionError('closed before echo')
+            received += data
+        if received != payload:
+            raise ConnectionError('echo mismatch')
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+class Soak:
+    def __init__(self, Args):
+        self.Args = Args
+        self.Counters = Counters()
+        self.Idle = []
+        self.IdleLock = threading.Lock()
+        self.Running = True
+        self.Processes = []
+        self.Probes = []
+        self.Samples = []
+        self.Ports = []
+        self.Workdir = tempfile.mkdtemp(prefix='pyfrp-soak-')
+
+    def Launch(self, name, script, config, python=None):
+        path = os.path.join(self.Workdir, f'{name}.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        log = open(os.path.join(self.Workdir, f'{name}.log'), 'w')
+        process = subprocess.Popen([python or sys.executable, os.path.join(RepoDir, script), path], cwd=RepoDir,
+                                   stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT,
+                                   preexec_fn=RaiseFdLimit)
+        self.Processes.append((name, process, log))
+        self.Probes.append(ProcessProbe(name, process.pid))
+        return process
+
+    def StartStack(self, backendPort, serverConfig=None):
+        args = self.Args
+        total = args.clients * args.forwards
+        lastPort = args.base_port + total
+        self.Launch('server', 'server.py', dict({
+            'InternalDataPort': args.base_port,
+            'AllowedPortRange': f'{args.base_port + 1}-{lastPort + 1}',
+            'MaxPortsPerClient': args.forwards,
+            'Key': args.key,
+        }, **(serverConfig or {})))
+        time.sleep(0.5)
+        port = args.base_port + 1
+        for index in range(args.clients):
+            forwards = []
+            for _ in range(args.forwards):
+                forwards.append({'forward_domain': '127.0.0.1', 'forward_port': backendPort,
+                                 'target_port': port, 'mode': 'TCP'})
+                self.Ports.append(port)
+                port += 1
+            self.Launch(f'client{index}', 'client.py', {
+                'ServerDomain': '127.0.0.1', 'ServerPort': args.base_port, 'Key': args.key, 'Forwards': forwards,
+            })
+        deadline = time.monotonic() + 30
+        for port in self.Ports:
+            while True:
+                try:
+                    Ping(port, b'ready', 2).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f'forward {port} never came up, see logs in {self.Workdir}')
+                    time.sleep(0.2)
+
+    def Ramp(self, worker):
+        args = self.Args
+        workers = args.ramp_workers
+        interval = workers / args.ramp_rate if args.ramp_rate else 0
+        index = worker
+        while self.Running and index < args.connections:
+            started = time.monotonic()
+            self.Counters.Add(Attempts=1)
+            try:
+                conn = Ping(self.Ports[index % len(self.Ports)], b'idle', args.timeout)
+                with self.IdleLock:
+                    self.Idle.append(conn)
+                self.Counters.Add(Opened=1)
+            except OSError:
+                self.Counters.Add(Errors=1)
+            index += workers
+            delay = interval - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def Churn(self, worker):
+        args = self.Args
+        payload = os.urandom(args.churn_bytes)
+        index = worker
+        while self.Running:
+            self.Counters.Add(Attempts=1)
+            try:
+                Ping(self.Ports[index % len(self.Ports)], payload, args.timeout).close()
+                self.Counters.Add(Churned=1)
+            except OSError:
+                self.Counters.Add(Errors=1)
+            index += 1
+
+    def Sample(self, started, baseline):
+        counters = self.Counters
+        sample = {'time': round(time.monotonic() - started, 1), 'idle': counters.Opened,
+                  'churned': counters.Churned, 'errors': counters.Errors, 'attempts': counters.Attempts}
+        for probe in self.Probes:
+            usage = probe.Sample()
+            if usage is not None:
+                sample[probe.Name] = usage
+                if probe.Name not in baseline:
+                    baseline[probe.Name] = usage['rss']
+        self.Samples.append(sample)
+        return sample
+
+    def Report(self, sample):
+        parts = [f"t={sample['time']:>6}s idle={sample['idle']:>6} churned={sample['churned']:>7} errors={sample['errors']}"]
+        for probe in self.Probes:
+            usage = sample.get(probe.Name)
+            if usage:
+                parts.append(f"{probe.Name}: rss={usage['rss'] // 1048576}M thr={usage['threads']} "
+                             f"fd={usage['fds']} cpu={usage['cpu']}%")
+        print(' | '.join(parts), flush=True)
+
+    def Run(self):
+        args = self.Args
+        limit = RaiseFdLimit()
+        if args.connections * 2 + 256 > limit:
+            print(f"Warning: fd limit {limit} is below what {args.connections} connections need")
+        backend = EchoBackend(args.backend_port)
+        threading.Thread(target=backend.Run, daemon=True).start()
+        baseline = {}
+        try:
+            self.StartStack(backend.Port)
+            started = time.monotonic()
+            self.Report(self.Sample(started, baseline))
+            threads = [threading.Thread(target=self.Ramp, args=(worker,), daemon=True)
+                       for worker in range(args.ramp_workers)]
+            threads += [threading.Thread(target=self.Churn, args=(worker,), daemon=True)
+                        for worker in range(args.churn_workers)]
+            for thread in threads:
+                thread.start()
+            while time.monotonic() - started < args.duration:
+                time.sleep(args.interval)
+                self.Report(self.Sample(started, baseline))
+            self.Running = False
+            return self.Verdict(baseline)
+        finally:
+            self.Running = False
+            backend.Running = False
+            self.Shutdown()
+
+    def Verdict(self, baseline):
+        args = self.Args
+        result = {'samples': self.Samples, 'budgets': {}, 'passed': True}
+        peak = max((sample['idle'] for sample in self.Samples), default=0)
+        attempts = self.Counters.Attempts
+        errorRate = self.Counters.Errors / attempts if attempts else 0.0
+        result['peak_connections'] = peak
+        result['error_rate'] = errorRate
+        result['budgets']['error_rate'] = {'value': errorRate, 'limit': args.max_error_rate,
+                                           'passed': errorRate <= args.max_error_rate}
+        for probe in self.Probes:
+            rss = [sample[probe.Name]['rss'] for sample in self.Samples if probe.Name in sample]
+            if not rss or not peak:
+                continue
+            perConnection = (max(rss) - baseline[probe.Name]) / peak
+            result['budgets'][f'{probe.Name}_bytes_per_connection'] = {
+                'value': round(perConnection), 'limit': args.max_bytes_per_connection,
+                'passed': perConnection <= args.max_bytes_per_connection}
+        if peak < args.connections * args.min_reached:
+            result['budgets']['connections_reached'] = {'value': peak, 'limit': args.connections, 'passed': False}
+        result['passed'] = all(budget['passed'] for budget in result['budgets'].values())
+        for name, budget in result['budgets'].items():
+            state = 'ok' if budget['passed'] else 'FAIL'
+            print(f"{state:>4} {name}: {budget['value']} (limit {budget['limit']})")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+        return result['passed']
+
+    def Shutdown(self):
+        with self.IdleLock:
+            for conn in self.Idle:
+                conn.close()
+            self.Idle.clear()
+        for name, process, log in self.Processes:
+            try:
+                if name == 'server':
+                    process.stdin.write(b'exit\n')
+                    process.stdin.flush()
+            except OSError:
+                pass
+        for name, process, log in self.Processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp scale and soak harness')
+    parser.add_argument('--connections', type=int, default=2000, help='idle connections to ramp up to')
+    parser.add_argument('--ramp-rate', type=float, default=500, help='new idle connections per second (0 = unthrottled)')
+    parser.add_argument('--ramp-workers', type=int, default=8)
+    parser.add_argument('--churn-workers', type=int, default=2, help='threads opening short-lived connections')
+    parser.add_argument('--churn-bytes', type=int, default=1024)
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--forwards', type=int, default=4, help='forwards per client')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--base-port', type=int, default=21000, help='control port; forwards use the ports above it')
+    parser.add_argument('--backend-port', type=int, default=0)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--max-bytes-per-connection', type=int, default=65536)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--min-reached', type=float, default=0.0,
+                        help='fail unless this fraction of --connections was reached')
+    parser.add_argument('--output', help='write samples and verdict as JSON')
+    args = parser.parse_args()
+    sys.exit(0 if Soak(args).Run() else 1)
+
+if __name__ == '__main__':
+    main()
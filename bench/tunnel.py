@@ -0,0 +1,206 @@
+"""Same-host tunnel transports compared.
+
+For each transport the server and one client run as separate processes, the
+client forwarding one public port to an echo backend. The tunnel leg between
+them is loopback TCP, the server's Unix socket, or shared-memory rings
+negotiated over that socket:
+
+    tcp   ServerDomain 127.0.0.1
+    unix  ServerDomain unix:<path>
+    shm   ServerDomain unix:<path> with SharedMemory set
+
+Reports bulk echo throughput and small-message round-trip latency per mode,
+end to end through the proxy and for the bare transport between two processes
+(--raw), which is the ceiling the tunnel's own framing sits under.
+
+    python bench/tunnel.py --bytes 33554432 --pings 2000
+    python bench/tunnel.py --raw
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from soak import EchoBackend, Soak, Ping
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transport import OfferSharedMemory, AcceptSharedMemory
+
+Modes = ('tcp', 'unix', 'shm')
+
+def Bulk(port, size, timeout):
+    payload = os.urandom(size)
+    conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    started = time.monotonic()
+    sender = threading.Thread(target=conn.sendall, args=(payload,), daemon=True)
+    sender.start()
+    received = bytearray()
+    while len(received) < size:
+        data = conn.recv(262144)
+        if not data:
+            break
+        received += data
+    elapsed = time.monotonic() - started
+    sender.join()
+    conn.close()
+    return bytes(received) == payload, elapsed
+
+def PingPong(port, count, timeout):
+    conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    samples = []
+    for index in range(count):
+        message = b'%08d' % index
+        started = time.perf_counter()
+        conn.sendall(message)
+        received = b''
+        while len(received) < len(message):
+            data = conn.recv(64)
+            if not data:
+                raise ConnectionError('echo closed early')
+            received += data
+        samples.append(time.perf_counter() - started)
+    conn.close()
+    samples.sort()
+    return {'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+            'p99_us': round(samples[int(len(samples) * 0.99)] * 1e6, 1)}
+
+def RawEcho(mode, address):
+    listener = socket.socket(socket.AF_INET if mode == 'tcp' else socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(1)
+    conn, _ = listener.accept()
+    if mode == 'shm':
+        line = b''
+        while not line.endswith(b'\n'):
+            line += conn.recv(1)
+        conn = AcceptSharedMemory(conn, line)
+    while True:
+        data = conn.recv(262144)
+        if not data:
+            break
+        conn.sendall(data)
+    conn.close()
+
+def RunRaw(args, mode, basePort):
+    workdir = tempfile.mkdtemp(prefix='pyfrp-tunnel-')
+    address = ('127.0.0.1', basePort) if mode == 'tcp' else os.path.join(workdir, 'raw.sock')
+    echo = multiprocessing.Process(target=RawEcho, args=(mode, address), daemon=True)
+    echo.start()
+    deadline = time.monotonic() + 10
+    while True:
+        conn = socket.socket(socket.AF_INET if mode == 'tcp' else socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(address)
+            break
+        except OSError:
+            conn.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    if mode == 'tcp':
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if mode == 'shm':
+        conn = OfferSharedMemory(conn, args.ring)
+    payload = os.urandom(args.bytes)
+    started = time.monotonic()
+    sender = threading.Thread(target=conn.sendall, args=(payload,), daemon=True)
+    sender.start()
+    received = 0
+    while received < args.bytes:
+        received += len(conn.recv(262144))
+    elapsed = time.monotonic() - started
+    sender.join()
+    samples = []
+    for index in range(args.pings):
+        started = time.perf_counter()
+        conn.sendall(b'%08d' % index)
+        got = 0
+        while got < 8:
+            got += len(conn.recv(64))
+        samples.append(time.perf_counter() - started)
+    conn.close()
+    echo.join(5)
+    samples.sort()
+    return {'mode': f'raw-{mode}', 'ok': received == args.bytes, 'mb_per_s': round(args.bytes / elapsed / 1048576, 1),
+            'p50_us': round(samples[len(samples) // 2] * 1e6, 1),
+            'p99_us': round(samples[int(len(samples) * 0.99)] * 1e6, 1)}
+
+def RunMode(args, mode, basePort, backendPort):
+    stack = Soak(args)
+    socketPath = os.path.join(stack.Workdir, 'tunnel.sock')
+    serverConfig = {'InternalDataPort': basePort, 'AllowedPortRange': f'{basePort + 1}-{basePort + 2}', 'Key': args.key}
+    clientConfig = {'ServerDomain': '127.0.0.1', 'ServerPort': basePort, 'Key': args.key, 'Forwards': [
+        {'forward_domain': '127.0.0.1', 'forward_port': backendPort, 'target_port': basePort + 1, 'mode': 'TCP'}]}
+    if mode != 'tcp':
+        serverConfig['UnixSocketPath'] = socketPath
+        clientConfig['ServerDomain'] = f'unix:{socketPath}'
+    if mode == 'shm':
+        clientConfig['SharedMemory'] = args.ring
+    result = {'mode': mode}
+    try:
+        stack.Launch('server', 'server.py', serverConfig)
+        time.sleep(0.5)
+        stack.Launch('client0', 'client.py', clientConfig)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                Ping(basePort + 1, b'ready', 2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'{mode} forward never came up, see logs in {stack.Workdir}')
+                time.sleep(0.2)
+        ok, elapsed = Bulk(basePort + 1, args.bytes, args.timeout)
+        result['ok'] = ok
+        result['mb_per_s'] = round(args.bytes / elapsed / 1048576, 1)
+        result.update(PingPong(basePort + 1, args.pings, args.timeout))
+    finally:
+        stack.Shutdown()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp same-host tunnel transports')
+    parser.add_argument('--modes', default=','.join(Modes), help='comma-separated subset of tcp,unix,shm')
+    parser.add_argument('--bytes', type=int, default=16777216, help='payload echoed for the throughput run')
+    parser.add_argument('--pings', type=int, default=1000, help='round trips for the latency run')
+    parser.add_argument('--ring', type=int, default=4194304, help='shared-memory ring size per direction')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--base-port', type=int, default=21600)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--raw', action='store_true', help='measure the bare transports instead of the proxy')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    results = []
+    for index, mode in enumerate(args.modes.split(',')):
+        if mode not in Modes:
+            parser.error(f'unknown mode {mode}')
+        if args.raw:
+            result = RunRaw(args, mode, args.base_port + index * 3)
+        else:
+            result = RunMode(args, mode, args.base_port + index * 3, backend.Port)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+    baseline = next((r for r in results if r['mode'].endswith('tcp')), None)
+    if baseline:
+        for result in results:
+            if result is not baseline:
+                print(f"{result['mode']}: {result['mb_per_s'] / baseline['mb_per_s']:.2f}x throughput, "
+                      f"{result['p50_us'] / baseline['p50_us']:.2f}x p50 latency vs {baseline['mode']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == '__main__':
+    main()
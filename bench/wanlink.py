@@ -0,0 +1,166 @@
+"""Tunnel bytes with and without chunk deduplication.
+
+Runs the server and one client as separate processes with the tunnel routed
+through a relay in this process, which stands in for the WAN link: it counts
+the bytes in each direction and can cap their rate. Each round echoes a copy
+of the same payload with a small edit at a random offset, the way a bundle or
+API response is fetched again by another visitor, through a forward with
+"dedup" on or off:
+
+    python bench/wanlink.py --size 1048576 --rounds 8 --rate 10485760
+"""
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+
+from soak import EchoBackend, Soak, Ping
+
+Modes = ('plain', 'dedup')
+
+class Link:
+    """TCP relay between client and server that counts and paces tunnel bytes."""
+
+    def __init__(self, Port, Target, Rate):
+        self.Target = Target
+        self.Rate = Rate
+        self.Bytes = {'up': 0, 'down': 0}
+        self.Listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.Listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.Listener.bind(('127.0.0.1', Port))
+        self.Listener.listen(1)
+        threading.Thread(target=self.Run, daemon=True).start()
+
+    def Run(self):
+        while True:
+            try:
+                conn, _ = self.Listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.Target)
+            threading.Thread(target=self.Pump, args=(conn, upstream, 'up'), daemon=True).start()
+            threading.Thread(target=self.Pump, args=(upstream, conn, 'down'), daemon=True).start()
+
+    def Pump(self, source, sink, direction):
+        started = time.monotonic()
+        sent = 0
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                self.Bytes[direction] += len(data)
+                sent += len(data)
+                if self.Rate:
+                    delay = started + sent / self.Rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        started, sent = time.monotonic(), 0
+                sink.sendall(data)
+        except OSError:
+            pass
+        for conn in (source, sink):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def Close(self):
+        self.Listener.close()
+
+def Echo(port, payload, timeout):
+    conn = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    sender = threading.Thread(target=conn.sendall, args=(payload,), daemon=True)
+    sender.start()
+    received = bytearray()
+    while len(received) < len(payload):
+        data = conn.recv(262144)
+        if not data:
+            break
+        received += data
+    sender.join()
+    conn.close()
+    return bytes(received) == payload
+
+def RunMode(args, mode, basePort, backendPort):
+    stack = Soak(args)
+    link = Link(basePort + 3, ('127.0.0.1', basePort), args.rate)
+    serverConfig = {'InternalDataPort': basePort, 'AllowedPortRange': f'{basePort + 1}-{basePort + 2}', 'Key': args.key,
+                    'Dedup': {'max_bytes': args.store}}
+    clientConfig = {'ServerDomain': '127.0.0.1', 'ServerPort': basePort + 3, 'Key': args.key, 'Dedup': {'max_bytes': args.store},
+                    'Forwards': [{'forward_domain': '127.0.0.1', 'forward_port': backendPort, 'target_port': basePort + 1,
+                                  'mode': 'TCP', 'dedup': mode == 'dedup'}]}
+    rng = random.Random(args.seed)
+    base = rng.randbytes(args.size)
+    result = {'mode': mode, 'ok': True}
+    try:
+        stack.Launch('server', 'server.py', serverConfig)
+        time.sleep(0.5)
+        stack.Launch('client0', 'client.py', clientConfig)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                Ping(basePort + 1, b'ready', 2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'{mode} forward never came up, see logs in {stack.Workdir}')
+                time.sleep(0.2)
+        before = dict(link.Bytes)
+        started = time.monotonic()
+        payloadBytes = 0
+        for index in range(args.rounds):
+            offset = rng.randrange(args.size)
+            payload = base[:offset] + b'edit %d' % index + base[offset:]
+            payloadBytes += len(payload)
+            result['ok'] &= Echo(basePort + 1, payload, args.timeout)
+        elapsed = time.monotonic() - started
+        result['up_bytes'] = link.Bytes['up'] - before['up']
+        result['down_bytes'] = link.Bytes['down'] - before['down']
+        result['payload_bytes'] = payloadBytes
+        result['wire_per_payload'] = round((result['up_bytes'] + result['down_bytes']) / (2 * payloadBytes), 3)
+        result['seconds'] = round(elapsed, 2)
+    finally:
+        stack.Shutdown()
+        link.Close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='PyFrp chunk deduplication over a counted link')
+    parser.add_argument('--modes', default=','.join(Modes), help='comma-separated subset of plain,dedup')
+    parser.add_argument('--size', type=int, default=1048576, help='payload size per round')
+    parser.add_argument('--rounds', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=0, help='link rate in bytes per second each way, 0 for unpaced')
+    parser.add_argument('--store', type=int, default=16777216, help='chunk store size per tunnel direction')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--base-port', type=int, default=21650)
+    parser.add_argument('--key', default='07A36AEF1907843')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    backend = EchoBackend(0)
+    threading.Thread(target=backend.Run, daemon=True).start()
+    results = []
+    for index, mode in enumerate(args.modes.split(',')):
+        if mode not in Modes:
+            parser.error(f'unknown mode {mode}')
+        result = RunMode(args, mode, args.base_port + index * 4, backend.Port)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+    byMode = {result['mode']: result for result in results}
+    if len(byMode) == 2:
+        plain, dedup = byMode['plain'], byMode['dedup']
+        print(f"dedup: {dedup['wire_per_payload'] / plain['wire_per_payload']:.3f}x tunnel bytes, "
+              f"{plain['seconds'] / dedup['seconds']:.2f}x speed vs plain")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
+
+if __name__ == '__main__':
+    main()
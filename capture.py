@@ -0,0 +1,247 @@
+import sys
+import os
+import mmap
+import json
+import time
+import struct
+import socket
+import threading
+from collections import defaultdict
+
+CaptureMagic = b'PFXCAP1\n'
+CaptureRecord = struct.Struct('<dBII')
+CaptureIn = 0
+CaptureOut = 1
+MessageSeparator = b'|||'
+
+class CaptureWriter:
+    def __init__(self, Path, Role, BufferSize=1048576):
+        self.Path = Path
+        self.Role = Role
+        self.Lock = threading.Lock()
+        self.File = open(Path, 'ab', buffering=BufferSize)
+        if self.File.tell() == 0:
+            self.File.write(CaptureMagic + Role.encode('ascii').ljust(8, b'\0'))
+        self.Frames = 0
+        self.Bytes = 0
+
+    def Write(self, direction, channel, frame):
+        header = CaptureRecord.pack(time.time(), direction, channel, len(frame))
+        with self.Lock:
+            if self.File is None:
+                return
+            self.File.write(header)
+            self.File.write(frame)
+            self.Frames += 1
+            self.Bytes += len(frame)
+
+    def Flush(self):
+        with self.Lock:
+            if self.File is not None:
+                self.File.flush()
+
+    def Close(self):
+        with self.Lock:
+            if self.File is not None:
+                self.File.close()
+                self.File = None
+
+class CaptureReader:
+    def __init__(self, Path):
+        self.Path = Path
+        with open(Path, 'rb') as f:
+            self.Map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.Map[:len(CaptureMagic)] != CaptureMagic:
+            self.Map.close()
+            raise ValueError(f"{Path} is not a capture file")
+        offset = len(CaptureMagic)
+        self.Role = self.Map[offset:offset + 8].rstrip(b'\0').decode('ascii')
+        self.Start = offset + 8
+
+    def __iter__(self):
+        offset = self.Start
+        size = len(self.Map)
+        while offset + CaptureRecord.size <= size:
+            timestamp, direction, channel, length = CaptureRecord.unpack_from(self.Map, offset)
+            offset += CaptureRecord.size
+            if offset + length > size:
+                break
+            yield timestamp, direction, channel, self.Map[offset:offset + length]
+            offset += length
+
+    def Close(self):
+        self.Map.close()
+
+def RewriteAuth(frame, key):
+    if key is None or b'"auth"' not in frame:
+        return frame
+    try:
+        message = json.loads(frame.decode('utf-8'))
+    except ValueError:
+        return frame
+    if message.get('type') != 'auth':
+        return frame
+    message['key'] = key
+    return json.dumps(message).encode('utf-8')
+
+def ReplayChannel(sock, frames, speed, key, result):
+    # Frames are (timestamp, frame); pacing follows the capture clock divided by speed.
+    start = time.monotonic()
+    first = frames[0][0] if frames else 0
+    sent = 0
+    size = 0
+    errors = 0
+    try:
+        for timestamp, frame in frames:
+            if speed:
+                delay = (timestamp - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            sock.sendall(RewriteAuth(frame, key) + MessageSeparator)
+            sent += 1
+            size += len(frame)
+    except OSError as e:
+        errors += 1
+        print(f"Replay error: {e}")
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        DrainSocket(sock)
+        sock.close()
+    with result['lock']:
+        result['frames'] += sent
+        result['bytes'] += size
+        result['errors'] += errors
+
+def DrainSocket(sock, timeout=1):
+    sock.settimeout(timeout)
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+def Replay(Path, Connect, Speed=None, Key=None):
+    """Replay the inbound frames of a capture.
+
+    Connect(channel) must return a connected socket for each captured tunnel;
+    Speed=None sends as fast as possible, 1.0 keeps the original timing.
+    """
+    reader = CaptureReader(Path)
+    channels = defaultdict(list)
+    try:
+        for timestamp, direction, channel, frame in reader:
+            if direction == CaptureIn:
+                channels[channel].append((timestamp, bytes(frame)))
+    finally:
+        reader.Close()
+    first = min((frames[0][0] for frames in channels.values()), default=0)
+    result = {'frames': 0, 'bytes': 0, 'errors': 0, 'channels': len(channels), 'lock': threading.Lock()}
+    threads = []
+    start = time.monotonic()
+    for channel, frames in sorted(channels.items()):
+        if Speed:
+            delay = (frames[0][0] - first) / Speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            sock = Connect(channel)
+        except OSError as e:
+            result['errors'] += 1
+            print(f"Replay connect error on channel {channel}: {e}")
+            continue
+        thread = threading.Thread(target=ReplayChannel, args=(sock, frames, Speed, Key, result))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    del result['lock']
+    result['elapsed'] = elapsed
+    result['frames_per_second'] = result['frames'] / elapsed if elapsed > 0 else 0.0
+    result['bytes_per_second'] = result['bytes'] / elapsed if elapsed > 0 else 0.0
+    return result
+
+def ReplayToServer(Path, Host, Port, Speed=None, Key=None):
+    return Replay(Path, lambda channel: socket.create_connection((Host, Port)), Speed, Key)
+
+def ReplayToClient(Path, Host, Port, Speed=None):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((Host, Port))
+    listener.listen(16)
+    print(f"Waiting for clients on {Host}:{Port}")
+
+    def Accept(channel):
+        conn, addr = listener.accept()
+        print(f"Replaying channel {channel} to {addr[0]}:{addr[1]}")
+        return conn
+
+    try:
+        return Replay(Path, Accept, Speed)
+    finally:
+        listener.close()
+
+def Summarize(Path):
+    reader = CaptureReader(Path)
+    counts = defaultdict(int)
+    channels = set()
+    first = last = None
+    total = 0
+    try:
+        for timestamp, direction, channel, frame in reader:
+            first = timestamp if first is None else first
+            last = timestamp
+            channels.add(channel)
+            counts['in' if direction == CaptureIn else 'out'] += 1
+            total += len(frame)
+    finally:
+        reader.Close()
+    return {'role': reader.Role, 'channels': len(channels), 'frames_in': counts['in'], 'frames_out': counts['out'],
+            'bytes': total, 'duration': (last - first) if first is not None else 0.0}
+
+def main():
+    usage = ("Usage:\n"
+             "  python capture.py info <capture>\n"
+             "  python capture.py server <capture> <host> <port> [--realtime|--speed N] [--key KEY]\n"
+             "  python capture.py client <capture> <listen_host> <listen_port> [--realtime|--speed N]")
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] not in ('info', 'server', 'client'):
+        print(usage)
+        sys.exit(1)
+    command, path = args[0], args[1]
+    if not os.path.exists(path):
+        print(f"Capture file not found: {path}")
+        sys.exit(1)
+    if command == 'info':
+        print(json.dumps(Summarize(path), indent=2))
+        return
+    if len(args) < 4:
+        print(usage)
+        sys.exit(1)
+    host, port = args[2], int(args[3])
+    speed = None
+    key = None
+    rest = args[4:]
+    while rest:
+        option = rest.pop(0)
+        if option == '--realtime':
+            speed = 1.0
+        elif option == '--speed' and rest:
+            speed = float(rest.pop(0))
+        elif option == '--key' and rest:
+            key = rest.pop(0)
+        else:
+            print(usage)
+            sys.exit(1)
+    if command == 'server':
+        result = ReplayToServer(path, host, port, speed, key)
+    else:
+        result = ReplayToClient(path, host, port, speed)
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -4,29 +4,290 @@ import json
 import traceback
 import sys
 import time
+import random
+import asyncio
+import itertools
+from collections import defaultdict
+
+try:
+    from .capture import CaptureWriter, CaptureIn, CaptureOut
+    from .transport import MemoryBudget, OfferSharedMemory
+    from .p2p import Punch, Splice
+    from .dedup import Chunker, StreamCutter, DedupEncoder, DedupDecoder, Queued, DataMessage, MessageData, MinStoreBytes
+except ImportError:
+    from capture import CaptureWriter, CaptureIn, CaptureOut
+    from transport import MemoryBudget, OfferSharedMemory
+    from p2p import Punch, Splice
+    from dedup import Chunker, StreamCutter, DedupEncoder, DedupDecoder, Queued, DataMessage, MessageData, MinStoreBytes
+
+StreamModes = ('TCP', 'HTTP', 'HTTPS', 'P2P')
+VhostModes = ('HTTP', 'HTTPS')
+
+def ParsePorts(value):
+    """Ports named by a range or list, None for a single port; raises ValueError if malformed."""
+    if isinstance(value, list):
+        return [int(port) for port in value]
+    if isinstance(value, str) and '-' in value:
+        first, last = (int(port) for port in value.split('-', 1))
+        if first > last:
+            raise ValueError(f"range {value} is reversed")
+        return list(range(first, last + 1))
+    return None
+
+def ExpandForwards(forwards):
+    """Turn entries with port ranges or lists ("6000-6099", [6000, 6005]) into one entry per port."""
+    expanded = []
+    for forward in forwards or []:
+        try:
+            targets = ParsePorts(forward.get('target_port'))
+            forwardPorts = ParsePorts(forward.get('forward_port'))
+        except ValueError as e:
+            print(f"Invalid port range in {forward.get('forward_port')} -> {forward.get('target_port')} ({e}), skipping")
+            continue
+        if targets is None:
+            expanded.append(forward)
+            continue
+        if forwardPorts is not None and len(forwardPorts) != len(targets):
+            print(f"Port range {forward.get('forward_port')} does not match {forward.get('target_port')}, skipping")
+            continue
+        for index, port in enumerate(targets):
+            entry = dict(forward, target_port=port)
+            if forwardPorts is not None:
+                entry['forward_port'] = forwardPorts[index]
+            expanded.append(entry)
+    return expanded
+
+class Backend:
+    def __init__(self, Domain, Port, UnixPath=None):
+        self.Domain = Domain
+        self.Port = Port
+        self.UnixPath = UnixPath
+        self.Healthy = True
+        self.HealthStreak = 0
+        self.Failures = 0
+        self.EjectedUntil = 0
+        self.EjectTime = 0
+        self.Probing = False
+        self.Active = 0
+
+    def __str__(self):
+        if self.UnixPath:
+            return f"unix:{self.UnixPath}"
+        return f"{self.Domain}:{self.Port}"
+
+    def Open(self, timeout):
+        if self.UnixPath:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.UnixPath
+        else:
+            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.Domain, self.Port)
+        conn.settimeout(timeout)
+        try:
+            conn.connect(address)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+class BackendPool:
+    Policies = ('ROUND_ROBIN', 'LEAST_CONNECTIONS', 'RANDOM')
+
+    def __init__(self, Config):
+        backends = Config.get('backends') or [Config]
+        self.Backends = [Backend(b.get('forward_domain', '127.0.0.1'), b.get('forward_port'), b.get('forward_unix_path'))
+                         for b in backends]
+        self.Policy = str(Config.get('backend_balance', 'round_robin')).upper()
+        self.ConnectTimeout = Config.get('connect_timeout', 5)
+        self.MaxFailures = Config.get('max_failures', 3)
+        self.EjectTime = Config.get('eject_time', 10)
+        self.MaxEjectTime = Config.get('max_eject_time', 300)
+        self.HealthCheck = Config.get('health_check')
+        self.Next = 0
+        self.Running = True
+        self.Lock = threading.Lock()
+        if self.HealthCheck:
+            threading.Thread(target=self.RunHealthChecks, daemon=True).start()
+
+    def Stop(self):
+        self.Running = False
+
+    def IsAvailable(self, backend, now):
+        if not backend.Healthy:
+            return False
+        if backend.EjectedUntil > now:
+            return False
+        # Circuit half-open: let a single probe connection through after the ejection expires
+        if backend.EjectedUntil and backend.Probing:
+            return False
+        return True
+
+    def Candidates(self):
+        now = time.monotonic()
+        with self.Lock:
+            candidates = [backend for backend in self.Backends if self.IsAvailable(backend, now)]
+            if not candidates:
+                return []
+            if self.Policy == 'LEAST_CONNECTIONS':
+                candidates.sort(key=lambda backend: backend.Active)
+            elif self.Policy == 'RANDOM':
+                random.shuffle(candidates)
+            else:
+                start = self.Next % len(candidates)
+                self.Next += 1
+                candidates = candidates[start:] + candidates[:start]
+            return candidates
+
+    def BeginAttempt(self, backend):
+        with self.Lock:
+            if backend.EjectedUntil:
+                if backend.Probing:
+                    return False
+                backend.Probing = True
+            return True
+
+    def Connect(self):
+        for backend in self.Candidates():
+            if not self.BeginAttempt(backend):
+                continue
+            try:
+                conn = backend.Open(self.ConnectTimeout)
+            except Exception as e:
+                self.ReportFailure(backend, e)
+                continue
+            self.ReportSuccess(backend)
+            return conn, backend
+        return None, None
+
+    def ReportSuccess(self, backend):
+        with self.Lock:
+            backend.Failures = 0
+            backend.Probing = False
+            if backend.EjectedUntil:
+                print(f"Backend {backend} recovered")
+            backend.EjectedUntil = 0
+            backend.EjectTime = 0
+            backend.Active += 1
+
+    def ReportFailure(self, backend, error):
+        with self.Lock:
+            backend.Failures += 1
+            backend.Probing = False
+            if backend.EjectedUntil or backend.Failures >= self.MaxFailures:
+                backend.EjectTime = min(self.MaxEjectTime, backend.EjectTime * 2 or self.EjectTime)
+                backend.EjectedUntil = time.monotonic() + backend.EjectTime
+                print(f"Backend {backend} ejected for {backend.EjectTime}s: {error}")
+
+    def Release(self, backend):
+        with self.Lock:
+            if backend.Active > 0:
+                backend.Active -= 1
+
+    def RunHealthChecks(self):
+        interval = self.HealthCheck.get('interval', 5)
+        timeout = self.HealthCheck.get('timeout', 1)
+        rise = self.HealthCheck.get('rise', 2)
+        fall = self.HealthCheck.get('fall', 3)
+        while self.Running:
+            for backend in self.Backends:
+                try:
+                    backend.Open(timeout).close()
+                    passed = True
+                except OSError:
+                    passed = False
+                with self.Lock:
+                    if passed != backend.Healthy:
+                        backend.HealthStreak += 1
+                        if backend.HealthStreak >= (rise if passed else fall):
+                            backend.Healthy = passed
+                            backend.HealthStreak = 0
+                            if passed:
+                                backend.Failures = 0
+                                backend.EjectedUntil = 0
+                                backend.EjectTime = 0
+                            print(f"Backend {backend} is {'up' if passed else 'down'}")
+                    else:
+                        backend.HealthStreak = 0
+            time.sleep(interval)
 
 class PortForwardClient:
-    def __init__(self, ServerDomain="127.0.0.1", ServerPort=5000, Forwards=None, Key="07A36AEF1907843"):
+    def __init__(self, ServerDomain="127.0.0.1", ServerPort=5000, Forwards=None, Key="07A36AEF1907843", MemoryServer=None, Capture=None,
+                 MemoryLimit=0, MaxMessageSize=1048576, Visitors=None, UdpFactory=None, SharedMemory=0, Dedup=None):
         self.ServerDomain = ServerDomain
         self.ServerPort = ServerPort
-        self.Forwards = Forwards or []
+        # "unix:/path" reaches a server on the same host over its Unix socket
+        self.UnixPath = ServerDomain[5:] if ServerDomain.startswith('unix:') else None
+        self.RendezvousHost = '127.0.0.1' if self.UnixPath else ServerDomain
+        self.SharedMemory = SharedMemory
+        Dedup = Dedup or {}
+        self.DedupBytes = int(Dedup.get('max_bytes', 67108864))
+        self.Chunker = Chunker(int(Dedup.get('min_chunk', 2048)), int(Dedup.get('avg_chunk', 8192)), int(Dedup.get('max_chunk', 65536)))
+        self.DedupReadSize = 65536
+        self.Encoder = None
+        self.Decoder = None
+        self.Forwards = ExpandForwards(Forwards)
         self.Key = Key
+        self.MemoryServer = MemoryServer
+        self.Capture = CaptureWriter(Capture, 'client') if Capture else None
+        self.TunnelSerial = 0
+        self.Memory = MemoryBudget(MemoryLimit)
+        self.SendMemory = MemoryBudget(MemoryLimit)
+        # The dedup store is reserved whole at login, outside the budget the tunnel reader waits on
+        self.StoreMemory = MemoryBudget(MemoryLimit // 2)
+        self.StoreReserved = 0
+        self.MaxMessageSize = MaxMessageSize
+        self.Visitors = list(Visitors or [])
+        self.VisitorSockets = []
+        self.PendingVisits = {}
+        self.VisitRefs = itertools.count(1)
+        self.UdpFactory = UdpFactory or (lambda: socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        self.Stats = defaultdict(int)
+        self.Traces = {}
+        self.ServerFeatures = frozenset()
+        self.BatchSize = 256
         self.ServerSocket = None
         self.Running = True
+        self.Stopped = False
+        self.StopLock = threading.Lock()
         self.ForwardMap = {}
         self.ConnectionMap = {}
+        self.PendingStreams = {}
+        self.PendingForwards = {}
         self.Lock = threading.Lock()
+        self.SendLock = threading.Lock()
         self.Buffer = b''
         self.MessageSeparator = b'|||'
 
+    def OpenTunnel(self):
+        if self.MemoryServer:
+            print("Connected to in-process server")
+            return self.MemoryServer.ConnectMemory()
+        if self.UnixPath:
+            tunnel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            tunnel.connect(self.UnixPath)
+            if self.SharedMemory:
+                tunnel = OfferSharedMemory(tunnel, self.SharedMemory)
+                print(f"Connected to server over shared memory via unix:{self.UnixPath}")
+            else:
+                print(f"Connected to server unix:{self.UnixPath}")
+            return tunnel
+        tunnel = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tunnel.connect((self.ServerDomain, self.ServerPort))
+        print(f"Connected to server {self.ServerDomain}:{self.ServerPort}")
+        return tunnel
+
+    def Connect(self):
+        self.ServerSocket = self.OpenTunnel()
+        self.TunnelSerial += 1
+        self.Encoder = self.Decoder = None
+        self.Authenticate()
+        threading.Thread(target=self.ReceiveFromServer, daemon=True).start()
+        self.SetupForwards()
+        self.StartVisitors()
+
     def Start(self):
         try:
-            self.ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.ServerSocket.connect((self.ServerDomain, self.ServerPort))
-            print(f"Connected to server {self.ServerDomain}:{self.ServerPort}")
-            self.Authenticate()
-            threading.Thread(target=self.ReceiveFromServer, daemon=True).start()
-            self.SetupForwards()
+            self.Connect()
             while self.Running:
                 time.sleep(5)
         except Exception as e:
@@ -35,29 +296,83 @@ class PortForwardClient:
             self.Stop()
 
     def Stop(self):
-        self.Running = False
+        with self.StopLock:
+            if self.Stopped:
+                return
+            self.Stopped = True
         with self.Lock:
-            for forwardId, forwardData in self.ForwardMap.items():
-                try:
-                    self.SendToServer({'type': 'close_forward', 'forward_id': forwardId})
-                except:
-                    pass
-                for connId, conn in forwardData['connections'].items():
-                    try:
-                        conn.close()
-                    except:
-                        pass
+            forwards = list(self.ForwardMap.items())
             self.ForwardMap.clear()
             self.ConnectionMap.clear()
+        for forwardId, forwardData in forwards:
+            if not forwardData.get('visitor'):
+                self.SendToServer({'type': 'close_forward', 'forward_id': forwardId})
+            self.CloseForwardData(forwardData)
+        self.Running = False
+        for listener in self.VisitorSockets:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            listener.close()
         if self.ServerSocket:
+            try:
+                self.ServerSocket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
             try:
                 self.ServerSocket.close()
             except:
                 pass
+        if self.Capture:
+            self.Capture.Close()
         print("Client stopped")
 
+    def GetStats(self):
+        with self.Lock:
+            connections = len(self.ConnectionMap)
+            forwards = len(self.ForwardMap)
+            stats = dict(self.Stats)
+        stats.update(forwards=forwards, active_connections=connections, memory=self.Memory.Snapshot(),
+                     send_memory=self.SendMemory.Snapshot())
+        if self.Encoder:
+            stats['dedup'] = {'sent': self.Encoder.Snapshot(), 'received': self.Decoder.Snapshot(),
+                              'reserved': self.StoreMemory.Snapshot()}
+        return stats
+
+    def CountStat(self, name, amount=1):
+        with self.Lock:
+            self.Stats[name] += amount
+
+    def CloseForwardData(self, forwardData):
+        if forwardData['pool']:
+            forwardData['pool'].Stop()
+        for streamId, conn in list(forwardData['connections'].items()):
+            try:
+                conn.close()
+            except:
+                pass
+
+    def __enter__(self):
+        self.Connect()
+        return self
+
+    def __exit__(self, *excInfo):
+        self.Stop()
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.Connect)
+        return self
+
+    async def __aexit__(self, *excInfo):
+        await asyncio.to_thread(self.Stop)
+
     def Authenticate(self):
-        self.SendToServer({'type': 'auth', 'key': self.Key})
+        message = {'type': 'auth', 'key': self.Key, 'features': ['new_connections', 'early_data']}
+        self.StoreReserved = self.StoreMemory.Reserve(self.DedupBytes, MinStoreBytes)
+        if self.StoreReserved:
+            message['dedup'] = {'max_bytes': self.StoreReserved}
+        self.SendToServer(message)
         response = self.ServerSocket.recv(4096)
         if not response:
             raise ConnectionError("Server closed connection during authentication")
@@ -65,24 +380,124 @@ class PortForwardClient:
         self.ProcessBuffer()
 
     def SetupForwards(self):
-        for forward in self.Forwards:
-            forwardDomain = forward.get('forward_domain', '127.0.0.1')
-            forwardPort = forward.get('forward_port')
-            targetPort = forward.get('target_port')
-            mode = forward.get('mode', 'tcp').upper()
-            if not all([forwardPort, targetPort]):
-                print("Invalid forward configuration, skipping")
-                continue
-            self.SendToServer({
-                'type': 'forward_request',
-                'forward_domain': forwardDomain,
-                'forward_port': forwardPort,
-                'target_port': targetPort,
-                'mode': mode
-            })
+        requests = [self.BuildForwardRequest(ref, forward) for ref, forward in enumerate(self.Forwards) if forward is not None]
+        self.SendForwardRequests([request for request in requests if request])
+
+    def SendForwardRequests(self, requests):
+        if len(requests) > 1 and 'forward_batch' in self.ServerFeatures:
+            for start in range(0, len(requests), self.BatchSize):
+                self.SendToServer({'type': 'forward_batch', 'requests': requests[start:start + self.BatchSize]})
+            return
+        for request in requests:
+            self.SendToServer(request)
+
+    def RequestForward(self, ref, forward):
+        request = self.BuildForwardRequest(ref, forward)
+        if not request:
+            return False
+        self.SendToServer(request)
+        return True
+
+    def BuildForwardRequest(self, ref, forward):
+        forwardDomain = forward.get('forward_domain', '127.0.0.1')
+        forwardPort = forward.get('forward_port')
+        targetPort = forward.get('target_port')
+        domains = forward.get('domains')
+        mode = forward.get('mode', 'tcp').upper()
+        if mode in VhostModes:
+            routed = domains
+        elif mode == 'P2P':
+            routed = forward.get('name')
+        else:
+            routed = targetPort is not None
+        if not all([forwardPort or forward.get('forward_unix_path') or forward.get('backends'), routed]):
+            print("Invalid forward configuration, skipping")
+            return None
+        request = {
+            'type': 'forward_request',
+            'ref': ref,
+            'forward_domain': forwardDomain,
+            'forward_port': forwardPort,
+            'mode': mode
+        }
+        if mode in VhostModes:
+            request['domains'] = domains
+            if mode == 'HTTP' and forward.get('cache'):
+                request['cache'] = True
+        elif mode == 'P2P':
+            request['name'] = forward['name']
+            request['secret'] = forward.get('secret')
+        else:
+            request['target_port'] = targetPort
+        if forward.get('group'):
+            request['group'] = forward['group']
+            request['balance'] = forward.get('balance', 'round_robin')
+        if forward.get('sticky'):
+            request['sticky'] = forward['sticky']
+        if forward.get('dedup'):
+            request['dedup'] = True
+        return request
+
+    def AddForward(self, forward, timeout=5):
+        """Returns the new forward id; a target_port range or list returns one id per port, in order."""
+        forwards = ExpandForwards([forward])
+        if not forwards:
+            raise ValueError("Invalid forward configuration")
+        forwardIds = self.AddForwards(forwards, timeout)
+        return forwardIds if ParsePorts(forward.get('target_port')) is not None else forwardIds[0]
+
+    def AddForwards(self, forwards, timeout):
+        waiters = {}
+        requests = []
+        with self.Lock:
+            for forward in forwards:
+                ref = len(self.Forwards)
+                self.Forwards.append(forward)
+                waiters[ref] = self.PendingForwards[ref] = {'event': threading.Event(), 'success': False, 'result': 'No response from server'}
+                requests.append(self.BuildForwardRequest(ref, forward))
+            if not all(requests):
+                for ref in waiters:
+                    self.PendingForwards.pop(ref, None)
+                    self.Forwards[ref] = None
+                raise ValueError("Invalid forward configuration")
+        self.SendForwardRequests(requests)
+        deadline = time.monotonic() + timeout
+        for waiter in waiters.values():
+            waiter['event'].wait(max(deadline - time.monotonic(), 0))
+        with self.Lock:
+            for ref, waiter in waiters.items():
+                self.PendingForwards.pop(ref, None)
+                # A success that arrives after this is handed back to the server on arrival
+                if not waiter['success']:
+                    self.Forwards[ref] = None
+        failed = [waiter for waiter in waiters.values() if not waiter['success']]
+        if failed:
+            # A range is added whole or not at all
+            for waiter in waiters.values():
+                if waiter['success']:
+                    self.RemoveForward(waiter['result'])
+            raise ConnectionError(f"Forward request failed: {failed[0]['result']}")
+        return [waiter['result'] for waiter in waiters.values()]
+
+    def RemoveForward(self, forwardId):
+        with self.Lock:
+            forwardData = self.ForwardMap.pop(forwardId, None)
+            if not forwardData:
+                return False
+            for streamId in forwardData['connections']:
+                self.ConnectionMap.pop(streamId, None)
+            self.Forwards[forwardData['ref']] = None
+        self.SendToServer({'type': 'close_forward', 'forward_id': forwardId})
+        self.CloseForwardData(forwardData)
+        print(f"Forward removed: {forwardId}")
+        return True
 
     def ReceiveFromServer(self):
+        maxMessage = min(self.MaxMessageSize, self.Memory.Limit or self.MaxMessageSize)
+        buffered = 0
         while self.Running and self.ServerSocket:
+            if not buffered and not self.Memory.WaitForRoom(lambda: not self.Running):
+                break
             try:
                 self.ServerSocket.settimeout(1)
                 data = self.ServerSocket.recv(4096)
@@ -91,20 +506,34 @@ class PortForwardClient:
                     self.Running = False
                     break
                 self.Buffer += data
+                buffered = self.Memory.Resize(buffered, len(self.Buffer))
                 self.ProcessBuffer()
+                buffered = self.Memory.Resize(buffered, len(self.Buffer))
+                if len(self.Buffer) >= maxMessage:
+                    print(f"Server exceeded the {maxMessage}-byte message limit")
+                    self.Running = False
+                    break
             except socket.timeout:
                 continue
             except Exception as e:
-                print(f"Server communication error: {e}")
-                traceback.print_exc()
+                if self.Running:
+                    print(f"Server communication error: {e}")
+                    traceback.print_exc()
                 self.Running = False
                 break
+        self.Memory.Release(buffered)
+        self.StoreMemory.Release(self.StoreReserved)
+        self.StoreReserved = 0
+        # Close the tunnel too, so the server sees the disconnect and frees the streams it holds
+        self.Stop()
 
     def ProcessBuffer(self):
         while self.MessageSeparator in self.Buffer:
             msgEnd = self.Buffer.index(self.MessageSeparator)
             messageData = self.Buffer[:msgEnd]
             self.Buffer = self.Buffer[msgEnd + len(self.MessageSeparator):]
+            if self.Capture:
+                self.Capture.Write(CaptureIn, self.TunnelSerial, messageData)
             try:
                 message = json.loads(messageData.decode('utf-8'))
                 self.ProcessServerMessage(message)
@@ -117,85 +546,214 @@ class PortForwardClient:
     def ProcessServerMessage(self, message):
         if message.get('type') == 'forward_response':
             self.HandleForwardResponse(message)
+        elif message.get('type') == 'forward_batch_response':
+            for response in message.get('results') or []:
+                self.HandleForwardResponse(response)
+        elif message.get('type') == 'auth_response':
+            self.ServerFeatures = frozenset(message.get('features') or ())
+            size = min(int((message.get('dedup') or {}).get('max_bytes') or 0), self.StoreReserved)
+            self.StoreMemory.Release(self.StoreReserved - size)
+            self.StoreReserved = size
+            if size > 0:
+                self.Encoder, self.Decoder = DedupEncoder(size), DedupDecoder(size)
         elif message.get('type') == 'new_connection':
             self.HandleNewConnection(message)
+        elif message.get('type') == 'new_connections':
+            for entry in message.get('streams', []):
+                self.HandleNewConnection({'forward_id': entry[0], 'stream_id': entry[1], 'trace': message.get('trace'),
+                                          'data': entry[2] if len(entry) > 2 else None})
         elif message.get('type') == 'data':
             self.HandleData(message)
         elif message.get('type') == 'close_connection':
             self.HandleCloseConnection(message)
+        elif message.get('type') == 'visit_response':
+            self.HandleVisitResponse(message)
+        elif message.get('type') == 'p2p_offer':
+            self.HandleP2POffer(message)
         elif message.get('type') == 'error':
             print(f"Server error: {message.get('message')}")
 
     def HandleForwardResponse(self, message):
+        ref = message.get('ref')
+        with self.Lock:
+            waiter = self.PendingForwards.get(ref)
         if message.get('success'):
             forwardId = message.get('forward_id')
             targetPort = message.get('target_port')
-            forwardConfig = next((f for f in self.Forwards if f.get('target_port') == targetPort), None)
-            if forwardConfig and forwardId:
-                with self.Lock:
+            domains = message.get('domains')
+            forwardConfig = self.Forwards[ref] if isinstance(ref, int) and 0 <= ref < len(self.Forwards) else None
+            pool = BackendPool(forwardConfig) if forwardConfig and forwardId else None
+            with self.Lock:
+                # AddForward may have given up on this ref while the pool was being set up
+                registered = pool is not None and self.Forwards[ref] is forwardConfig
+                if registered:
                     self.ForwardMap[forwardId] = {
                         'config': forwardConfig,
-                        'connections': {}
+                        'connections': {},
+                        'pool': pool,
+                        'target_port': targetPort,
+                        'ref': ref
                     }
-                print(f"Forward established: {forwardId}")
+                    if waiter:
+                        waiter['success'], waiter['result'] = True, forwardId
+            if registered:
+                if domains:
+                    print(f"Forward established: {forwardId} for {', '.join(domains)}")
+                elif message.get('name'):
+                    print(f"Forward established: {forwardId} as P2P service {message['name']}")
+                else:
+                    print(f"Forward established: {forwardId} on port {targetPort}")
             else:
-                print(f"Received forward response for unknown target port {targetPort}")
+                print(f"Received forward response for unknown target {domains or message.get('name') or targetPort}")
+                if pool:
+                    pool.Stop()
+                if forwardId:
+                    # The server did create it; nothing here will use it, so give it back
+                    self.SendToServer({'type': 'close_forward', 'forward_id': forwardId})
         else:
             print(f"Forward request failed: {message.get('message')}")
+            if waiter:
+                waiter['result'] = message.get('message')
+        if waiter:
+            waiter['event'].set()
 
     def HandleNewConnection(self, message):
         forwardId = message.get('forward_id')
-        connId = message.get('conn_id')
-        if not all([forwardId, connId]):
+        streamId = message.get('stream_id')
+        if not all([forwardId, streamId]):
             return
         with self.Lock:
-            if forwardId not in self.ForwardMap:
-                print(f"Received connection for unknown forward {forwardId}")
-                return
-            forwardData = self.ForwardMap[forwardId]
-            config = forwardData['config']
+            forwardData = self.ForwardMap.get(forwardId)
+            supported = forwardData and forwardData['config'].get('mode', 'tcp').upper() in StreamModes
+            if supported:
+                # Data can arrive (even with the announcement) before the target is connected;
+                # it waits here and is flushed in order once the socket is ready
+                self.ConnectionMap[streamId] = forwardId
+                self.PendingStreams[streamId] = []
+        if not supported:
+            print(f"Received connection for {'unsupported' if forwardData else 'unknown'} forward {forwardId}")
+            # Without a reply the server would keep the visitor open
+            self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
+            return
+        if message.get('trace'):
+            self.Traces[streamId] = {'received': time.monotonic()}
+        if message.get('data'):
+            self.BufferEarlyData(streamId, bytes.fromhex(message['data']))
+        # Connect off the tunnel reader so a slow target does not hold up every other stream
+        threading.Thread(target=self.OpenTarget, args=(forwardId, streamId, forwardData), daemon=True).start()
+
+    def BufferEarlyData(self, streamId, data):
+        with self.Lock:
+            pending = self.PendingStreams.get(streamId)
+            if pending is None:
+                return False
+            pending.append(data)
+        self.Memory.Charge(len(data))
+        self.CountStat('early_data_bytes', len(data))
+        return True
+
+    def DropPending(self, streamId):
+        with self.Lock:
+            pending = self.PendingStreams.pop(streamId, None) or []
+        self.Memory.Release(sum(len(chunk) for chunk in pending if chunk))
+
+    def OpenTarget(self, forwardId, streamId, forwardData):
         try:
-            if config.get('mode', 'tcp').upper() == 'TCP':
-                conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                conn.connect((config['forward_domain'], config['forward_port']))
-                with self.Lock:
-                    forwardData['connections'][connId] = conn
-                    self.ConnectionMap[connId] = forwardId
-                threading.Thread(target=self.ForwardToServer, args=(forwardId, connId, conn), daemon=True).start()
-                print(f"Established connection {connId} for forward {forwardId}")
-            else:
-                print(f"Unsupported mode for forward {forwardId}")
+            conn, backend = forwardData['pool'].Connect()
+            if not conn:
+                raise ConnectionError("No backend available")
+            conn.settimeout(None)
         except Exception as e:
             print(f"Error establishing connection for {forwardId}: {e}")
-            traceback.print_exc()
-            self.SendToServer({
-                'type': 'close_connection',
-                'forward_id': forwardId,
-                'conn_id': connId
-            })
+            if not isinstance(e, ConnectionError):
+                traceback.print_exc()
+            self.DropPending(streamId)
+            with self.Lock:
+                closedHere = self.ConnectionMap.pop(streamId, None) is not None
+            if closedHere:
+                self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
+            self.FinishTrace(streamId, 'connect_failed')
+            return
+        self.MarkTrace(streamId, 'connected')
+        closing = False
+        while not closing:
+            with self.Lock:
+                pending = self.PendingStreams.get(streamId)
+                if self.ConnectionMap.get(streamId) != forwardId or pending is None:
+                    closing = True
+                    break
+                if not pending:
+                    # Hand the stream over: from here on HandleData writes to the socket directly
+                    del self.PendingStreams[streamId]
+                    forwardData['connections'][streamId] = conn
+                    break
+                self.PendingStreams[streamId] = []
+            for chunk in pending:
+                if chunk is None:
+                    closing = True
+                    continue
+                if not closing:
+                    try:
+                        conn.sendall(chunk)
+                        self.MarkTrace(streamId, 'first_request_byte')
+                    except OSError as e:
+                        print(f"Error sending early data for {streamId}: {e}")
+                        closing = True
+                self.Memory.Release(len(chunk))
+        if closing:
+            # Closed while the target was connecting: whatever the server sent before its
+            # close has been delivered above
+            self.DropPending(streamId)
+            with self.Lock:
+                closedHere = self.ConnectionMap.pop(streamId, None) is not None
+            if closedHere:
+                self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
+            forwardData['pool'].Release(backend)
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            conn.close()
+            self.FinishTrace(streamId, 'close')
+            print(f"Connection {streamId} for forward {forwardId} closed before it was established")
+            return
+        threading.Thread(target=self.ForwardToServer, args=(forwardId, streamId, conn, backend), daemon=True).start()
+        print(f"Established connection {streamId} for forward {forwardId} to {backend}")
 
-    def ForwardToServer(self, forwardId, connId, conn):
+    def ForwardToServer(self, forwardId, streamId, conn, backend):
+        stopping = lambda: not self.Running or streamId not in self.ConnectionMap
+        with self.Lock:
+            forwardData = self.ForwardMap.get(forwardId)
+        cutter = StreamCutter(self.Chunker) if self.Encoder and forwardData and forwardData['config'].get('dedup') else None
+        readSize = self.DedupReadSize if cutter else 4096
         try:
+            conn.settimeout(1)
             while self.Running:
-                conn.settimeout(1)
+                if not self.SendMemory.WaitForRoom(stopping):
+                    break
                 try:
-                    with self.Lock:
-                        if connId not in self.ConnectionMap or self.ConnectionMap[connId] != forwardId:
-                            break
-                    data = conn.recv(4096)
+                    data = conn.recv(readSize)
                     if not data:
+                        if cutter:
+                            self.SendChunks(streamId, cutter.Flush())
                         break
-                    self.SendToServer({
-                        'type': 'data',
-                        'forward_id': forwardId,
-                        'conn_id': connId,
-                        'data': data.hex()
-                    })
+                    self.MarkTrace(streamId, 'first_response_byte')
+                    self.SendMemory.Charge(len(data))
+                    try:
+                        if cutter:
+                            self.SendChunks(streamId, cutter.Feed(data, Queued(conn)))
+                        else:
+                            self.SendToServer({'type': 'data', 'stream_id': streamId, 'data': data.hex()})
+                    finally:
+                        self.SendMemory.Release(len(data))
                 except socket.timeout:
+                    if streamId not in self.ConnectionMap:
+                        break
                     continue
                 except Exception as e:
-                    print(f"Forward to server error: {e}")
-                    traceback.print_exc()
+                    if streamId in self.ConnectionMap:
+                        print(f"Forward to server error: {e}")
+                        traceback.print_exc()
                     break
         finally:
             try:
@@ -203,60 +761,191 @@ class PortForwardClient:
             except:
                 pass
             with self.Lock:
-                if forwardId in self.ForwardMap and connId in self.ForwardMap[forwardId]['connections']:
-                    del self.ForwardMap[forwardId]['connections'][connId]
-                if connId in self.ConnectionMap:
-                    del self.ConnectionMap[connId]
-            self.SendToServer({
-                'type': 'close_connection',
-                'forward_id': forwardId,
-                'conn_id': connId
-            })
-            print(f"Closed connection {connId} for forward {forwardId}")
+                forwardData = self.ForwardMap.get(forwardId)
+                if forwardData:
+                    # Visitor streams have no pool but are tracked in connections all the same
+                    if forwardData['pool']:
+                        forwardData['pool'].Release(backend)
+                    forwardData['connections'].pop(streamId, None)
+                closedHere = self.ConnectionMap.pop(streamId, None) is not None
+            if closedHere:
+                self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
+            self.FinishTrace(streamId, 'close')
+            print(f"Closed connection {streamId} for forward {forwardId}")
+
+    def SendChunks(self, streamId, chunks):
+        if chunks:
+            self.SendToServer(*DataMessage(streamId, chunks))
+
+    def DropUndecodable(self, streamId):
+        print(f"Server referenced an unknown chunk on connection {streamId}")
+        self.HandleCloseConnection({'stream_id': streamId})
+        self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
 
     def HandleData(self, message):
-        forwardId = message.get('forward_id')
-        connId = message.get('conn_id')
-        dataHex = message.get('data')
-        if not all([forwardId, connId, dataHex]):
-            return
+        streamId = message.get('stream_id')
         try:
-            data = bytes.fromhex(dataHex)
+            data = MessageData(message, self.Decoder)
+            if data is None:
+                self.DropUndecodable(streamId)
+                return
+            if not streamId or not data:
+                return
+            if self.BufferEarlyData(streamId, data):
+                return
             with self.Lock:
-                if forwardId not in self.ForwardMap or connId not in self.ForwardMap[forwardId]['connections']:
-                    print(f"Received data for unknown connection {connId}")
-                    return
-                conn = self.ForwardMap[forwardId]['connections'][connId]
+                forwardData = self.ForwardMap.get(self.ConnectionMap.get(streamId))
+                conn = forwardData and forwardData['connections'].get(streamId)
+            if not conn:
+                print(f"Received data for unknown connection {streamId}")
+                return
             conn.sendall(data)
+            self.MarkTrace(streamId, 'first_request_byte')
         except Exception as e:
             print(f"Data handling error: {e}")
             traceback.print_exc()
-            self.SendToServer({
-                'type': 'close_connection',
-                'forward_id': forwardId,
-                'conn_id': connId
-            })
+            self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
 
     def HandleCloseConnection(self, message):
+        streamId = message.get('stream_id')
+        with self.Lock:
+            pending = self.PendingStreams.get(streamId)
+            if pending is not None:
+                # Still connecting: close once the buffered data has been flushed
+                pending.append(None)
+                return
+            forwardId = self.ConnectionMap.pop(streamId, None)
+            forwardData = self.ForwardMap.get(forwardId)
+            conn = forwardData and forwardData['connections'].pop(streamId, None)
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+        print(f"Connection {streamId} for forward {forwardId} closed by server")
+
+    def MarkTrace(self, streamId, event):
+        trace = self.Traces.get(streamId)
+        if trace is not None:
+            trace.setdefault(event, time.monotonic())
+
+    def FinishTrace(self, streamId, event):
+        # Report this side's lifecycle in milliseconds since new_connection arrived
+        trace = self.Traces.pop(streamId, None)
+        if trace is None:
+            return
+        trace[event] = time.monotonic()
+        start = trace['received']
+        self.SendToServer({'type': 'trace', 'stream_id': streamId,
+                           'events': {name: round((when - start) * 1000, 2) for name, when in trace.items()}})
+
+    def StartVisitors(self):
+        for visitor in self.Visitors:
+            key = f"visitor:{visitor['name']}"
+            bindAddr = visitor.get('bind_addr', '127.0.0.1')
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((bindAddr, visitor['bind_port']))
+            listener.listen(128)
+            self.VisitorSockets.append(listener)
+            with self.Lock:
+                self.ForwardMap[key] = {'config': visitor, 'connections': {}, 'pool': None, 'target_port': None, 'ref': None, 'visitor': True}
+            threading.Thread(target=self.AcceptVisitors, args=(key, visitor, listener), daemon=True).start()
+            print(f"Visitor for P2P service {visitor['name']} listening on {bindAddr}:{visitor['bind_port']}")
+
+    def AcceptVisitors(self, key, visitor, listener):
+        while self.Running:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.Visit, args=(key, visitor, conn), daemon=True).start()
+
+    def Visit(self, key, visitor, conn):
+        name = visitor['name']
+        if visitor.get('direct', True):
+            offer = self.RequestVisit(visitor, True)
+            if offer and offer.get('mode') == 'direct':
+                rendezvous = (self.RendezvousHost, offer['rendezvous_port'])
+                channel = Punch(self.UdpFactory(), rendezvous, offer['session'], offer['token'], 'visitor', visitor.get('punch_timeout', 3))
+                if channel:
+                    print(f"Direct P2P connection to {name} via {channel.Peer[0]}:{channel.Peer[1]}")
+                    self.CountStat('p2p_direct')
+                    Splice(conn, channel)
+                    return
+                print(f"Hole punching to {name} failed, relaying through the server")
+                self.CountStat('p2p_punch_failed')
+        response = self.RequestVisit(visitor, False, key, conn)
+        if not response or not response.get('success'):
+            conn.close()
+            return
+        self.CountStat('p2p_relayed')
+        self.ForwardToServer(key, response['stream_id'], conn, None)
+
+    def RequestVisit(self, visitor, direct, key=None, conn=None, timeout=5):
+        waiter = {'event': threading.Event(), 'response': None, 'key': key, 'conn': conn}
+        with self.Lock:
+            ref = next(self.VisitRefs)
+            self.PendingVisits[ref] = waiter
+        self.SendToServer({'type': 'visit', 'ref': ref, 'name': visitor['name'], 'secret': visitor.get('secret'), 'direct': direct})
+        waiter['event'].wait(timeout)
+        with self.Lock:
+            self.PendingVisits.pop(ref, None)
+        return waiter['response']
+
+    def HandleVisitResponse(self, message):
+        streamId = message.get('stream_id')
+        with self.Lock:
+            waiter = self.PendingVisits.pop(message.get('ref'), None)
+            # Register a relayed stream before any of its data can be processed
+            forwardData = waiter and streamId and self.ForwardMap.get(waiter['key'])
+            if forwardData:
+                forwardData['connections'][streamId] = waiter['conn']
+                self.ConnectionMap[streamId] = waiter['key']
+        if not waiter:
+            if streamId:
+                self.SendToServer({'type': 'close_connection', 'stream_id': streamId})
+            return
+        if not message.get('success'):
+            print(f"Visit failed: {message.get('message')}")
+        waiter['response'] = message
+        waiter['event'].set()
+
+    def HandleP2POffer(self, message):
         forwardId = message.get('forward_id')
-        connId = message.get('conn_id')
         with self.Lock:
-            if forwardId in self.ForwardMap and connId in self.ForwardMap[forwardId]['connections']:
-                try:
-                    self.ForwardMap[forwardId]['connections'][connId].close()
-                except:
-                    pass
-                del self.ForwardMap[forwardId]['connections'][connId]
-            if connId in self.ConnectionMap:
-                del self.ConnectionMap[connId]
-        print(f"Connection {connId} for forward {forwardId} closed by server")
-
-    def SendToServer(self, message):
+            forwardData = self.ForwardMap.get(forwardId)
+        if forwardData:
+            threading.Thread(target=self.AnswerP2POffer, args=(forwardId, forwardData, message), daemon=True).start()
+
+    def AnswerP2POffer(self, forwardId, forwardData, offer):
+        rendezvous = (self.RendezvousHost, offer['rendezvous_port'])
+        channel = Punch(self.UdpFactory(), rendezvous, offer['session'], offer['token'], 'service', forwardData['config'].get('punch_timeout', 3))
+        if not channel:
+            print(f"Hole punching for {forwardId} failed")
+            return
+        pool = forwardData['pool']
+        conn, backend = pool.Connect()
+        if not conn:
+            channel.close()
+            return
+        conn.settimeout(None)
+        print(f"Direct P2P connection for {forwardId} to {backend}")
+        self.CountStat('p2p_direct')
+        Splice(channel, conn, lambda: pool.Release(backend))
+
+    def SendToServer(self, message, chunks=None):
         if not self.ServerSocket or not self.Running:
             return
         try:
-            data = json.dumps(message).encode('utf-8') + self.MessageSeparator
-            self.ServerSocket.sendall(data)
+            if chunks is None:
+                frame = json.dumps(message).encode('utf-8')
+            with self.SendLock:
+                if chunks is not None:
+                    frame = self.Encoder.Frame(message, chunks)
+                if self.Capture:
+                    self.Capture.Write(CaptureOut, self.TunnelSerial, frame)
+                self.ServerSocket.sendall(frame + self.MessageSeparator)
         except Exception as e:
             print(f"Error sending to server: {e}")
             traceback.print_exc()
@@ -274,7 +963,13 @@ def main():
                 "target_port": 5002,
                 "mode": "TCP"
             }
-        ]
+        ],
+        "Capture": None,
+        "MemoryLimit": 0,
+        "MaxMessageSize": 1048576,
+        "Visitors": [],
+        "SharedMemory": 0,
+        "Dedup": {}
     }
     if len(sys.argv) > 1:
         try:
@@ -287,7 +982,13 @@ def main():
         ServerDomain=config["ServerDomain"],
         ServerPort=int(config["ServerPort"]),
         Forwards=config["Forwards"],
-        Key=config["Key"]
+        Key=config["Key"],
+        Capture=config["Capture"],
+        MemoryLimit=int(config["MemoryLimit"]),
+        MaxMessageSize=int(config["MaxMessageSize"]),
+        Visitors=config["Visitors"],
+        SharedMemory=int(config["SharedMemory"]),
+        Dedup=config["Dedup"]
     )
     client.Start()
 
@@ -0,0 +1,453 @@
+import queue
+import socket
+import threading
+import itertools
+import traceback
+import json
+import time
+
+Separator = b'|||'
+# The hello comes before the key is checked, so it gets a small allowance and a deadline.
+# After it, frames hold 64 KiB of hex-encoded stream data or a state sync.
+MaxHello = 16384
+MaxFrame = 1048576
+
+class RemoteForward:
+    """A vhost forward whose client tunnel lives on another node."""
+    __slots__ = ('Node', 'Id', 'Mode', 'Domains')
+
+    def __init__(self, Node, Id, Mode, Domains):
+        self.Node = Node
+        self.Id = Id
+        self.Mode = Mode
+        self.Domains = Domains
+
+def ReadFrame(sock, buffer, timeout=5):
+    deadline = time.monotonic() + timeout
+    while Separator not in buffer:
+        if len(buffer) > MaxHello:
+            raise ValueError('Handshake frame too large')
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('Handshake timed out')
+        sock.settimeout(remaining)
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError('Node closed the link during handshake')
+        buffer += data
+    end = buffer.index(Separator)
+    return json.loads(bytes(buffer[:end]).decode('utf-8')), buffer[end + len(Separator):]
+
+class NodeLink:
+    """One connection between two cluster nodes, multiplexing announcements and relayed streams."""
+
+    def __init__(self, Node, Socket, PeerId, Dialer, Buffer=b''):
+        self.Node = Node
+        self.Socket = Socket
+        self.PeerId = PeerId
+        self.Buffer = bytearray(Buffer)
+        # Each side numbers the streams it opens with its own parity so ids never collide
+        self.StreamIds = itertools.count(1 if Dialer else 2, 2)
+        self.Streams = {}
+        self.Lock = threading.Lock()
+        self.SendLock = threading.Lock()
+        self.Closed = False
+        self.Outbox = queue.SimpleQueue()
+        threading.Thread(target=self.Write, daemon=True).start()
+
+    def Send(self, message):
+        frame = json.dumps(message).encode('utf-8') + Separator
+        with self.SendLock:
+            self.Socket.sendall(frame)
+
+    def Queue(self, message):
+        """Sends a control message from the link's own writer, so the caller never blocks on a slow peer."""
+        self.Outbox.put(message)
+
+    def Write(self):
+        while True:
+            message = self.Outbox.get()
+            if message is None:
+                break
+            try:
+                self.Send(message)
+            except OSError:
+                break
+
+    def OpenStream(self, sock, target, peer, initialData=b''):
+        with self.Lock:
+            streamId = next(self.StreamIds)
+            self.Streams[streamId] = sock
+        message = dict(target, type='stream_open', stream=streamId, peer=[peer[0], peer[1]])
+        if initialData:
+            message['data'] = initialData.hex()
+        try:
+            self.Send(message)
+        except OSError:
+            self.DropStream(streamId)
+            return
+        self.Node.CountStat('relayed_out')
+        threading.Thread(target=self.Pump, args=(streamId, sock), daemon=True).start()
+
+    def DropStream(self, streamId):
+        with self.Lock:
+            sock = self.Streams.pop(streamId, None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def Pump(self, streamId, sock):
+        try:
+            sock.settimeout(None)
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                self.Send({'type': 'data', 'stream': streamId, 'data': data.hex()})
+        except OSError:
+            pass
+        finally:
+            with self.Lock:
+                ours = self.Streams.pop(streamId, None) is not None
+            if ours and not self.Closed:
+                try:
+                    self.Send({'type': 'close', 'stream': streamId})
+                except OSError:
+                    pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def Run(self):
+        try:
+            self.Socket.settimeout(None)
+            while True:
+                while Separator in self.Buffer:
+                    end = self.Buffer.index(Separator)
+                    frame = bytes(self.Buffer[:end])
+                    del self.Buffer[:end + len(Separator)]
+                    try:
+                        self.Dispatch(json.loads(frame.decode('utf-8')))
+                    except ValueError:
+                        print(f"Invalid frame from node {self.PeerId}")
+                if len(self.Buffer) > MaxFrame:
+                    print(f"Frame from node {self.PeerId} exceeds {MaxFrame} bytes, closing the link")
+                    break
+                data = self.Socket.recv(65536)
+                if not data:
+                    break
+                self.Buffer += data
+        except OSError as e:
+            if not self.Closed:
+                print(f"Link to node {self.PeerId} failed: {e}")
+        finally:
+            self.Close()
+            self.Node.LinkClosed(self)
+
+    def Dispatch(self, message):
+        kind = message.get('type')
+        if kind == 'data':
+            with self.Lock:
+                sock = self.Streams.get(message.get('stream'))
+            if sock:
+                try:
+                    sock.sendall(bytes.fromhex(message.get('data', '')))
+                except OSError:
+                    self.DropStream(message.get('stream'))
+        elif kind == 'close':
+            self.DropStream(message.get('stream'))
+        elif kind == 'stream_open':
+            self.AcceptStream(message)
+        elif kind in ('sync', 'announce', 'withdraw'):
+            self.Node.Apply(self.PeerId, message)
+
+    def AcceptStream(self, message):
+        streamId = message.get('stream')
+        sock = self.Node.Server.OpenRelayedStream(message, tuple(message.get('peer') or ('cluster', 0)))
+        if not sock:
+            self.Send({'type': 'close', 'stream': streamId})
+            return
+        self.Node.CountStat('relayed_in')
+        with self.Lock:
+            self.Streams[streamId] = sock
+        threading.Thread(target=self.Pump, args=(streamId, sock), daemon=True).start()
+
+    def Close(self):
+        self.Closed = True
+        self.Outbox.put(None)
+        try:
+            self.Socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.Socket.close()
+        except OSError:
+            pass
+        with self.Lock:
+            streamIds = list(self.Streams)
+        for streamId in streamIds:
+            self.DropStream(streamId)
+
+class ClusterNode:
+    """Shares a server's public ports and vhost domains with its peer nodes.
+
+    Nodes form a full mesh: the node with the lower id dials. Each node exposes
+    the ports and domains its peers announce, and relays public connections
+    for them over the link to the node holding the client tunnel.
+    """
+
+    def __init__(self, Server, NodeId, Port, Peers=None, RetryInterval=1):
+        self.Server = Server
+        self.NodeId = str(NodeId)
+        self.Port = Port
+        self.Peers = {str(node): address for node, address in (Peers or {}).items()}
+        self.RetryInterval = RetryInterval
+        self.Links = {}
+        self.RemotePorts = {}
+        self.RemoteVhosts = {}
+        self.Stats = {'relayed_in': 0, 'relayed_out': 0, 'conflicts': 0}
+        self.Lock = threading.RLock()
+        # Bumped by every broadcast, so Register can tell whether its snapshot went stale
+        self.Generation = 0
+        self.Listener = None
+
+    def CountStat(self, name, amount=1):
+        with self.Lock:
+            self.Stats[name] += amount
+
+    def Start(self):
+        self.Listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.Listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.Listener.bind((self.Server.BindAddress, self.Port))
+        self.Listener.listen(64)
+        threading.Thread(target=self.AcceptNodes, daemon=True).start()
+        for node, address in self.Peers.items():
+            if node > self.NodeId:
+                threading.Thread(target=self.Dial, args=(node, address), daemon=True).start()
+        print(f"Cluster node {self.NodeId} listening on port {self.Port}")
+
+    def Stop(self):
+        if self.Listener:
+            try:
+                self.Listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.Listener.close()
+        with self.Lock:
+            links = list(self.Links.values())
+        for link in links:
+            link.Close()
+
+    def Hello(self):
+        return {'type': 'hello', 'node': self.NodeId, 'key': self.Server.Key}
+
+    def Dial(self, node, address):
+        host, port = address.rsplit(':', 1)
+        while self.Server.Running:
+            try:
+                sock = socket.create_connection((host, int(port)), timeout=5)
+            except OSError:
+                time.sleep(self.RetryInterval)
+                continue
+            try:
+                sock.sendall(json.dumps(self.Hello()).encode('utf-8') + Separator)
+                reply, rest = ReadFrame(sock, bytearray())
+                if not reply.get('success'):
+                    print(f"Node {node} refused the link: {reply.get('message')}")
+                    sock.close()
+                    time.sleep(self.RetryInterval)
+                    continue
+                link = NodeLink(self, sock, str(reply.get('node', node)), True, rest)
+            except (OSError, ValueError) as e:
+                print(f"Handshake with node {node} failed: {e}")
+                sock.close()
+                time.sleep(self.RetryInterval)
+                continue
+            self.Register(link)
+            link.Run()
+            if self.Server.Running:
+                time.sleep(self.RetryInterval)
+
+    def AcceptNodes(self):
+        while self.Server.Running:
+            try:
+                sock, addr = self.Listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.HandleNode, args=(sock, addr), daemon=True).start()
+
+    def HandleNode(self, sock, addr):
+        try:
+            hello, rest = ReadFrame(sock, bytearray())
+            if hello.get('type') != 'hello' or hello.get('key') != self.Server.Key or not hello.get('node'):
+                sock.sendall(json.dumps({'type': 'hello', 'success': False, 'message': 'Invalid key'}).encode('utf-8') + Separator)
+                sock.close()
+                return
+            sock.sendall(json.dumps({'type': 'hello', 'success': True, 'node': self.NodeId}).encode('utf-8') + Separator)
+        except (OSError, ValueError) as e:
+            print(f"Node handshake from {addr[0]}:{addr[1]} failed: {e}")
+            sock.close()
+            return
+        link = NodeLink(self, sock, str(hello['node']), False, rest)
+        self.Register(link)
+        link.Run()
+
+    def Register(self, link):
+        # The state is read outside the cluster lock, since it takes the server's locks. If a
+        # broadcast went out meanwhile it is read again, so no announcement lands ahead of the sync.
+        while True:
+            with self.Lock:
+                generation = self.Generation
+            state = self.LocalState()
+            with self.Lock:
+                if self.Generation != generation:
+                    continue
+                previous = self.Links.get(link.PeerId)
+                self.Links[link.PeerId] = link
+                link.Queue(dict(state, type='sync'))
+                break
+        if previous:
+            previous.Close()
+        print(f"Cluster link to node {link.PeerId} established")
+
+    def LinkClosed(self, link):
+        with self.Lock:
+            if self.Links.get(link.PeerId) is not link:
+                return
+            del self.Links[link.PeerId]
+        self.Apply(link.PeerId, {'type': 'sync', 'ports': [], 'vhosts': []})
+        print(f"Cluster link to node {link.PeerId} lost")
+
+    def LocalState(self):
+        with self.Server.GroupLock:
+            ports = list(self.Server.Groups)
+        vhosts = []
+        for forward in self.Server.Registry.ListForwards():
+            if forward.Mode in self.Server.VhostRouters:
+                vhosts.append({'forward_id': forward.Id, 'mode': forward.Mode, 'domains': forward.Domains})
+        return {'ports': ports, 'vhosts': vhosts}
+
+    def Broadcast(self, message):
+        with self.Lock:
+            self.Generation += 1
+            for link in self.Links.values():
+                link.Queue(message)
+
+    def AnnouncePort(self, port):
+        self.Broadcast({'type': 'announce', 'ports': [port]})
+
+    def WithdrawPort(self, port):
+        self.Broadcast({'type': 'withdraw', 'ports': [port]})
+
+    def AnnounceVhost(self, forward):
+        self.Broadcast({'type': 'announce', 'vhosts': [{'forward_id': forward.Id, 'mode': forward.Mode, 'domains': forward.Domains}]})
+
+    def WithdrawVhost(self, forward):
+        self.Broadcast({'type': 'withdraw', 'forward_ids': [forward.Id]})
+
+    def Apply(self, node, message):
+        with self.Lock:
+            ports = self.RemotePorts.setdefault(node, {})
+            vhosts = self.RemoteVhosts.setdefault(node, {})
+            announcedPorts = message.get('ports') or []
+            announcedVhosts = {entry['forward_id']: entry for entry in message.get('vhosts') or []}
+            if message['type'] == 'sync':
+                withdrawPorts = [port for port in ports if port not in announcedPorts]
+                withdrawVhosts = [forwardId for forwardId in vhosts if forwardId not in announcedVhosts]
+            elif message['type'] == 'withdraw':
+                withdrawPorts, withdrawVhosts = announcedPorts, message.get('forward_ids') or []
+                announcedPorts, announcedVhosts = [], {}
+            else:
+                withdrawPorts, withdrawVhosts = [], []
+            for port in withdrawPorts:
+                self.UnexposePort(ports.pop(port, None), port)
+            for forwardId in withdrawVhosts:
+                remote = vhosts.pop(forwardId, None)
+                if remote:
+                    for domain in remote.Domains:
+                        self.Server.VhostRouters[remote.Mode].Remove(domain, remote)
+            for port in announcedPorts:
+                if port not in ports:
+                    listener = self.ExposePort(node, port)
+                    if listener:
+                        ports[port] = listener
+            for forwardId, entry in announcedVhosts.items():
+                if forwardId not in vhosts and entry.get('mode') in self.Server.VhostRouters:
+                    vhosts[forwardId] = self.ExposeVhost(node, entry)
+
+    def ExposePort(self, node, port):
+        # First claim wins: a port already used on this node stays local and is only reachable on its owner
+        if not self.Server.PortAllocator.Claim(port):
+            self.Stats['conflicts'] += 1
+            print(f"Port {port} from node {node} is already in use here, not exposing it")
+            return None
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.Server.BindAddress, port))
+            self.Server.ListenPublic(listener)
+        except OSError as e:
+            print(f"Cannot expose port {port} from node {node}: {e}")
+            listener.close()
+            self.Server.PortAllocator.Release(port)
+            return None
+        threading.Thread(target=self.AcceptRemote, args=(node, port, listener), daemon=True).start()
+        print(f"Exposing port {port} for node {node}")
+        return listener
+
+    def UnexposePort(self, listener, port):
+        if not listener:
+            return
+        try:
+            listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        listener.close()
+        self.Server.PortAllocator.Release(port)
+        print(f"Stopped exposing port {port}")
+
+    def ExposeVhost(self, node, entry):
+        remote = RemoteForward(node, entry['forward_id'], entry['mode'], [])
+        router = self.Server.VhostRouters[remote.Mode]
+        for domain in entry.get('domains') or []:
+            if router.Add(domain, remote):
+                remote.Domains.append(domain)
+            else:
+                self.Stats['conflicts'] += 1
+                print(f"Domain {domain} from node {node} is already in use here, not exposing it")
+        return remote
+
+    def AcceptRemote(self, node, port, listener):
+        while self.Server.Running:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                break
+            self.Relay(node, {'port': port}, conn, addr)
+
+    def Relay(self, node, target, conn, addr, initialData=b''):
+        with self.Lock:
+            link = self.Links.get(node)
+        if not link:
+            conn.close()
+            return
+        try:
+            link.OpenStream(conn, target, addr, initialData)
+        except Exception as e:
+            print(f"Relay to node {node} failed: {e}")
+            traceback.print_exc()
+            conn.close()
+
+    def Snapshot(self):
+        with self.Lock:
+            return dict(self.Stats, node=self.NodeId, links=sorted(self.Links),
+                        remote_ports={node: sorted(ports) for node, ports in self.RemotePorts.items() if ports},
+                        remote_domains={node: sorted(domain for remote in vhosts.values() for domain in remote.Domains)
+                                        for node, vhosts in self.RemoteVhosts.items() if vhosts})
@@ -0,0 +1,225 @@
+import json
+import random
+import select
+import hashlib
+from collections import OrderedDict
+
+# A reference stands in for a chunk the peer already holds; anything else in a
+# frame's "chunks" list is a hex literal
+RefPrefix = '@'
+# Smallest store worth negotiating: a handful of maximum-size chunks
+MinStoreBytes = 1048576
+
+def Digest(chunk):
+    return hashlib.blake2b(chunk, digest_size=16).hexdigest()
+
+def Queued(conn):
+    """True if more bytes are already waiting on conn (or it has reached EOF)."""
+    # select() rather than a MSG_PEEK recv: stream sockets carry a timeout, which makes recv block first
+    if conn.fileno() < 0:
+        return False
+    try:
+        return bool(select.select([conn], [], [], 0)[0])
+    except (OSError, ValueError):
+        return False
+
+def DataMessage(streamId, chunks):
+    """A data message and its (digest, chunk) pairs, hashed before the send lock is taken."""
+    return {'type': 'data', 'stream_id': streamId}, [(Digest(chunk), chunk) for chunk in chunks]
+
+def MessageData(message, decoder):
+    """The bytes a data message carries, or None if it names a chunk the decoder lacks.
+
+    Chunked frames are decoded even when their stream is already gone: the store
+    has to see every frame the peer sent.
+    """
+    if 'chunks' not in message:
+        return bytes.fromhex(message.get('data') or '')
+    return decoder.Decode(message['chunks']) if decoder else None
+
+def Summarize(codecs):
+    """Adds up codec snapshots, e.g. over every tunnel of a server."""
+    totals = dict.fromkeys(('chunks', 'hits', 'bytes', 'bytes_saved', 'store_bytes', 'evictions'), 0)
+    for codec in codecs:
+        for name, value in codec.Snapshot().items():
+            if name != 'hit_ratio':
+                totals[name] = totals.get(name, 0) + value
+    totals['hit_ratio'] = round(totals['hits'] / totals['chunks'], 4) if totals['chunks'] else 0.0
+    return totals
+
+class Chunker:
+    """Cuts stream data at content-defined boundaries.
+
+    Two fixed tables map every byte value to 0 or 1. Each position gets the XOR
+    of its own byte's bit and the previous byte's bit, and a chunk ends where
+    those bits spell out Pattern. The boundary depends only on the bytes just
+    before it, so an insertion early in a payload moves the cuts next to it and
+    leaves the rest of the chunks unchanged. Mixing in the previous byte keeps
+    text with a small alphabet close to random, and Pattern has no run longer
+    than three, so a repeated byte value (padding, indentation) never matches.
+    translate() and big-integer XOR keep the scan in C.
+    """
+
+    def __init__(self, MinChunk=2048, AvgChunk=8192, MaxChunk=65536):
+        self.MinChunk = max(MinChunk, 64)
+        self.MaxChunk = max(MaxChunk, self.MinChunk)
+        rng = random.Random(0x5EED)
+        self.Table, self.PreviousTable = (self.BitTable(rng) for _ in range(2))
+        # An n-bit pattern turns up about every 2**n bytes of random data
+        bits = min(max(max(AvgChunk - self.MinChunk, 2).bit_length() - 1, 2), 32)
+        self.Pattern = bytes((0xB2E3A5C9 >> (31 - index)) & 1 for index in range(bits))
+
+    @staticmethod
+    def BitTable(rng):
+        values = list(range(256))
+        rng.shuffle(values)
+        table = bytearray(256)
+        for value in values[:128]:
+            table[value] = 1
+        return bytes(table)
+
+    def Marks(self, data):
+        current = int.from_bytes(data.translate(self.Table), 'big')
+        previous = int.from_bytes((b'\x00' + data[:-1]).translate(self.PreviousTable), 'big')
+        return (current ^ previous).to_bytes(len(data), 'big')
+
+    def Split(self, data, final=True):
+        """Returns (chunks, rest). Without final, bytes after the last boundary are
+        returned as rest, to be prepended to the next read."""
+        marks = self.Marks(data)
+        chunks = []
+        start = 0
+        while len(data) - start > self.MinChunk:
+            found = marks.find(self.Pattern, start + self.MinChunk - len(self.Pattern), start + self.MaxChunk)
+            if found >= 0:
+                end = found + len(self.Pattern)
+            elif len(data) - start > self.MaxChunk:
+                end = start + self.MaxChunk
+            else:
+                break
+            chunks.append(data[start:end])
+            start = end
+        rest = data[start:]
+        if final and rest:
+            chunks.append(rest)
+            rest = b''
+        return chunks, rest
+
+class StreamCutter:
+    """Chunking state for one stream: holds back the tail after the last boundary
+    while more data is already queued, so a read boundary does not force a cut."""
+
+    def __init__(self, Chunker):
+        self.Chunker = Chunker
+        self.Rest = b''
+
+    def Feed(self, data, more):
+        # Split never leaves more than MaxChunk behind, so the held tail stays bounded
+        chunks, self.Rest = self.Chunker.Split(self.Rest + data, final=not more)
+        return chunks
+
+    def Flush(self):
+        rest, self.Rest = self.Rest, b''
+        return [rest] if rest else []
+
+class ChunkStore:
+    """Chunks indexed by digest and evicted least recently used first.
+
+    Both ends of a tunnel direction keep one: the receiver with the chunk bytes,
+    the sender with sizes only. They stay identical because both apply the same
+    inserts and touches in frame order.
+    """
+
+    def __init__(self, MaxBytes):
+        self.MaxBytes = MaxBytes
+        self.Entries = OrderedDict()
+        self.Size = 0
+        self.Evictions = 0
+
+    def Touch(self, digest):
+        entry = self.Entries.get(digest)
+        if entry is not None:
+            self.Entries.move_to_end(digest)
+        return entry
+
+    def Store(self, digest, size, chunk=None):
+        previous = self.Entries.pop(digest, None)
+        if previous:
+            self.Size -= previous[0]
+        self.Entries[digest] = (size, chunk)
+        self.Size += size
+        while self.Size > self.MaxBytes and self.Entries:
+            _, (evicted, _) = self.Entries.popitem(last=False)
+            self.Size -= evicted
+            self.Evictions += 1
+
+class ChunkCodec:
+    def __init__(self, MaxBytes):
+        self.Store = ChunkStore(MaxBytes)
+        self.Chunks = 0
+        self.Hits = 0
+        self.Bytes = 0
+        self.Saved = 0
+
+    def Snapshot(self):
+        return {'chunks': self.Chunks, 'hits': self.Hits, 'bytes': self.Bytes, 'bytes_saved': self.Saved,
+                'hit_ratio': round(self.Hits / self.Chunks, 4) if self.Chunks else 0.0,
+                'store_bytes': self.Store.Size, 'evictions': self.Store.Evictions}
+
+class DedupEncoder(ChunkCodec):
+    """Sending half of a tunnel direction. Encode() and Frame() must be called in
+    wire order, under the lock that serializes frames onto the tunnel, because the
+    references assume the peer applies frames in the order they were encoded."""
+
+    def Frame(self, message, chunks):
+        message['chunks'] = self.Encode(chunks)
+        return json.dumps(message).encode('utf-8')
+
+    def Encode(self, chunks):
+        entries = []
+        for digest, chunk in chunks:
+            self.Chunks += 1
+            self.Bytes += len(chunk)
+            if self.Store.Touch(digest) is not None:
+                self.Hits += 1
+                self.Saved += len(chunk)
+                entries.append(RefPrefix + digest)
+            else:
+                self.Store.Store(digest, len(chunk))
+                entries.append(chunk.hex())
+        return entries
+
+class DedupDecoder(ChunkCodec):
+    """Receiving half of a tunnel direction. Decode() must see every chunked frame
+    the peer sends, in order, including frames for streams already closed."""
+
+    def __init__(self, MaxBytes):
+        super().__init__(MaxBytes)
+        self.Misses = 0
+
+    def Decode(self, entries):
+        """Returns the stream bytes, or None if a reference names an unknown chunk."""
+        parts = []
+        missing = False
+        for entry in entries:
+            if entry.startswith(RefPrefix):
+                found = self.Store.Touch(entry[len(RefPrefix):])
+                if found is None:
+                    missing = True
+                    self.Misses += 1
+                    continue
+                chunk = found[1]
+                self.Hits += 1
+                self.Saved += len(chunk)
+            else:
+                chunk = bytes.fromhex(entry)
+                self.Store.Store(Digest(chunk), len(chunk), chunk)
+            self.Chunks += 1
+            self.Bytes += len(chunk)
+            parts.append(chunk)
+        return None if missing else b''.join(parts)
+
+    def Snapshot(self):
+        snapshot = super().Snapshot()
+        snapshot['misses'] = self.Misses
+        return snapshot
@@ -0,0 +1,479 @@
+import time
+import socket
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+# Hop-by-hop headers never stored with a cached response
+HopHeaders = frozenset(['connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'upgrade',
+                        'proxy-authenticate', 'proxy-authorization', 'age', 'x-cache'])
+CacheableStatus = frozenset([200, 203, 301, 404, 410])
+ConditionalHeaders = frozenset(['if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'])
+MaxHeadSize = 65536
+
+class HttpError(Exception):
+    pass
+
+class HttpReader:
+    def __init__(self, Sock, Data=b''):
+        self.Sock = Sock
+        self.Buffer = bytearray(Data)
+
+    def Fill(self):
+        data = self.Sock.recv(65536)
+        if not data:
+            return False
+        self.Buffer += data
+        return True
+
+    def ReadUntil(self, marker, limit):
+        while True:
+            end = self.Buffer.find(marker)
+            if end >= 0:
+                data = bytes(self.Buffer[:end + len(marker)])
+                del self.Buffer[:end + len(marker)]
+                return data
+            if len(self.Buffer) > limit:
+                raise HttpError('Header too large')
+            if not self.Fill():
+                if self.Buffer:
+                    raise HttpError('Connection closed mid-message')
+                return None
+
+    def ReadHead(self):
+        return self.ReadUntil(b'\r\n\r\n', MaxHeadSize)
+
+    def ReadLine(self):
+        line = self.ReadUntil(b'\r\n', MaxHeadSize)
+        if line is None:
+            raise HttpError('Connection closed mid-message')
+        return line
+
+    def Read(self, size):
+        if not self.Buffer and not self.Fill():
+            return b''
+        data = bytes(self.Buffer[:size])
+        del self.Buffer[:size]
+        return data
+
+    def ReadExact(self, size):
+        while len(self.Buffer) < size:
+            if not self.Fill():
+                raise HttpError('Connection closed mid-message')
+        data = bytes(self.Buffer[:size])
+        del self.Buffer[:size]
+        return data
+
+    def Take(self):
+        data = bytes(self.Buffer)
+        self.Buffer.clear()
+        return data
+
+class HttpMessage:
+    def __init__(self, head):
+        lines = head[:-4].decode('latin-1').split('\r\n')
+        self.Start = lines[0]
+        self.Headers = []
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and self.Headers:
+                name, value = self.Headers[-1]
+                self.Headers[-1] = (name, f"{value} {line.strip()}")
+                continue
+            name, sep, value = line.partition(':')
+            if not sep or not name.strip():
+                raise HttpError('Malformed header line')
+            self.Headers.append((name.strip(), value.strip()))
+
+    def Get(self, name, default=None):
+        name = name.lower()
+        for header, value in self.Headers:
+            if header.lower() == name:
+                return value
+        return default
+
+    def Tokens(self, name):
+        name = name.lower()
+        return [token.strip().lower() for header, value in self.Headers if header.lower() == name
+                for token in value.split(',') if token.strip()]
+
+    def CacheControl(self):
+        directives = {}
+        for token in self.Tokens('cache-control'):
+            key, _, value = token.partition('=')
+            directives[key.strip()] = value.strip().strip('"')
+        return directives
+
+    def Head(self, headers=None):
+        lines = [self.Start] + [f"{name}: {value}" for name, value in (self.Headers if headers is None else headers)]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+def BodyLength(message, method=None, status=None):
+    """Bytes of body that follow the head, 'chunked', or None when it runs until close."""
+    if status is not None and (method == 'HEAD' or status in (204, 304) or 100 <= status < 200):
+        return 0
+    if 'chunked' in message.Tokens('transfer-encoding'):
+        return 'chunked'
+    length = message.Get('content-length')
+    if length is not None:
+        if not length.isdigit():
+            raise HttpError('Invalid Content-Length')
+        return int(length)
+    return 0 if status is None else None
+
+def CopyBody(reader, length, write):
+    if length == 'chunked':
+        while True:
+            line = reader.ReadLine()
+            write(line)
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise HttpError('Invalid chunk size')
+            if size == 0:
+                while True:
+                    trailer = reader.ReadLine()
+                    write(trailer)
+                    if trailer == b'\r\n':
+                        return
+            write(reader.ReadExact(size + 2))
+    elif length is None:
+        while True:
+            data = reader.Read(65536)
+            if not data:
+                return
+            write(data)
+    else:
+        remaining = length
+        while remaining:
+            data = reader.Read(min(remaining, 65536))
+            if not data:
+                raise HttpError('Connection closed mid-body')
+            write(data)
+            remaining -= len(data)
+
+def HttpDate(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class CacheEntry:
+    def __init__(self, Response, Body, Request, Vary):
+        self.Start = Response.Start
+        self.Status = int(Response.Start.split(' ', 2)[1])
+        self.Headers = [(name, value) for name, value in Response.Headers if name.lower() not in HopHeaders]
+        self.Body = Body
+        self.Vary = Vary
+        self.VaryValues = tuple(Request.Get(name) for name in Vary)
+        self.Size = len(Body) + len(Response.Head()) + 256
+        self.Refresh(Response)
+
+    def Refresh(self, response):
+        if response is not None and response.Start.split(' ', 2)[1] == '304':
+            # A 304 carries updated metadata for the stored representation
+            updated = {name.lower(): (name, value) for name, value in response.Headers if name.lower() not in HopHeaders}
+            self.Headers = [updated.pop(name.lower(), (name, value)) for name, value in self.Headers
+                            if name.lower() not in ('content-length', 'transfer-encoding') or name.lower() not in updated]
+            self.Headers.extend(value for key, value in updated.items() if key not in ('content-length', 'transfer-encoding'))
+        message = HttpMessage(b'HTTP/1.1 200 OK\r\n' + ''.join(f"{name}: {value}\r\n" for name, value in self.Headers).encode('latin-1') + b'\r\n')
+        directives = message.CacheControl()
+        self.ETag = message.Get('etag')
+        self.LastModified = message.Get('last-modified')
+        self.Stored = time.monotonic()
+        age = message.Get('age', '0')
+        self.InitialAge = int(age) if age.isdigit() else 0
+        self.FreshFor = 0
+        if 'no-cache' in directives:
+            return
+        for directive in ('s-maxage', 'max-age'):
+            if directives.get(directive, '').isdigit():
+                self.FreshFor = int(directives[directive])
+                return
+        expires = HttpDate(message.Get('expires'))
+        if expires is not None:
+            date = HttpDate(message.Get('date')) or time.time()
+            self.FreshFor = max(0, int(expires - date))
+
+    def Age(self, now):
+        return self.InitialAge + int(now - self.Stored)
+
+    def Fresh(self, now):
+        return self.Age(now) < self.FreshFor
+
+    def Validators(self):
+        headers = []
+        if self.ETag:
+            headers.append(('If-None-Match', self.ETag))
+        if self.LastModified:
+            headers.append(('If-Modified-Since', self.LastModified))
+        return headers
+
+    def NotModifiedFor(self, request):
+        match = request.Get('if-none-match')
+        if match is not None:
+            return bool(self.ETag) and (match.strip() == '*' or self.ETag in [tag.strip() for tag in match.split(',')])
+        since = HttpDate(request.Get('if-modified-since'))
+        modified = HttpDate(self.LastModified)
+        return since is not None and modified is not None and modified <= since
+
+class ResponseCache:
+    def __init__(self, MaxBytes=67108864, MaxObject=1048576):
+        self.MaxBytes = MaxBytes
+        self.MaxObject = MaxObject
+        self.Entries = OrderedDict()
+        self.Size = 0
+        self.Evictions = 0
+        self.Lock = threading.Lock()
+
+    def Lookup(self, key, request):
+        with self.Lock:
+            entry = self.Entries.get(key)
+            if entry is None:
+                return None
+            self.Entries.move_to_end(key)
+        if entry.VaryValues != tuple(request.Get(name) for name in entry.Vary):
+            return None
+        return entry
+
+    def Store(self, key, entry):
+        with self.Lock:
+            previous = self.Entries.pop(key, None)
+            if previous:
+                self.Size -= previous.Size
+            self.Entries[key] = entry
+            self.Size += entry.Size
+            while self.Size > self.MaxBytes and self.Entries:
+                _, evicted = self.Entries.popitem(last=False)
+                self.Size -= evicted.Size
+                self.Evictions += 1
+
+    def Purge(self, scope):
+        with self.Lock:
+            for key in [key for key in self.Entries if key[0] == scope]:
+                self.Size -= self.Entries.pop(key).Size
+
+    def Snapshot(self):
+        with self.Lock:
+            return {'entries': len(self.Entries), 'bytes': self.Size, 'max_bytes': self.MaxBytes, 'evictions': self.Evictions}
+
+class HttpEdge:
+    """Serves one public HTTP/1.x connection, answering cacheable GETs from the cache.
+
+    OpenUpstream() must return a fresh socket-like connection to the origin;
+    Count(name, amount) receives the hit/miss counters.
+    """
+
+    def __init__(self, Cache, Conn, InitialData, OpenUpstream, Count, Scope):
+        self.Cache = Cache
+        self.Conn = Conn
+        self.Client = HttpReader(Conn, InitialData)
+        self.OpenUpstream = OpenUpstream
+        self.Count = Count
+        self.Scope = Scope
+        self.Upstream = None
+        self.UpstreamReader = None
+        self.UpstreamUses = 0
+
+    def Run(self):
+        try:
+            while True:
+                head = self.Client.ReadHead()
+                if head is None:
+                    break
+                request = HttpMessage(head)
+                parts = request.Start.split(' ')
+                if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+                    raise HttpError('Malformed request line')
+                method, target, version = parts
+                connection = request.Tokens('connection')
+                keepAlive = 'keep-alive' in connection if version == 'HTTP/1.0' else 'close' not in connection
+                if not self.Handle(request, method, target) or not keepAlive:
+                    break
+        except HttpError as e:
+            self.Count('http_errors')
+            self.Reply(400, str(e))
+        except OSError:
+            pass
+        finally:
+            self.CloseUpstream()
+            try:
+                self.Conn.close()
+            except OSError:
+                pass
+
+    def Reply(self, status, reason):
+        body = f"{status} {reason}\n".encode('utf-8')
+        try:
+            self.Conn.sendall(f"HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+                              f"Connection: close\r\n\r\n".encode('latin-1') + body)
+        except OSError:
+            pass
+
+    def CloseUpstream(self):
+        if self.Upstream:
+            try:
+                self.Upstream.close()
+            except OSError:
+                pass
+        self.Upstream = None
+        self.UpstreamReader = None
+
+    def Handle(self, request, method, target):
+        now = time.monotonic()
+        key = None
+        entry = None
+        directives = request.CacheControl()
+        if (method in ('GET', 'HEAD') and BodyLength(request) == 0 and request.Get('authorization') is None
+                and 'upgrade' not in request.Tokens('connection') and 'no-store' not in directives):
+            key = (self.Scope, request.Get('host', '').lower(), target)
+            entry = self.Cache.Lookup(key, request)
+            forceRevalidate = 'no-cache' in directives or directives.get('max-age') == '0' or 'no-cache' in request.Tokens('pragma')
+            if entry and entry.Fresh(now) and not forceRevalidate:
+                self.Count('cache_hits')
+                self.Count('cache_hit_bytes', len(entry.Body))
+                self.ServeEntry(entry, request, method, now)
+                return True
+        if key is None:
+            self.Count('cache_bypassed')
+        else:
+            self.Count('cache_revalidations' if entry else 'cache_misses')
+        headers = request.Headers
+        if entry and entry.Validators():
+            headers = [(name, value) for name, value in headers if name.lower() not in ConditionalHeaders] + entry.Validators()
+        return self.Forward(request, method, request.Head(headers), key, entry)
+
+    def Forward(self, request, method, head, key, entry):
+        requestLength = BodyLength(request)
+        for attempt in range(2):
+            if not self.Upstream:
+                self.Upstream = self.OpenUpstream()
+                self.UpstreamReader = HttpReader(self.Upstream)
+                self.UpstreamUses = 0
+            reused = self.UpstreamUses > 0
+            self.UpstreamUses += 1
+            try:
+                self.Upstream.sendall(head)
+                if requestLength:
+                    CopyBody(self.Client, requestLength, self.Upstream.sendall)
+                responseHead = self.UpstreamReader.ReadHead()
+            except OSError:
+                responseHead = None
+            if responseHead is not None:
+                break
+            self.CloseUpstream()
+            # An idle keep-alive upstream may have been closed by the origin; retry safe requests once
+            if not reused or requestLength or method not in ('GET', 'HEAD'):
+                self.Reply(502, 'Bad Gateway')
+                return False
+        return self.Respond(request, method, HttpMessage(responseHead), key, entry)
+
+    def Respond(self, request, method, response, key, entry):
+        while True:
+            status = int(response.Start.split(' ', 2)[1])
+            if status == 101:
+                self.Conn.sendall(response.Head())
+                self.Tunnel()
+                return False
+            if not 100 <= status < 200:
+                break
+            self.Conn.sendall(response.Head())
+            response = HttpMessage(self.UpstreamReader.ReadHead() or b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+        now = time.monotonic()
+        if status == 304 and entry:
+            entry.Refresh(response)
+            self.Count('cache_revalidated')
+            self.ServeEntry(entry, request, method, now)
+            return self.KeepUpstream(response)
+        length = BodyLength(response, method, status)
+        if key and method == 'GET' and length is not None and self.Cacheable(response, status, length):
+            body = bytearray()
+            spilled = [False]
+
+            def Collect(data):
+                if spilled[0]:
+                    self.Conn.sendall(data)
+                    return
+                body.extend(data)
+                if len(body) > self.Cache.MaxObject:
+                    # Too large to cache after all: stream the rest straight through
+                    spilled[0] = True
+                    self.Conn.sendall(response.Head() + bytes(body))
+
+            CopyBody(self.UpstreamReader, length, Collect)
+            if not spilled[0]:
+                vary = [name for name in response.Tokens('vary')]
+                self.Cache.Store(key, CacheEntry(response, bytes(body), request, vary))
+                self.Count('cache_stored')
+                self.Conn.sendall(response.Head() + bytes(body))
+        else:
+            self.Conn.sendall(response.Head())
+            CopyBody(self.UpstreamReader, length, self.Conn.sendall)
+        if length is None:
+            self.CloseUpstream()
+            return False
+        return self.KeepUpstream(response)
+
+    def KeepUpstream(self, response):
+        if 'close' in response.Tokens('connection') or response.Start.startswith('HTTP/1.0'):
+            self.CloseUpstream()
+        return True
+
+    def Cacheable(self, response, status, length):
+        if status not in CacheableStatus:
+            return False
+        if isinstance(length, int) and length > self.Cache.MaxObject:
+            return False
+        directives = response.CacheControl()
+        if 'no-store' in directives or 'private' in directives or response.Get('set-cookie') is not None:
+            return False
+        if '*' in response.Tokens('vary'):
+            return False
+        explicit = any(directives.get(name, '').isdigit() and int(directives[name]) > 0 for name in ('s-maxage', 'max-age'))
+        explicit = explicit or (response.Get('expires') is not None and 'max-age' not in directives)
+        # Without explicit freshness only validators make a stored copy useful (revalidated every time)
+        return explicit or response.Get('etag') is not None or response.Get('last-modified') is not None
+
+    def ServeEntry(self, entry, request, method, now):
+        if entry.NotModifiedFor(request):
+            headers = [(name, value) for name, value in entry.Headers
+                       if name.lower() in ('etag', 'cache-control', 'expires', 'last-modified', 'vary', 'date')]
+            self.Conn.sendall(HttpMessage(b'HTTP/1.1 304 Not Modified\r\n\r\n').Head(headers + [('Age', str(entry.Age(now)))]))
+            return
+        head = HttpMessage(entry.Start.encode('latin-1') + b'\r\n\r\n').Head(entry.Headers + [('Age', str(entry.Age(now))), ('X-Cache', 'HIT')])
+        self.Conn.sendall(head if method == 'HEAD' else head + entry.Body)
+
+    def Tunnel(self):
+        # Protocol switch (e.g. WebSocket): hand over any buffered bytes and splice both ways
+        upstream, conn = self.Upstream, self.Conn
+        leftover = self.Client.Take()
+        if leftover:
+            upstream.sendall(leftover)
+        pending = self.UpstreamReader.Take()
+        if pending:
+            conn.sendall(pending)
+        self.Upstream = None
+
+        def Pump(source, target):
+            try:
+                while True:
+                    data = source.recv(65536)
+                    if not data:
+                        break
+                    target.sendall(data)
+            except OSError:
+                pass
+            finally:
+                # Either direction ending tears down both so the other pump wakes up
+                for end in (source, target):
+                    try:
+                        end.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        conn.settimeout(None)
+        upstream.settimeout(None)
+        pump = threading.Thread(target=Pump, args=(upstream, conn), daemon=True)
+        pump.start()
+        Pump(conn, upstream)
+        pump.join()
+        upstream.close()
@@ -0,0 +1,337 @@
+import socket
+import threading
+import errno
+import struct
+import json
+import time
+from collections import deque
+
+# kind, conversation id, sequence number, cumulative ack (next sequence expected from the peer)
+PacketHeader = struct.Struct('!BIII')
+PUNCH = 1
+PUNCH_ACK = 2
+DATA = 3
+ACK = 4
+FIN = 5
+SegmentSize = 1200
+
+def ConversationId(token):
+    return int(token[:8], 16)
+
+def Punch(Sock, Rendezvous, Session, Token, Role, Timeout=3):
+    """Register with the rendezvous server and punch a path to the peer it reports.
+
+    Returns a ReliableChannel on success, or None after closing Sock when no
+    two-way path could be confirmed within Timeout seconds.
+    """
+    conv = ConversationId(Token)
+    register = json.dumps({'type': 'register', 'session': Session, 'token': Token, 'role': Role}).encode('utf-8')
+    punch = PacketHeader.pack(PUNCH, conv, 0, 0)
+    peer = None
+    confirmed = False
+    lastSent = 0
+    deadline = time.monotonic() + Timeout
+    Sock.settimeout(0.05)
+    try:
+        while not confirmed and time.monotonic() < deadline:
+            now = time.monotonic()
+            if peer is None and now - lastSent >= 0.1:
+                Sock.sendto(register, Rendezvous)
+                lastSent = now
+            elif peer is not None and now - lastSent >= 0.05:
+                Sock.sendto(punch, peer)
+                lastSent = now
+            try:
+                data, addr = Sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            if data[:1] == b'{':
+                try:
+                    message = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    continue
+                if message.get('type') == 'peer' and message.get('session') == Session and peer is None:
+                    peer = tuple(message['addr'])
+                    lastSent = 0
+                continue
+            if len(data) < PacketHeader.size:
+                continue
+            kind, packetConv, seq, ack = PacketHeader.unpack_from(data)
+            if packetConv != conv:
+                continue
+            # Whatever address the peer's packets arrive from is the one its NAT opened for us
+            peer = addr
+            if kind == PUNCH:
+                Sock.sendto(PacketHeader.pack(PUNCH_ACK, conv, 0, 0), addr)
+            else:
+                confirmed = True
+    except OSError as e:
+        print(f"Hole punching error: {e}")
+    if not confirmed:
+        Sock.close()
+        return None
+    return ReliableChannel(Sock, peer, conv)
+
+class ReliableChannel:
+    """Ordered, acknowledged byte stream over a punched UDP path with a socket-like API."""
+
+    def __init__(self, Sock, Peer, Conv, Window=128, RetransmitTimeout=0.2, DeadTimeout=10):
+        self.Sock = Sock
+        self.Peer = Peer
+        self.Conv = Conv
+        self.Window = Window
+        self.RetransmitTimeout = RetransmitTimeout
+        self.DeadTimeout = DeadTimeout
+        self.Condition = threading.Condition()
+        self.NextSeq = 0
+        self.Unacked = {}
+        self.Expected = 0
+        self.OutOfOrder = {}
+        self.Chunks = deque()
+        self.Buffered = 0
+        self.MaxBuffered = Window * SegmentSize
+        self.Timeout = None
+        self.ReadShut = False
+        self.WriteShut = False
+        self.Closed = False
+        self.Error = None
+        self.LastHeard = time.monotonic()
+        self.LastAck = 0
+        self.DuplicateAcks = 0
+        self.Retransmits = 0
+        self.Sock.settimeout(0.05)
+        try:
+            self.Sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304)
+        except (OSError, AttributeError):
+            pass
+        threading.Thread(target=self.Run, daemon=True).start()
+
+    def __repr__(self):
+        return f"<ReliableChannel {self.Peer[0]}:{self.Peer[1]}>"
+
+    def fileno(self):
+        return -1
+
+    def getpeername(self):
+        return self.Peer
+
+    def settimeout(self, timeout):
+        self.Timeout = timeout
+
+    def gettimeout(self):
+        return self.Timeout
+
+    def setblocking(self, flag):
+        self.Timeout = None if flag else 0.0
+
+    def SendPacket(self, kind, seq=0, payload=b''):
+        try:
+            self.Sock.sendto(PacketHeader.pack(kind, self.Conv, seq, self.Expected) + payload, self.Peer)
+        except OSError:
+            pass
+
+    def Wait(self, predicate, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout('timed out')
+            self.Condition.wait(remaining)
+
+    def Queue(self, kind, payload=b''):
+        with self.Condition:
+            self.Wait(lambda: len(self.Unacked) < self.Window or self.Error or self.Closed, self.Timeout)
+            if self.Error:
+                raise self.Error
+            seq = self.NextSeq
+            self.NextSeq += 1
+            self.Unacked[seq] = [kind, payload, time.monotonic(), self.RetransmitTimeout]
+        self.SendPacket(kind, seq, payload)
+
+    def sendall(self, data, flags=0):
+        if self.Closed:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+        if self.WriteShut:
+            raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+        data = memoryview(bytes(data))
+        for offset in range(0, len(data), SegmentSize):
+            self.Queue(DATA, bytes(data[offset:offset + SegmentSize]))
+
+    def send(self, data, flags=0):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, bufsize, flags=0):
+        with self.Condition:
+            self.Wait(lambda: self.Chunks or self.ReadShut or self.Error or self.Closed, self.Timeout)
+            if self.Closed:
+                raise OSError(errno.EBADF, 'Bad file descriptor')
+            if not self.Chunks:
+                if self.Error:
+                    raise self.Error
+                return b''
+            chunk = self.Chunks.popleft()
+            if len(chunk) > bufsize:
+                self.Chunks.appendleft(chunk[bufsize:])
+                chunk = chunk[:bufsize]
+            self.Buffered -= len(chunk)
+            expected = self.Expected
+            self.Deliver()
+            reopened = self.Expected != expected
+        if reopened:
+            # Acknowledge what was held back so the peer resumes without waiting for a retransmit
+            self.SendPacket(ACK)
+        return chunk
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR) and not self.WriteShut and not self.Error:
+            self.WriteShut = True
+            try:
+                self.Queue(FIN)
+            except OSError:
+                pass
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            with self.Condition:
+                self.ReadShut = True
+                self.Condition.notify_all()
+
+    def close(self):
+        if self.Closed:
+            return
+        self.shutdown(socket.SHUT_WR)
+        with self.Condition:
+            self.Closed = True
+            self.Chunks.clear()
+            self.Buffered = 0
+            self.Condition.notify_all()
+
+    def Deliver(self):
+        # Segments beyond a full receive queue stay unacknowledged: the peer's send window
+        # fills and its sender waits, instead of Chunks growing while the reader falls behind
+        while self.Expected in self.OutOfOrder and self.Buffered < self.MaxBuffered:
+            kind, payload = self.OutOfOrder.pop(self.Expected)
+            self.Expected += 1
+            if kind == FIN:
+                self.ReadShut = True
+            elif not self.Closed:
+                self.Chunks.append(payload)
+                self.Buffered += len(payload)
+
+    def Receive(self, data):
+        kind, conv, seq, ack = PacketHeader.unpack_from(data)
+        if conv != self.Conv:
+            return
+        self.LastHeard = time.monotonic()
+        if kind == PUNCH:
+            self.SendPacket(PUNCH_ACK)
+            return
+        fastRetransmit = None
+        with self.Condition:
+            if ack > self.LastAck:
+                for acked in range(self.LastAck, ack):
+                    self.Unacked.pop(acked, None)
+                self.LastAck = ack
+                self.DuplicateAcks = 0
+            elif kind == ACK and ack in self.Unacked:
+                # Three duplicate acks mean the segment at ack was lost while later ones arrived
+                self.DuplicateAcks += 1
+                if self.DuplicateAcks == 3:
+                    entry = self.Unacked[ack]
+                    entry[2] = time.monotonic()
+                    fastRetransmit = (ack, entry[0], entry[1])
+            if kind in (DATA, FIN):
+                if seq >= self.Expected and seq < self.Expected + 2 * self.Window:
+                    self.OutOfOrder[seq] = (kind, data[PacketHeader.size:])
+                self.Deliver()
+            self.Condition.notify_all()
+        if fastRetransmit:
+            with self.Condition:
+                self.Retransmits += 1
+            self.SendPacket(fastRetransmit[1], fastRetransmit[0], fastRetransmit[2])
+        if kind in (DATA, FIN):
+            self.SendPacket(ACK)
+
+    def Retransmit(self):
+        now = time.monotonic()
+        resend = None
+        with self.Condition:
+            # Only the oldest segment is resent on timeout; later ones are usually buffered by the peer
+            entry = self.Unacked.get(self.LastAck)
+            if entry and now - entry[2] >= entry[3]:
+                entry[2] = now
+                entry[3] = min(entry[3] * 2, 2.0)
+                resend = (self.LastAck, entry[0], entry[1])
+            if self.Unacked and now - self.LastHeard > self.DeadTimeout:
+                self.Error = ConnectionResetError(errno.ECONNRESET, 'Peer stopped responding')
+                self.Unacked.clear()
+                self.Condition.notify_all()
+        if resend:
+            with self.Condition:
+                self.Retransmits += 1
+            self.SendPacket(resend[1], resend[0], resend[2])
+
+    def Finished(self):
+        with self.Condition:
+            if self.Error:
+                return True
+            # Linger after close until everything queued has been acknowledged
+            return self.Closed and not self.Unacked
+
+    def Run(self):
+        try:
+            while not self.Finished():
+                try:
+                    data, addr = self.Sock.recvfrom(65536)
+                    if len(data) >= PacketHeader.size and data[:1] != b'{':
+                        self.Receive(data)
+                except socket.timeout:
+                    pass
+                except OSError:
+                    if self.Closed:
+                        break
+                self.Retransmit()
+        finally:
+            try:
+                self.Sock.close()
+            except OSError:
+                pass
+
+def Splice(left, right, onClose=None):
+    """Copy bytes both ways between two socket-like objects until both directions end."""
+    remaining = [2]
+    lock = threading.Lock()
+
+    def CloseBoth():
+        for end in (left, right):
+            try:
+                # shutdown wakes a pump still blocked in recv() on the other end
+                end.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                end.close()
+            except OSError:
+                pass
+
+    def Pump(source, target):
+        failed = False
+        try:
+            source.settimeout(None)
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                target.sendall(data)
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            failed = True
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if failed or last:
+            CloseBoth()
+        if last and onClose:
+            onClose()
+
+    threading.Thread(target=Pump, args=(left, right), daemon=True).start()
+    threading.Thread(target=Pump, args=(right, left), daemon=True).start()
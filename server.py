@@ -3,23 +3,649 @@ import threading
 import json
 import traceback
 import sys
+import os
 import re
-from collections import defaultdict
+import stat
+import time
+import zlib
+import queue
+import struct
+import bisect
+import itertools
+import asyncio
+import selectors
+import secrets
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .transport import MemoryPipe, MemoryBudget, AcceptSharedMemory
+    from .capture import CaptureWriter, CaptureIn, CaptureOut
+    from .edgecache import ResponseCache, HttpEdge
+    from .cluster import ClusterNode, RemoteForward
+    from .dedup import Chunker, StreamCutter, DedupEncoder, DedupDecoder, Queued, Summarize, DataMessage, MessageData, MinStoreBytes
+except ImportError:
+    from transport import MemoryPipe, MemoryBudget, AcceptSharedMemory
+    from capture import CaptureWriter, CaptureIn, CaptureOut
+    from edgecache import ResponseCache, HttpEdge
+    from cluster import ClusterNode, RemoteForward
+    from dedup import Chunker, StreamCutter, DedupEncoder, DedupDecoder, Queued, Summarize, DataMessage, MessageData, MinStoreBytes
+
+def StitchTrace(entry):
+    """Place the client's events on the server timeline and split the time into phases.
+
+    Client events are relative to the moment it received new_connection. The
+    tunnel round trip is what remains of the server's announce-to-first-byte
+    wait once the client's own receive-to-first-byte time is taken out.
+    """
+    server = entry['server']
+    remote = entry.get('client') or {}
+    timeline = [[ms, 'server', name] for name, ms in server.items()]
+    phases = {}
+    if 'announced' in server:
+        phases['admission'] = round(server['admitted'] - server['accept'], 2)
+        phases['announce'] = round(server['announced'] - server['announce'], 2)
+    if remote and 'announced' in server:
+        rtt = 0.0
+        if 'first_byte_out' in server and 'first_response_byte' in remote:
+            rtt = max(0.0, server['first_byte_out'] - server['announced'] - remote['first_response_byte'])
+            phases['tunnel_rtt'] = round(rtt, 2)
+        offset = server['announced'] + rtt / 2
+        timeline += [[round(offset + ms, 2), 'client', name] for name, ms in remote.items()]
+        if 'connected' in remote:
+            phases['target_connect'] = remote['connected']
+            if 'first_response_byte' in remote:
+                ready = max(remote['connected'], remote.get('first_request_byte', 0))
+                phases['service'] = round(remote['first_response_byte'] - ready, 2)
+    if 'first_byte_out' in server:
+        phases['first_byte'] = server['first_byte_out']
+    timeline.sort()
+    entry['timeline'] = timeline
+    entry['phases'] = phases
+    return entry
+
+class TokenBucket:
+    def __init__(self, Rate, Burst=None):
+        self.Rate = float(Rate)
+        self.Burst = float(Burst or Rate)
+        self.Tokens = self.Burst
+        self.Last = time.monotonic()
+        self.Lock = threading.Lock()
+
+    def Refill(self):
+        now = time.monotonic()
+        self.Tokens = min(self.Burst, self.Tokens + (now - self.Last) * self.Rate)
+        self.Last = now
+
+    def TryConsume(self, amount=1):
+        with self.Lock:
+            self.Refill()
+            if self.Tokens >= amount:
+                self.Tokens -= amount
+                return True
+            return False
+
+    def Consume(self, amount):
+        # Goes into debt instead of refusing, the caller sleeps off the returned delay
+        with self.Lock:
+            self.Refill()
+            self.Tokens -= amount
+            if self.Tokens >= 0:
+                return 0
+            return -self.Tokens / self.Rate
+
+class LimitSet:
+    def __init__(self, Limits=None, Parent=None):
+        # Memory holds data read from the tunnel, SendMemory data on its way to it; separate
+        # trees, so a backlog in one direction never pauses the reader of the other
+        self.Memory = MemoryBudget(0, Parent.Memory if Parent else None)
+        self.SendMemory = MemoryBudget(0, Parent.SendMemory if Parent else None)
+        # Dedup stores stay resident, so they are reserved whole at login from their own
+        # account instead of counting against the budget the tunnel reader waits on
+        self.StoreMemory = MemoryBudget(0, Parent.StoreMemory if Parent else None)
+        self.Active = 0
+        self.Lock = threading.Lock()
+        self.Configure(Limits)
+
+    def Configure(self, Limits):
+        Limits = Limits or {}
+        bytesRate = Limits.get('bytes_per_second', 0)
+        connRate = Limits.get('connections_per_second', 0)
+        self.Bytes = TokenBucket(bytesRate, Limits.get('bytes_burst')) if bytesRate else None
+        self.Connections = TokenBucket(connRate, Limits.get('connections_burst')) if connRate else None
+        self.MaxConnections = int(Limits.get('max_connections', 0))
+        self.Memory.Limit = self.SendMemory.Limit = int(Limits.get('memory', 0) or 0)
+        self.StoreMemory.Limit = self.Memory.Limit // 2
+
+    def Admit(self):
+        with self.Lock:
+            if self.MaxConnections and self.Active >= self.MaxConnections:
+                return 'max_connections'
+            if self.Connections and not self.Connections.TryConsume():
+                return 'connection_rate'
+            self.Active += 1
+            return None
+
+    def Release(self):
+        with self.Lock:
+            if self.Active > 0:
+                self.Active -= 1
+
+    def Throttle(self, amount):
+        if not self.Bytes:
+            return 0
+        return self.Bytes.Consume(amount)
+
+class HandshakeGuard:
+    """Pre-auth admission for tunnel peers: handshake budgets and per-IP failure bans.
+
+    Failures are counted per source IP in a sliding window; crossing the limit
+    bans the IP for BanTime seconds. The table is an LRU capped at MaxTracked
+    entries, so a flood of distinct addresses cannot grow it without bound.
+    """
+
+    def __init__(self, Config=None):
+        Config = Config or {}
+        self.Timeout = float(Config.get('timeout', 10))
+        self.MaxBytes = int(Config.get('max_bytes', 16384))
+        self.MaxFailures = int(Config.get('max_failures', 5))
+        self.Window = float(Config.get('window', 60))
+        self.BanTime = float(Config.get('ban_time', 300))
+        self.MaxTracked = int(Config.get('max_tracked', 4096))
+        self.MaxPending = int(Config.get('max_pending', 256))
+        self.MaxPendingPerIp = int(Config.get('max_pending_per_ip', 8))
+        self.Sources = OrderedDict()
+        self.Pending = defaultdict(int)
+        self.PendingTotal = 0
+        self.Lock = threading.Lock()
+
+    def Admit(self, ip):
+        # Called from the accept loop before any thread exists for the peer
+        now = time.monotonic()
+        with self.Lock:
+            entry = self.Sources.get(ip)
+            if entry and entry[2] > now:
+                return 'banned'
+            if self.PendingTotal >= self.MaxPending or self.Pending[ip] >= self.MaxPendingPerIp:
+                if not self.Pending[ip]:
+                    del self.Pending[ip]
+                return 'handshake_backlog'
+            self.Pending[ip] += 1
+            self.PendingTotal += 1
+            return None
+
+    def Settle(self, ip):
+        with self.Lock:
+            self.PendingTotal -= 1
+            self.Pending[ip] -= 1
+            if self.Pending[ip] <= 0:
+                del self.Pending[ip]
+
+    def Success(self, ip):
+        with self.Lock:
+            self.Sources.pop(ip, None)
+
+    def Failure(self, ip):
+        now = time.monotonic()
+        with self.Lock:
+            entry = self.Sources.pop(ip, None)
+            if not entry or now - entry[1] > self.Window:
+                entry = [0, now, 0]
+            entry[0] += 1
+            banned = entry[0] >= self.MaxFailures
+            if banned:
+                entry[:] = [0, now, now + self.BanTime]
+            self.Sources[ip] = entry
+            while len(self.Sources) > self.MaxTracked:
+                self.Sources.popitem(last=False)
+            return banned
+
+    def Snapshot(self):
+        now = time.monotonic()
+        with self.Lock:
+            return {'tracked': len(self.Sources), 'pending': self.PendingTotal,
+                    'banned': sorted(ip for ip, entry in self.Sources.items() if entry[2] > now)}
+
+def ParseHttpHost(data):
+    headerEnd = data.find(b'\r\n\r\n')
+    if headerEnd < 0:
+        return None
+    match = re.search(rb'\r\nhost:[ \t]*([^\r\n]+)', data[:headerEnd + 2], re.IGNORECASE)
+    if not match:
+        return ''
+    host = match.group(1).strip().decode('latin-1')
+    if host.startswith('['):
+        return host[:host.find(']') + 1].lower()
+    return host.split(':')[0].lower()
+
+def ParseTlsSni(data):
+    if len(data) < 5:
+        return None
+    recordEnd = 5 + int.from_bytes(data[3:5], 'big')
+    if len(data) < recordEnd:
+        return None
+    try:
+        if data[5] != 1:
+            return ''
+        pos = 5 + 4 + 2 + 32
+        pos += 1 + data[pos]
+        pos += 2 + int.from_bytes(data[pos:pos + 2], 'big')
+        pos += 1 + data[pos]
+        extensionsEnd = pos + 2 + int.from_bytes(data[pos:pos + 2], 'big')
+        pos += 2
+        while pos + 4 <= min(extensionsEnd, recordEnd):
+            extType = int.from_bytes(data[pos:pos + 2], 'big')
+            extLength = int.from_bytes(data[pos + 2:pos + 4], 'big')
+            pos += 4
+            if extType == 0:
+                namePos = pos + 2
+                while namePos + 3 <= pos + extLength:
+                    nameType = data[namePos]
+                    nameLength = int.from_bytes(data[namePos + 1:namePos + 3], 'big')
+                    if nameType == 0:
+                        return data[namePos + 3:namePos + 3 + nameLength].decode('ascii').lower()
+                    namePos += 3 + nameLength
+                return ''
+            pos += extLength
+    except (IndexError, UnicodeDecodeError):
+        pass
+    return ''
+
+class VhostRouter:
+    def __init__(self):
+        self.Exact = {}
+        self.Wildcards = {}
+        self.Lock = threading.Lock()
+
+    def Add(self, domain, target):
+        domain = domain.lower().rstrip('.')
+        with self.Lock:
+            if domain.startswith('*.'):
+                table, key = self.Wildcards, domain[1:]
+            else:
+                table, key = self.Exact, domain
+            if key in table:
+                return False
+            table[key] = target
+            return True
+
+    def Remove(self, domain, target=None):
+        domain = domain.lower().rstrip('.')
+        with self.Lock:
+            if domain.startswith('*.'):
+                table, key = self.Wildcards, domain[1:]
+            else:
+                table, key = self.Exact, domain
+            if target is None or table.get(key) is target:
+                table.pop(key, None)
+
+    def Match(self, host):
+        host = host.lower().rstrip('.')
+        target = self.Exact.get(host)
+        if target:
+            return target
+        dot = host.find('.')
+        while dot >= 0:
+            target = self.Wildcards.get(host[dot:])
+            if target:
+                return target
+            dot = host.find('.', dot + 1)
+        return None
+
+class PortAllocator:
+    def __init__(self, MinPort, MaxPort, StickyTimeout=300):
+        self.MinPort = MinPort
+        self.MaxPort = MaxPort
+        self.Size = MaxPort - MinPort + 1
+        self.Bitmap = bytearray((self.Size + 7) // 8)
+        self.Owners = {}
+        self.Reservations = {}
+        self.ReservedPorts = {}
+        self.StickyTimeout = StickyTimeout
+        self.Cursor = 0
+        self.Used = 0
+        self.Lock = threading.Lock()
+
+    def IsUsed(self, port):
+        index = port - self.MinPort
+        return bool(self.Bitmap[index >> 3] & (1 << (index & 7)))
+
+    def Mark(self, port, used):
+        index = port - self.MinPort
+        if used:
+            self.Bitmap[index >> 3] |= 1 << (index & 7)
+            self.Used += 1
+        else:
+            self.Bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.Used -= 1
+
+    def ExpireReservations(self):
+        now = time.monotonic()
+        for sticky, (port, expires) in list(self.Reservations.items()):
+            if expires and expires <= now:
+                del self.Reservations[sticky]
+                self.ReservedPorts.pop(port, None)
+
+    def IsFreeFor(self, port, sticky):
+        if self.IsUsed(port):
+            return False
+        reservedFor = self.ReservedPorts.get(port)
+        return reservedFor is None or reservedFor == sticky
+
+    def Take(self, port, sticky):
+        self.Mark(port, True)
+        if sticky:
+            previous = self.Reservations.pop(sticky, None)
+            if previous:
+                self.ReservedPorts.pop(previous[0], None)
+            self.Reservations[sticky] = (port, 0)
+            self.ReservedPorts[port] = sticky
+        return port
+
+    def Claim(self, port, sticky=None):
+        with self.Lock:
+            self.ExpireReservations()
+            if not self.MinPort <= port <= self.MaxPort or not self.IsFreeFor(port, sticky):
+                return False
+            self.Take(port, sticky)
+            return True
+
+    def Allocate(self, sticky=None):
+        with self.Lock:
+            self.ExpireReservations()
+            if sticky in self.Reservations:
+                port = self.Reservations[sticky][0]
+                if not self.IsUsed(port):
+                    return self.Take(port, sticky)
+            byteCount = len(self.Bitmap)
+            start = self.Cursor >> 3
+            for step in range(byteCount + 1):
+                byteIndex = (start + step) % byteCount
+                if self.Bitmap[byteIndex] == 0xFF:
+                    continue
+                for bit in range(8):
+                    index = (byteIndex << 3) + bit
+                    if index >= self.Size or self.Bitmap[byteIndex] & (1 << bit):
+                        continue
+                    port = self.MinPort + index
+                    if port in self.ReservedPorts:
+                        continue
+                    self.Cursor = index + 1
+                    return self.Take(port, sticky)
+            return None
+
+    def SetOwner(self, port, owner):
+        with self.Lock:
+            self.Owners[port] = owner
+
+    def Owner(self, port):
+        return self.Owners.get(port)
+
+    def Release(self, port, sticky=None):
+        with self.Lock:
+            if not self.MinPort <= port <= self.MaxPort or not self.IsUsed(port):
+                return
+            self.Mark(port, False)
+            self.Owners.pop(port, None)
+            if sticky and self.Reservations.get(sticky, (None,))[0] == port:
+                self.Reservations[sticky] = (port, time.monotonic() + self.StickyTimeout)
+
+class ForwardGroup:
+    Policies = ('ROUND_ROBIN', 'LEAST_CONNECTIONS', 'SOURCE_HASH')
+
+    def __init__(self, Name, Port, Server, Policy='ROUND_ROBIN', VirtualNodes=64):
+        self.Name = Name
+        self.Port = Port
+        self.Server = Server
+        self.Policy = Policy
+        self.VirtualNodes = VirtualNodes
+        self.Members = []
+        self.Ring = []
+        self.RingKeys = []
+        self.Next = 0
+        self.Sticky = None
+        self.Ready = threading.Event()
+        self.Lock = threading.Lock()
+
+    def Add(self, forward):
+        with self.Lock:
+            self.Members.append(forward)
+            self.RebuildRing()
+
+    def Remove(self, forward):
+        with self.Lock:
+            self.Members = [member for member in self.Members if member is not forward]
+            self.RebuildRing()
+            return len(self.Members)
+
+    def RebuildRing(self):
+        if self.Policy != 'SOURCE_HASH':
+            return
+        self.Ring = sorted(
+            (zlib.crc32(f"{member.Id}#{i}".encode('utf-8')), member)
+            for member in self.Members
+            for i in range(self.VirtualNodes)
+        )
+        self.RingKeys = [point for point, member in self.Ring]
+
+    def Pick(self, sourceIp):
+        with self.Lock:
+            if not self.Members:
+                return None
+            if self.Policy == 'LEAST_CONNECTIONS':
+                return min(self.Members, key=lambda member: member.Limits.Active)
+            if self.Policy == 'SOURCE_HASH':
+                index = bisect.bisect(self.RingKeys, zlib.crc32(sourceIp.encode('utf-8'))) % len(self.Ring)
+                return self.Ring[index][1]
+            member = self.Members[self.Next % len(self.Members)]
+            self.Next += 1
+            return member
+
+class BatchedRequest(dict):
+    """A forward_request taken from a forward_batch; its response is collected rather than sent,
+    and a listener it opens starts accepting once the batch response is out."""
+    __slots__ = ('Response', 'Listener')
+
+    def __init__(self, request):
+        super().__init__(request)
+        self.Response = None
+        self.Listener = None
+
+class ClientRecord:
+    __slots__ = ('Id', 'Serial', 'Socket', 'Addr', 'Buffer', 'Authenticated', 'Rejected', 'Features', 'Forwards', 'Streams', 'Limits',
+                 'Lock', 'SendLock', 'Encoder', 'Decoder')
+
+    def __init__(self, Id, Socket, Addr, Limits):
+        self.Id = Id
+        self.Serial = 0
+        self.Socket = Socket
+        self.Addr = Addr
+        self.Buffer = b''
+        self.Authenticated = False
+        self.Rejected = None
+        self.Features = frozenset()
+        self.Forwards = {}
+        self.Streams = {}
+        self.Limits = Limits
+        self.Lock = threading.Lock()
+        self.SendLock = threading.Lock()
+        self.Encoder = None
+        self.Decoder = None
+
+class ForwardRecord:
+    __slots__ = ('Id', 'Client', 'Mode', 'Port', 'Domains', 'Group', 'Limits', 'LimitChain', 'Stats', 'Streams', 'Cache', 'Dedup')
+
+    def __init__(self, Id, Client, Mode, Limits, GlobalLimits, Port=None, Domains=None):
+        self.Id = Id
+        self.Client = Client
+        self.Mode = Mode
+        self.Port = Port
+        self.Domains = Domains or []
+        self.Group = None
+        self.Limits = Limits
+        self.LimitChain = (GlobalLimits, Client.Limits, Limits)
+        self.Stats = defaultdict(int)
+        self.Streams = {}
+        self.Cache = None
+        self.Dedup = False
+
+class StreamRecord:
+    __slots__ = ('Id', 'Forward', 'Socket', 'Trace', 'EarlyData', 'Outbox', 'Writer')
+
+    def __init__(self, Id, Forward, Socket):
+        self.Id = Id
+        self.Forward = Forward
+        self.Socket = Socket
+        self.Trace = None
+        self.EarlyData = b''
+        self.Outbox = None
+        self.Writer = None
+
+class Registry:
+    def __init__(self):
+        self.Clients = {}
+        self.StreamIds = itertools.count(1)
+        self.ClientSerials = itertools.count(1)
+        self.Lock = threading.Lock()
+
+    def AddClient(self, client):
+        with self.Lock:
+            client.Serial = next(self.ClientSerials)
+            self.Clients[client.Id] = client
+
+    def ListClients(self):
+        with self.Lock:
+            return list(self.Clients.values())
+
+    def ListForwards(self):
+        forwards = []
+        for client in self.ListClients():
+            with client.Lock:
+                forwards.extend(client.Forwards.values())
+        return forwards
+
+    def NextStreamId(self):
+        # Id counters are shared by every client's threads; never rely on the GIL to serialize next()
+        with self.Lock:
+            return next(self.StreamIds)
+
+    def RemoveClient(self, client):
+        with self.Lock:
+            self.Clients.pop(client.Id, None)
+        with client.Lock:
+            forwards = list(client.Forwards.values())
+            streams = list(client.Streams.values())
+            client.Forwards.clear()
+            client.Streams.clear()
+            for forward in forwards:
+                forward.Streams.clear()
+        return forwards, streams
+
+    def AddForward(self, forward):
+        with forward.Client.Lock:
+            if forward.Id in forward.Client.Forwards:
+                return False
+            forward.Client.Forwards[forward.Id] = forward
+            return True
+
+    def RemoveForward(self, client, forwardId):
+        with client.Lock:
+            forward = client.Forwards.pop(forwardId, None)
+            if not forward:
+                return None, []
+            streams = list(forward.Streams.values())
+            for stream in streams:
+                client.Streams.pop(stream.Id, None)
+            forward.Streams.clear()
+        return forward, streams
+
+    def AddStream(self, forward, sock):
+        client = forward.Client
+        streamId = self.NextStreamId()
+        with client.Lock:
+            if client.Forwards.get(forward.Id) is not forward:
+                return None
+            stream = StreamRecord(streamId, forward, sock)
+            client.Streams[stream.Id] = stream
+            forward.Streams[stream.Id] = stream
+            return stream
+
+    def RemoveStream(self, stream):
+        client = stream.Forward.Client
+        with client.Lock:
+            removed = client.Streams.pop(stream.Id, None)
+            stream.Forward.Streams.pop(stream.Id, None)
+            return removed is not None
 
 class PortForwardServer:
-    def __init__(self, InternalDataPort=5000, AllowedPortRange="5001-5500", MaxPortsPerClient=5, Key="07A36AEF1907843"):
+    def __init__(self, InternalDataPort=5000, AllowedPortRange="5001-5500", MaxPortsPerClient=5, Key="07A36AEF1907843",
+                 Limits=None, ClientLimits=None, ForwardLimits=None, VhostPort=0, StickyTimeout=300, Capture=None,
+                 AcceptBacklog=1024, DeferAccept=0, FastOpen=0, RendezvousPort=0, HttpCache=None, Tracing=None,
+                 BindAddress='0.0.0.0', Cluster=None, UnixSocketPath=None, Handshake=None, Dedup=None,
+                 Keys=None):
         self.InternalDataPort = InternalDataPort
+        self.BindAddress = BindAddress
+        self.UnixSocketPath = UnixSocketPath
+        self.UnixSocket = None
+        self.UnixSerial = itertools.count(1)
+        self.VhostPort = VhostPort
+        self.VhostSocket = None
+        self.VhostRouters = {'HTTP': VhostRouter(), 'HTTPS': VhostRouter()}
+        self.VhostPeekLimit = 16384
+        self.VhostPeekTimeout = 5
+        self.Handshake = HandshakeGuard(Handshake)
+        Dedup = Dedup or {}
+        self.DedupBytes = int(Dedup.get('max_bytes', 16777216))
+        self.Chunker = Chunker(int(Dedup.get('min_chunk', 2048)), int(Dedup.get('avg_chunk', 8192)), int(Dedup.get('max_chunk', 65536)))
+        self.DedupReadSize = 65536
+        HttpCache = HttpCache or {}
+        self.HttpCache = ResponseCache(int(HttpCache.get('max_bytes', 67108864)), int(HttpCache.get('max_object', 1048576)))
+        self.HttpIdleTimeout = int(HttpCache.get('idle_timeout', 60))
+        self.Tracing = Tracing is not None
+        Tracing = Tracing or {}
+        self.TraceSlowMs = float(Tracing.get('slow_ms', 500))
+        self.TraceBuffer = int(Tracing.get('buffer', 256))
+        self.Traces = OrderedDict()
+        self.TraceParts = OrderedDict()
+        self.TraceLock = threading.Lock()
+        self.RendezvousPort = RendezvousPort
+        self.RendezvousSocket = None
+        self.P2PServices = {}
+        self.P2PSessions = {}
+        self.P2PSessionTimeout = 30
+        self.P2PLock = threading.Lock()
         self.AllowedPortRange = AllowedPortRange
         self.MaxPortsPerClient = MaxPortsPerClient
         self.Key = Key
+        self.ClientKeys = frozenset([Key, *(Keys or [])])
+        self.GlobalLimits = LimitSet(Limits)
+        self.MaxMessageSize = int((Limits or {}).get('max_message_size', 1048576))
+        # Keyed by client key, with "default" for the rest; a flat set of limits applies to every client
+        ClientLimits = ClientLimits or {}
+        if not any(isinstance(limits, dict) for limits in ClientLimits.values()):
+            ClientLimits = {'default': ClientLimits}
+        self.ClientLimits = ClientLimits
+        self.ForwardLimits = {str(port): limits for port, limits in (ForwardLimits or {}).items()}
+        self.Stats = defaultdict(int)
+        self.StatsLock = threading.Lock()
         self.ParsePortRange()
+        self.PortAllocator = PortAllocator(self.MinPort, self.MaxPort, StickyTimeout)
         self.ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.ServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.Clients = {}
-        self.ClientLocks = defaultdict(threading.Lock)
-        self.ForwardMap = {}
-        self.ForwardLocks = defaultdict(threading.Lock)
+        self.Registry = Registry()
+        self.Groups = {}
+        self.GroupLock = threading.Lock()
+        self.Capture = CaptureWriter(Capture, 'server') if Capture else None
+        self.AcceptBacklog = AcceptBacklog
+        self.AcceptBatch = 64
+        self.EarlyDataSize = 4096
+        self.BindWorkers = 16
+        self.DeferAccept = DeferAccept
+        self.FastOpen = FastOpen
+        self.Cluster = ClusterNode(self, Cluster['node_id'], int(Cluster['port']), Cluster.get('peers')) if Cluster else None
         self.Running = True
+        self.Stopped = False
+        self.StopLock = threading.Lock()
         self.MessageSeparator = b'|||'
 
     def ParsePortRange(self):
@@ -34,295 +660,1206 @@ class PortForwardServer:
     def IsPortAllowed(self, port):
         return self.MinPort <= port <= self.MaxPort
 
+    def CountStat(self, name, amount=1, forward=None):
+        with self.StatsLock:
+            self.Stats[name] += amount
+            if forward is not None:
+                forward.Stats[name] += amount
+
+    def GetStats(self):
+        clients = self.Registry.ListClients()
+        forwards = self.Registry.ListForwards()
+        with self.StatsLock:
+            stats = dict(self.Stats)
+            stats['forwards'] = {}
+            for forward in forwards:
+                forwardStats = dict(forward.Stats)
+                forwardStats['active_connections'] = forward.Limits.Active
+                forwardStats['memory_used'] = forward.Limits.Memory.Used
+                forwardStats['send_memory_used'] = forward.Limits.SendMemory.Used
+                stats['forwards'][forward.Id] = forwardStats
+        stats['clients'] = len(clients)
+        stats['active_connections'] = self.GlobalLimits.Active
+        stats['ports_used'] = self.PortAllocator.Used
+        stats['ports_free'] = self.PortAllocator.Size - self.PortAllocator.Used
+        stats['memory'] = self.GlobalLimits.Memory.Snapshot()
+        stats['memory']['clients'] = {client.Id: client.Limits.Memory.Snapshot() for client in clients}
+        stats['send_memory'] = self.GlobalLimits.SendMemory.Snapshot()
+        stats['send_memory']['clients'] = {client.Id: client.Limits.SendMemory.Snapshot() for client in clients}
+        stats['handshake'] = self.Handshake.Snapshot()
+        stats['dedup'] = {'sent': Summarize(client.Encoder for client in clients if client.Encoder),
+                          'received': Summarize(client.Decoder for client in clients if client.Decoder),
+                          'reserved': self.GlobalLimits.StoreMemory.Snapshot()}
+        stats['http_cache'] = self.HttpCache.Snapshot()
+        if self.Cluster:
+            stats['cluster'] = self.Cluster.Snapshot()
+        lookups = stats.get('cache_hits', 0) + stats.get('cache_misses', 0) + stats.get('cache_revalidations', 0)
+        stats['http_cache']['hit_ratio'] = round(stats.get('cache_hits', 0) / lookups, 4) if lookups else 0.0
+        with self.GroupLock:
+            stats['groups'] = {
+                str(port): {'name': group.Name, 'policy': group.Policy, 'members': [member.Id for member in group.Members]}
+                for port, group in self.Groups.items() if group.Name
+            }
+        return stats
+
+    def AdmitConnection(self, limitChain):
+        admitted = []
+        for limits in limitChain:
+            reason = limits.Admit()
+            if reason:
+                for previous in admitted:
+                    previous.Release()
+                return reason
+            admitted.append(limits)
+        return None
+
+    def ReleaseConnection(self, limitChain):
+        for limits in limitChain:
+            limits.Release()
+
+    def ThrottleBytes(self, forward, amount):
+        delay = max(limits.Throttle(amount) for limits in forward.LimitChain)
+        if delay > 0:
+            self.CountStat('throttled_bytes', amount, forward)
+            self.CountStat('throttle_delay_ms', int(delay * 1000), forward)
+            time.sleep(delay)
+
+    def ListenPublic(self, listener):
+        # TCP_DEFER_ACCEPT suits client-speaks-first protocols only; both options are Linux-specific
+        if self.DeferAccept and hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, self.DeferAccept)
+        if self.FastOpen and hasattr(socket, 'TCP_FASTOPEN'):
+            try:
+                listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, self.FastOpen)
+            except OSError as e:
+                print(f"TCP_FASTOPEN unavailable: {e}")
+        listener.listen(self.AcceptBacklog)
+
+    def Serve(self):
+        if self.InternalDataPort is not None:
+            self.ServerSocket.bind((self.BindAddress, self.InternalDataPort))
+            self.ServerSocket.listen(self.AcceptBacklog)
+            print(f"Server started on port {self.InternalDataPort}")
+            threading.Thread(target=self.AcceptClients, daemon=True).start()
+        if self.UnixSocketPath:
+            self.StartUnix()
+        if self.VhostPort:
+            self.StartVhost()
+        if self.RendezvousPort:
+            self.StartRendezvous()
+        if self.Cluster:
+            self.Cluster.Start()
+
     def Start(self):
         try:
-            self.ServerSocket.bind(('0.0.0.0', self.InternalDataPort))
-            self.ServerSocket.listen(5)
-            print(f"Server started on port {self.InternalDataPort}")
-            acceptThread = threading.Thread(target=self.AcceptClients, daemon=True)
-            acceptThread.start()
+            self.Serve()
             while self.Running:
                 cmd = input("Enter 'exit' to stop server: ")
                 if cmd.lower() == 'exit':
                     self.Running = False
                     break
+                elif cmd.lower() == 'stats':
+                    print(json.dumps(self.GetStats(), indent=2))
+                elif cmd.lower().split(' ')[0] == 'traces':
+                    self.DumpTraces(cmd.split(' ', 1)[1].strip() if ' ' in cmd else None)
             self.Stop()
         except Exception as e:
             print(f"Server start error: {e}")
             traceback.print_exc()
 
     def Stop(self):
+        with self.StopLock:
+            if self.Stopped:
+                return
+            self.Stopped = True
         self.Running = False
-        self.ServerSocket.close()
-        for clientId, clientData in self.Clients.items():
-            with self.ClientLocks[clientId]:
-                if clientData['socket']:
-                    try:
-                        clientData['socket'].close()
-                    except:
-                        pass
-            with self.ForwardLocks[clientId]:
-                for forwardId, forwardData in clientData['forwards'].items():
-                    try:
-                        forwardData['server'].close()
-                    except:
-                        pass
+        if self.RendezvousSocket:
+            self.RendezvousSocket.close()
+        if self.Cluster:
+            self.Cluster.Stop()
+        for listener in (self.ServerSocket, self.VhostSocket, self.UnixSocket):
+            if listener:
+                try:
+                    listener.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+                listener.close()
+        if self.UnixSocket:
+            try:
+                self.RemoveUnixSocket()
+            except OSError:
+                pass
+        for client in self.Registry.ListClients():
+            try:
+                client.Socket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            self.CleanupClient(client)
+        if self.Capture:
+            self.Capture.Close()
         print("Server stopped")
 
+    def ConnectMemory(self):
+        serverEnd, clientEnd = MemoryPipe()
+        threading.Thread(target=self.HandleClient, args=(serverEnd, ('memory', serverEnd.Name)), daemon=True).start()
+        return clientEnd
+
+    def __enter__(self):
+        self.Serve()
+        return self
+
+    def __exit__(self, *excInfo):
+        self.Stop()
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.Serve)
+        return self
+
+    async def __aexit__(self, *excInfo):
+        await asyncio.to_thread(self.Stop)
+
+    def StartVhost(self):
+        self.VhostSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.VhostSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.VhostSocket.bind((self.BindAddress, self.VhostPort))
+        self.ListenPublic(self.VhostSocket)
+        threading.Thread(target=self.AcceptVhostConnections, daemon=True).start()
+        print(f"Vhost listener started on port {self.VhostPort}")
+
+    def StartRendezvous(self):
+        self.RendezvousSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.RendezvousSocket.bind((self.BindAddress, self.RendezvousPort))
+        self.RendezvousSocket.settimeout(1)
+        threading.Thread(target=self.ServeRendezvous, daemon=True).start()
+        print(f"P2P rendezvous listening on UDP port {self.RendezvousPort}")
+
+    def ServeRendezvous(self):
+        rendezvous = self.RendezvousSocket
+        while self.Running:
+            try:
+                data, addr = rendezvous.recvfrom(2048)
+                message = json.loads(data.decode('utf-8'))
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            except ValueError:
+                continue
+            role = message.get('role')
+            if message.get('type') != 'register' or role not in ('service', 'visitor'):
+                continue
+            now = time.monotonic()
+            with self.P2PLock:
+                for sessionId in [sessionId for sessionId, session in self.P2PSessions.items() if session['expires'] < now]:
+                    del self.P2PSessions[sessionId]
+                session = self.P2PSessions.get(message.get('session'))
+                if not session or session['token'] != message.get('token'):
+                    continue
+                session['peers'][role] = addr
+                peers = dict(session['peers'])
+            if len(peers) < 2:
+                continue
+            # Each side learns the other's endpoint as observed from here, i.e. after its NAT
+            for role, peerAddr in peers.items():
+                other = peers['visitor' if role == 'service' else 'service']
+                reply = {'type': 'peer', 'session': message['session'], 'addr': list(other)}
+                try:
+                    rendezvous.sendto(json.dumps(reply).encode('utf-8'), peerAddr)
+                except OSError:
+                    pass
+
+    def AcceptVhostConnections(self):
+        while self.Running:
+            try:
+                conn, addr = self.VhostSocket.accept()
+                threading.Thread(target=self.DispatchVhostConnection, args=(conn, addr), daemon=True).start()
+            except Exception as e:
+                if self.Running:
+                    print(f"Vhost accept error: {e}")
+                    traceback.print_exc()
+
+    def DispatchVhostConnection(self, conn, addr):
+        acceptedAt = time.monotonic()
+        initialData = b''
+        host = None
+        memory = self.GlobalLimits.SendMemory
+        try:
+            conn.settimeout(self.VhostPeekTimeout)
+            while host is None and len(initialData) < self.VhostPeekLimit:
+                if not memory.WaitForRoom(lambda: not self.Running):
+                    break
+                data = conn.recv(4096)
+                if not data:
+                    break
+                memory.Charge(len(data))
+                initialData += data
+                if initialData[0] == 0x16:
+                    protocol, host = 'HTTPS', ParseTlsSni(initialData)
+                else:
+                    protocol, host = 'HTTP', ParseHttpHost(initialData)
+        except Exception:
+            pass
+        forward = host and self.VhostRouters[protocol].Match(host)
+        if not forward:
+            print(f"No vhost route for {host!r} from {addr[0]}:{addr[1]}")
+            try:
+                if host is not None and protocol == 'HTTP':
+                    conn.sendall(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                conn.close()
+            except:
+                pass
+            memory.Release(len(initialData))
+            return
+        if isinstance(forward, RemoteForward):
+            self.Cluster.Relay(forward.Node, {'forward_id': forward.Id}, conn, addr, initialData)
+            memory.Release(len(initialData))
+            return
+        if forward.Cache:
+            memory.Release(len(initialData))
+            self.ServeHttpEdge(forward, conn, addr, initialData)
+            return
+        self.OpenStream(forward, conn, addr, initialData, acceptedAt)
+        memory.Release(len(initialData))
+
+    def FindForward(self, forwardId):
+        for client in self.Registry.ListClients():
+            with client.Lock:
+                forward = client.Forwards.get(forwardId)
+            if forward:
+                return forward
+        return None
+
+    def OpenRelayedStream(self, message, addr):
+        # A peer node accepted a public connection for one of our forwards
+        if 'port' in message:
+            with self.GroupLock:
+                group = self.Groups.get(message['port'])
+            forward = group and group.Pick(addr[0])
+        else:
+            forward = self.FindForward(message.get('forward_id'))
+        if not forward:
+            return None
+        relayEnd, streamEnd = MemoryPipe()
+        initialData = bytes.fromhex(message.get('data', ''))
+        if forward.Cache and not message.get('port'):
+            threading.Thread(target=self.ServeHttpEdge, args=(forward, streamEnd, addr, initialData), daemon=True).start()
+        else:
+            self.OpenStream(forward, streamEnd, addr, initialData)
+        return relayEnd
+
+    def ServeHttpEdge(self, forward, conn, addr, initialData):
+        # Each cache miss travels over an ordinary tunnel stream opened through an in-memory pipe
+        def OpenUpstream():
+            edgeEnd, streamEnd = MemoryPipe()
+            edgeEnd.settimeout(self.HttpIdleTimeout)
+            self.OpenStream(forward, streamEnd, addr)
+            return edgeEnd
+
+        conn.settimeout(self.HttpIdleTimeout)
+        HttpEdge(forward.Cache, conn, initialData, OpenUpstream,
+                 lambda name, amount=1: self.CountStat(name, amount, forward), forward.Id).Run()
+
     def AcceptClients(self):
         while self.Running:
             try:
                 clientSocket, addr = self.ServerSocket.accept()
+                # Banned sources and handshake floods are turned away before they get a thread
+                reason = self.Handshake.Admit(addr[0])
+                if reason:
+                    self.CountStat(f'rejected_{reason}')
+                    self.Reject(clientSocket)
+                    continue
                 print(f"New client connection from {addr}")
-                clientThread = threading.Thread(target=self.HandleClient, args=(clientSocket, addr), daemon=True)
+                clientThread = threading.Thread(target=self.HandleClient, args=(clientSocket, addr, addr[0]), daemon=True)
                 clientThread.start()
             except Exception as e:
                 if self.Running:
                     print(f"Accept error: {e}")
                     traceback.print_exc()
 
-    def HandleClient(self, clientSocket, addr):
-        clientId = f"{addr[0]}:{addr[1]}"
-        self.Clients[clientId] = {'socket': clientSocket, 'forwards': {}, 'addr': addr, 'buffer': b''}
+    def StartUnix(self):
+        # Same-host clients skip the TCP/IP stack; a leftover socket file from a crashed run is replaced
+        self.RemoveUnixSocket()
+        self.UnixSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.UnixSocket.bind(self.UnixSocketPath)
+        self.UnixSocket.listen(self.AcceptBacklog)
+        print(f"Server listening on unix:{self.UnixSocketPath}")
+        threading.Thread(target=self.AcceptUnixClients, daemon=True).start()
+
+    def RemoveUnixSocket(self):
+        # Only a socket is removed, so a mistyped path cannot delete a regular file
+        try:
+            mode = os.lstat(self.UnixSocketPath).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"{self.UnixSocketPath} exists and is not a socket")
+        os.unlink(self.UnixSocketPath)
+
+    def AcceptUnixClients(self):
+        while self.Running:
+            try:
+                clientSocket, _ = self.UnixSocket.accept()
+                addr = ('unix', next(self.UnixSerial))
+                print(f"New client connection on unix:{self.UnixSocketPath}")
+                threading.Thread(target=self.HandleUnixClient, args=(clientSocket, addr), daemon=True).start()
+            except Exception as e:
+                if self.Running:
+                    print(f"Unix accept error: {e}")
+                    traceback.print_exc()
+
+    def HandleUnixClient(self, clientSocket, addr):
+        # A client may ask to move the tunnel into shared memory before its first frame;
+        # the socket then stays open only as the doorbell
+        try:
+            clientSocket.settimeout(10)
+            if clientSocket.recv(4, socket.MSG_PEEK) == b'SHM ':
+                line = b''
+                while not line.endswith(b'\n') and len(line) < 256:
+                    data = clientSocket.recv(1)
+                    if not data:
+                        break
+                    line += data
+                channel = AcceptSharedMemory(clientSocket, line)
+                if channel is None:
+                    clientSocket.close()
+                    return
+                clientSocket.settimeout(None)
+                self.CountStat('shm_tunnels')
+                clientSocket = channel
+        except OSError as e:
+            print(f"Unix handshake error: {e}")
+            clientSocket.close()
+            return
+        self.HandleClient(clientSocket, addr)
+
+    def Reject(self, sock):
+        # Reset instead of a graceful close so a rejected peer leaves no TIME_WAIT behind
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        sock.close()
+
+    def HandleClient(self, clientSocket, addr, source=None):
+        client = ClientRecord(f"{addr[0]}:{addr[1]}", clientSocket, addr, LimitSet(self.ClientLimits.get('default'), self.GlobalLimits))
+        self.Registry.AddClient(client)
+        memory = client.Limits.Memory
+        buffered = 0
+        # Until it authenticates the peer gets a deadline and a byte allowance, not the 30s idle loop
+        handshake = self.Handshake
+        deadline = time.monotonic() + handshake.Timeout
+        handshakeBytes = 0
+        failure = None
         try:
             while self.Running:
-                clientSocket.settimeout(30)
+                if client.Authenticated:
+                    clientSocket.settimeout(30)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        failure = 'handshake_timeout'
+                        break
+                    clientSocket.settimeout(min(30, remaining))
+                # Over budget: stop reading the tunnel until stream writes drain. A partial
+                # message keeps reading so it can complete and release what it holds.
+                if not buffered and not memory.WaitForRoom(lambda: not self.Running):
+                    break
                 try:
                     data = clientSocket.recv(4096)
                     if not data:
-                        print(f"Client {clientId} disconnected")
+                        print(f"Client {client.Id} disconnected")
+                        if not client.Authenticated:
+                            failure = client.Rejected or 'handshake_aborted'
+                        break
+                    if not client.Authenticated:
+                        handshakeBytes += len(data)
+                        if handshakeBytes > handshake.MaxBytes:
+                            failure = 'handshake_oversized'
+                            break
+                    client.Buffer += data
+                    buffered = memory.Resize(buffered, len(client.Buffer))
+                    self.ProcessBuffer(client)
+                    buffered = memory.Resize(buffered, len(client.Buffer))
+                    if source and client.Authenticated:
+                        handshake.Settle(source)
+                        handshake.Success(source)
+                        source = None
+                    maxMessage = min(self.MaxMessageSize, memory.Limit or self.MaxMessageSize)
+                    if len(client.Buffer) >= maxMessage:
+                        print(f"Client {client.Id} exceeded the {maxMessage}-byte message limit")
+                        self.CountStat('oversized_messages')
                         break
-                    self.Clients[clientId]['buffer'] += data
-                    self.ProcessBuffer(clientId)
                 except socket.timeout:
                     continue
                 except Exception as e:
-                    print(f"Client communication error: {e}")
-                    traceback.print_exc()
+                    if client.Authenticated:
+                        print(f"Client communication error: {e}")
+                        traceback.print_exc()
+                    else:
+                        failure = 'handshake_error'
                     break
         finally:
-            with self.ClientLocks[clientId]:
-                if clientId in self.Clients:
-                    del self.Clients[clientId]
-            with self.ForwardLocks[clientId]:
-                for forwardId in list(self.ForwardMap.keys()):
-                    if forwardId.startswith(clientId):
-                        del self.ForwardMap[forwardId]
+            memory.Release(buffered)
+            if client.Decoder:
+                client.Limits.StoreMemory.Release(client.Decoder.Store.MaxBytes)
+            if failure:
+                self.CountStat(failure)
+            if source:
+                handshake.Settle(source)
+                if self.Running and handshake.Failure(source):
+                    self.CountStat('handshake_bans')
+                    print(f"Banning {source} for {handshake.BanTime:g}s after repeated failed handshakes")
+            self.CleanupClient(client)
             try:
                 clientSocket.close()
             except:
                 pass
-            print(f"Client {clientId} handler cleaned up")
+            print(f"Client {client.Id} handler cleaned up")
 
-    def ProcessBuffer(self, clientId):
-        clientData = self.Clients.get(clientId)
-        if not clientData:
-            return
-        while self.MessageSeparator in clientData['buffer']:
-            msgEnd = clientData['buffer'].index(self.MessageSeparator)
-            messageData = clientData['buffer'][:msgEnd]
-            clientData['buffer'] = clientData['buffer'][msgEnd + len(self.MessageSeparator):]
+    def CleanupClient(self, client):
+        forwards, streams = self.Registry.RemoveClient(client)
+        for forward in forwards:
+            self.ReleaseForward(forward)
+        for stream in streams:
+            try:
+                stream.Socket.close()
+            except:
+                pass
+
+    def ProcessBuffer(self, client):
+        while self.MessageSeparator in client.Buffer:
+            msgEnd = client.Buffer.index(self.MessageSeparator)
+            messageData = client.Buffer[:msgEnd]
+            client.Buffer = client.Buffer[msgEnd + len(self.MessageSeparator):]
+            if self.Capture:
+                self.Capture.Write(CaptureIn, client.Serial, messageData)
             try:
                 message = json.loads(messageData.decode('utf-8'))
-                self.ProcessClientMessage(clientId, message)
-            except json.JSONDecodeError:
-                print(f"Invalid JSON from client {clientId}")
-                self.SendToClient(clientId, {'type': 'error', 'message': 'Invalid JSON'})
+            except ValueError:
+                message = None
+            # Anything but a JSON object counts as malformed, e.g. "1" or "[]"
+            if not isinstance(message, dict):
+                print(f"Invalid JSON from client {client.Id}")
+                if not client.Authenticated:
+                    self.DropHandshake(client)
+                    return
+                self.SendToClient(client, {'type': 'error', 'message': 'Invalid JSON'})
+                continue
+            try:
+                self.ProcessClientMessage(client, message)
             except Exception as e:
                 print(f"Error processing message: {e}")
                 traceback.print_exc()
 
-    def ProcessClientMessage(self, clientId, message):
-        if message.get('type') == 'auth':
-            self.HandleAuth(clientId, message)
-        elif message.get('type') == 'forward_request':
-            self.HandleForwardRequest(clientId, message)
+    def ProcessClientMessage(self, client, message):
+        if not client.Authenticated and message.get('type') != 'auth':
+            self.DropHandshake(client)
         elif message.get('type') == 'data':
-            self.HandleData(clientId, message)
+            self.HandleData(client, message)
+        elif message.get('type') == 'close_connection':
+            self.HandleCloseConnection(client, message)
+        elif message.get('type') == 'auth':
+            self.HandleAuth(client, message)
+        elif message.get('type') == 'forward_batch':
+            self.HandleForwardBatch(client, message)
+        elif message.get('type') == 'forward_request':
+            self.HandleForwardRequest(client, message)
         elif message.get('type') == 'close_forward':
-            self.HandleCloseForward(clientId, message)
+            self.HandleCloseForward(client, message)
+        elif message.get('type') == 'trace':
+            self.HandleTrace(client, message)
+        elif message.get('type') == 'visit':
+            self.HandleVisit(client, message)
         else:
-            self.SendToClient(clientId, {'type': 'error', 'message': 'Unknown message type'})
+            self.SendToClient(client, {'type': 'error', 'message': 'Unknown message type'})
 
-    def HandleAuth(self, clientId, message):
-        clientData = self.Clients.get(clientId)
-        if not clientData:
-            return
-        if message.get('key') == self.Key:
-            clientData['authenticated'] = True
-            self.SendToClient(clientId, {'type': 'auth_response', 'success': True})
-            print(f"Client {clientId} authenticated successfully")
+    def HandleAuth(self, client, message):
+        key = message.get('key')
+        if isinstance(key, str) and key in self.ClientKeys:
+            client.Authenticated = True
+            if key in self.ClientLimits:
+                client.Limits.Configure(self.ClientLimits[key])
+            client.Features = frozenset(message.get('features') or ())
+            response = {'type': 'auth_response', 'success': True, 'features': ['forward_batch']}
+            offer = message.get('dedup')
+            if isinstance(offer, dict) and self.DedupBytes > 0:
+                # Both ends size their stores alike, so evictions stay in step
+                size = client.Limits.StoreMemory.Reserve(min(int(offer.get('max_bytes') or 0), self.DedupBytes), MinStoreBytes)
+                if size > 0:
+                    client.Encoder, client.Decoder = DedupEncoder(size), DedupDecoder(size)
+                    response['dedup'] = {'max_bytes': size}
+            self.SendToClient(client, response)
+            print(f"Client {client.Id} authenticated successfully")
         else:
-            self.SendToClient(clientId, {'type': 'auth_response', 'success': False, 'message': 'Invalid key'})
-            clientData['socket'].close()
-            print(f"Client {clientId} failed authentication")
-
-    def HandleForwardRequest(self, clientId, message):
-        clientData = self.Clients.get(clientId)
-        if not clientData or not clientData.get('authenticated', False):
-            self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': 'Not authenticated'})
+            self.SendToClient(client, {'type': 'auth_response', 'success': False, 'message': 'Invalid key'})
+            self.DropHandshake(client, 'auth_failures')
+            print(f"Client {client.Id} failed authentication")
+
+    def DropHandshake(self, client, reason='handshake_protocol_errors'):
+        # Shutting down (not closing) lets the reader loop see EOF and book the failure
+        client.Rejected = reason
+        client.Buffer = b''
+        try:
+            client.Socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def SendForwardResponse(self, client, request, success, **fields):
+        response = {'type': 'forward_response', 'success': success}
+        if 'ref' in request:
+            response['ref'] = request['ref']
+        response.update(fields)
+        if isinstance(request, BatchedRequest):
+            request.Response = response
+            return
+        self.SendToClient(client, response)
+
+    def NewForward(self, forwardId, client, mode, limitKey, port=None, domains=None):
+        limits = LimitSet(self.ForwardLimits.get(limitKey, self.ForwardLimits.get('default')), client.Limits)
+        return ForwardRecord(forwardId, client, mode, limits, self.GlobalLimits, port, domains)
+
+    def HandleForwardRequest(self, client, message):
+        if not client.Authenticated:
+            self.SendForwardResponse(client, message, False, message='Not authenticated')
+            return
+        if len(client.Forwards) >= self.MaxPortsPerClient:
+            self.SendForwardResponse(client, message, False, message='Max ports per client reached')
             return
-        with self.ClientLocks[clientId]:
-            if len(clientData['forwards']) >= self.MaxPortsPerClient:
-                self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': 'Max ports per client reached'})
-                return
-        targetPort = message.get('target_port')
         mode = message.get('mode', 'tcp').upper()
-        if not self.IsPortAllowed(targetPort):
-            self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': 'Target port not allowed'})
+        if mode in self.VhostRouters:
+            self.HandleVhostForwardRequest(client, mode, message)
             return
-        forwardId = f"{clientId}:{targetPort}"
-        if forwardId in self.ForwardMap:
-            self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': 'Port already in use'})
+        if mode == 'P2P':
+            self.HandleP2PForwardRequest(client, message)
             return
+        if mode != 'TCP':
+            self.SendForwardResponse(client, message, False, message='Unsupported mode')
+            return
+        targetPort = message.get('target_port')
+        if type(targetPort) is not int:
+            self.SendForwardResponse(client, message, False, message='Invalid target port')
+            return
+        if targetPort != 0 and not self.IsPortAllowed(targetPort):
+            self.SendForwardResponse(client, message, False, message='Target port not allowed')
+            return
+        groupName = message.get('group')
+        sticky = message.get('sticky')
+        policy = str(message.get('balance', 'round_robin')).upper()
+        if policy not in ForwardGroup.Policies:
+            self.SendForwardResponse(client, message, False, message='Unknown balance policy')
+            return
+        created = False
+        forward = None
         try:
-            if mode == 'TCP':
-                forwardServer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                forwardServer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                forwardServer.bind(('0.0.0.0', targetPort))
-                forwardServer.listen(5)
-                with self.ClientLocks[clientId]:
-                    clientData['forwards'][forwardId] = {'server': forwardServer, 'mode': mode, 'connections': {}}
-                with self.ForwardLocks[clientId]:
-                    self.ForwardMap[forwardId] = clientId
-                threading.Thread(target=self.AcceptForwardConnections, args=(clientId, forwardId, forwardServer), daemon=True).start()
-                self.SendToClient(clientId, {'type': 'forward_response', 'success': True, 'target_port': targetPort, 'forward_id': forwardId})
-                print(f"Forward created: {forwardId}")
+            with self.GroupLock:
+                group = self.Groups.get(targetPort)
+                if group and (not groupName or group.Name != groupName):
+                    self.SendForwardResponse(client, message, False, message='Port already in use')
+                    return
+                forwardId = f"{client.Id}:{targetPort}"
+                if group and forwardId in client.Forwards:
+                    self.SendForwardResponse(client, message, False, message='Port already in use')
+                    return
+                if not group:
+                    if targetPort == 0:
+                        targetPort = self.PortAllocator.Allocate(sticky)
+                        if targetPort is None:
+                            self.SendForwardResponse(client, message, False, message='No free port available')
+                            return
+                        forwardId = f"{client.Id}:{targetPort}"
+                    elif not self.PortAllocator.Claim(targetPort, sticky):
+                        self.SendForwardResponse(client, message, False, message='Port already in use')
+                        return
+                    created = True
+                    group = ForwardGroup(groupName, targetPort, None, policy)
+                    group.Sticky = sticky
+                    self.Groups[targetPort] = group
+                    self.PortAllocator.SetOwner(targetPort, group)
+                forward = self.NewForward(forwardId, client, mode, str(targetPort), port=targetPort)
+                forward.Dedup = bool(message.get('dedup'))
+                forward.Group = group
+                self.Registry.AddForward(forward)
+                group.Add(forward)
+            # The listener is bound outside the group lock so a batch of registrations binds in parallel
+            if created:
+                self.BindForwardListener(group)
+            elif not group.Ready.wait(5) or not group.Server:
+                raise OSError(f"Listener for port {targetPort} could not be opened")
+            self.SendForwardResponse(client, message, True, target_port=targetPort, forward_id=forwardId, group=groupName)
+            # Visitors wait in the listen backlog until the client knows the forward id they arrive for
+            if created and isinstance(message, BatchedRequest):
+                message.Listener = group
+            elif created:
+                self.StartAccepting(group)
+            if created and self.Cluster:
+                self.Cluster.AnnouncePort(targetPort)
+            if groupName:
+                print(f"Forward created: {forwardId} (group {groupName}, {len(group.Members)} members)")
             else:
-                self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': 'Unsupported mode'})
+                print(f"Forward created: {forwardId}")
         except Exception as e:
             print(f"Forward creation error: {e}")
             traceback.print_exc()
-            self.SendToClient(clientId, {'type': 'forward_response', 'success': False, 'message': str(e)})
+            if forward is not None:
+                self.Registry.RemoveForward(client, forward.Id)
+                self.ReleaseForward(forward)
+            self.SendForwardResponse(client, message, False, message=str(e))
 
-    def AcceptForwardConnections(self, clientId, forwardId, forwardServer):
+    def BindForwardListener(self, group):
+        forwardServer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            while self.Running and forwardId in self.ForwardMap and self.ForwardMap[forwardId] == clientId:
-                forwardServer.settimeout(1)
+            forwardServer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            forwardServer.bind((self.BindAddress, group.Port))
+            self.ListenPublic(forwardServer)
+        except Exception:
+            forwardServer.close()
+            group.Ready.set()
+            raise
+        group.Server = forwardServer
+        group.Ready.set()
+
+    def StartAccepting(self, group):
+        if self.GroupActive(group):
+            threading.Thread(target=self.AcceptForwardConnections, args=(group,), daemon=True).start()
+
+    def HandleForwardBatch(self, client, message):
+        requests = [BatchedRequest(request) for request in message.get('requests') or [] if isinstance(request, dict)]
+        room = self.MaxPortsPerClient - len(client.Forwards)
+        accepted, refused = requests[:max(room, 0)], requests[max(room, 0):]
+        for request in refused:
+            self.SendForwardResponse(client, request, False, message='Max ports per client reached')
+
+        def Register(request):
+            try:
+                self.HandleForwardRequest(client, request)
+            except Exception as e:
+                self.SendForwardResponse(client, request, False, message=str(e))
+
+        if accepted:
+            with ThreadPoolExecutor(max_workers=min(self.BindWorkers, len(accepted))) as pool:
+                list(pool.map(Register, accepted))
+        self.SendToClient(client, {'type': 'forward_batch_response', 'results': [request.Response for request in requests]})
+        for request in requests:
+            if request.Listener and request.Response.get('success'):
+                self.StartAccepting(request.Listener)
+        print(f"Forward batch from {client.Id}: {sum(1 for request in requests if request.Response.get('success'))}/{len(requests)} created")
+
+    def HandleVhostForwardRequest(self, client, mode, message):
+        domains = message.get('domains') or []
+        if not self.VhostSocket:
+            self.SendForwardResponse(client, message, False, domains=domains, message='Vhost mode not enabled')
+            return
+        if not domains or not all(isinstance(domain, str) and domain for domain in domains):
+            self.SendForwardResponse(client, message, False, domains=domains, message='No domains given')
+            return
+        forwardId = f"{client.Id}:{mode.lower()}:{domains[0]}"
+        forward = self.NewForward(forwardId, client, mode, domains[0], domains=domains)
+        forward.Dedup = bool(message.get('dedup'))
+        if mode == 'HTTP' and message.get('cache'):
+            forward.Cache = self.HttpCache
+        router = self.VhostRouters[mode]
+        added = []
+        for domain in domains:
+            if not router.Add(domain, forward):
+                for previous in added:
+                    router.Remove(previous)
+                self.SendForwardResponse(client, message, False, domains=domains, message=f'Domain {domain} already in use')
+                return
+            added.append(domain)
+        self.Registry.AddForward(forward)
+        self.SendForwardResponse(client, message, True, domains=domains, forward_id=forwardId)
+        if self.Cluster:
+            self.Cluster.AnnounceVhost(forward)
+        print(f"Vhost forward created: {forwardId}")
+
+    def HandleP2PForwardRequest(self, client, message):
+        name = message.get('name')
+        if not name or not isinstance(name, str):
+            self.SendForwardResponse(client, message, False, message='No service name given')
+            return
+        forwardId = f"{client.Id}:p2p:{name}"
+        forward = self.NewForward(forwardId, client, 'P2P', name, domains=[name])
+        with self.P2PLock:
+            if name in self.P2PServices:
+                self.SendForwardResponse(client, message, False, name=name, message=f'Service {name} already registered')
+                return
+            self.P2PServices[name] = (forward, message.get('secret'))
+        self.Registry.AddForward(forward)
+        self.SendForwardResponse(client, message, True, name=name, forward_id=forwardId)
+        print(f"P2P service registered: {forwardId}")
+
+    def HandleVisit(self, client, message):
+        response = {'type': 'visit_response', 'ref': message.get('ref'), 'success': False}
+        with self.P2PLock:
+            service, secret = self.P2PServices.get(message.get('name'), (None, None))
+        if not client.Authenticated or not service or message.get('secret') != secret:
+            response['message'] = 'Unknown service'
+            self.SendToClient(client, response)
+            return
+        if message.get('direct') and self.RendezvousSocket:
+            sessionId = secrets.token_hex(8)
+            token = secrets.token_hex(8)
+            with self.P2PLock:
+                self.P2PSessions[sessionId] = {'token': token, 'peers': {}, 'expires': time.monotonic() + self.P2PSessionTimeout}
+            offer = {'session': sessionId, 'token': token, 'rendezvous_port': self.RendezvousPort}
+            self.SendToClient(service.Client, dict(offer, type='p2p_offer', forward_id=service.Id))
+            response.update(offer, success=True, mode='direct')
+            self.SendToClient(client, response)
+            self.CountStat('p2p_sessions', 1, service)
+            return
+        # Relay fallback: bridge a visitor stream and a service stream through an in-memory pipe
+        serviceEnd, visitorEnd = MemoryPipe()
+        stream = self.AdmitStream(self.VisitorForward(client), visitorEnd, client.Addr)
+        if not stream:
+            response['message'] = 'Connection rejected'
+            self.SendToClient(client, response)
+            return
+        response.update(success=True, mode='relay', stream_id=stream.Id)
+        self.SendToClient(client, response)
+        threading.Thread(target=self.ForwardToClient, args=(stream,), daemon=True).start()
+        self.OpenStream(service, serviceEnd, client.Addr)
+        self.CountStat('p2p_relayed', 1, service)
+
+    def VisitorForward(self, client):
+        forwardId = f"{client.Id}:visitor"
+        forward = client.Forwards.get(forwardId)
+        if forward:
+            return forward
+        forward = self.NewForward(forwardId, client, 'VISITOR', 'visitor')
+        if not self.Registry.AddForward(forward):
+            return client.Forwards.get(forwardId)
+        return forward
+
+    def ReleaseForward(self, forward):
+        if forward.Mode in self.VhostRouters:
+            for domain in forward.Domains:
+                self.VhostRouters[forward.Mode].Remove(domain, forward)
+            if forward.Cache:
+                forward.Cache.Purge(forward.Id)
+            if self.Cluster:
+                self.Cluster.WithdrawVhost(forward)
+        elif forward.Mode == 'P2P':
+            with self.P2PLock:
+                if self.P2PServices.get(forward.Domains[0], (None,))[0] is forward:
+                    del self.P2PServices[forward.Domains[0]]
+        group = forward.Group
+        if group:
+            withdrawn = False
+            with self.GroupLock:
+                remaining = group.Remove(forward)
+                if not remaining and self.Groups.get(group.Port) is group:
+                    del self.Groups[group.Port]
+                    self.PortAllocator.Release(group.Port, group.Sticky)
+                    withdrawn = True
+                    if group.Server:
+                        try:
+                            # shutdown wakes the blocked accept() so the port is free to bind again right away
+                            group.Server.shutdown(socket.SHUT_RDWR)
+                        except:
+                            pass
+                        try:
+                            group.Server.close()
+                        except:
+                            pass
+            # Outside GroupLock: the cluster lock must never be taken while it is held
+            if withdrawn and self.Cluster:
+                self.Cluster.WithdrawPort(group.Port)
+
+    def GroupActive(self, group):
+        with self.GroupLock:
+            return self.Groups.get(group.Port) is group
+
+    def AcceptForwardConnections(self, group):
+        forwardServer = group.Server
+        selector = selectors.DefaultSelector()
+        try:
+            try:
+                forwardServer.setblocking(False)
+                selector.register(forwardServer, selectors.EVENT_READ)
+            except (OSError, ValueError):
+                # Released (and closed) between registration and here
+                if self.GroupActive(group):
+                    raise
+                return
+            while self.Running and self.GroupActive(group):
                 try:
-                    conn, addr = forwardServer.accept()
-                    connId = f"{addr[0]}:{addr[1]}"
-                    print(f"New connection to forward {forwardId} from {connId}")
-                    with self.ClientLocks[clientId]:
-                        clientData = self.Clients.get(clientId)
-                        if not clientData or forwardId not in clientData['forwards']:
-                            conn.close()
-                            continue
-                        clientData['forwards'][forwardId]['connections'][connId] = conn
-                    self.SendToClient(clientId, {
-                        'type': 'new_connection',
-                        'forward_id': forwardId,
-                        'conn_id': connId
-                    })
-                    threading.Thread(target=self.ForwardToClient, args=(clientId, forwardId, connId, conn), daemon=True).start()
-                except socket.timeout:
-                    continue
+                    if selector.select(1):
+                        self.OpenStreams(group, self.DrainAccept(forwardServer))
                 except Exception as e:
-                    print(f"Forward accept error: {e}")
-                    traceback.print_exc()
+                    if self.GroupActive(group):
+                        print(f"Forward accept error: {e}")
+                        traceback.print_exc()
         finally:
+            selector.close()
             try:
                 forwardServer.close()
             except:
                 pass
-            print(f"Forward listener {forwardId} stopped")
+            print(f"Forward listener on port {group.Port} stopped")
+
+    def DrainAccept(self, listener):
+        accepted = []
+        while len(accepted) < self.AcceptBatch:
+            try:
+                conn, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            conn.setblocking(True)
+            accepted.append((conn, addr))
+        return accepted
 
-    def ForwardToClient(self, clientId, forwardId, connId, conn):
+    def AdmitStream(self, forward, conn, addr, acceptedAt=None):
+        reason = self.AdmitConnection(forward.LimitChain)
+        if reason:
+            conn.close()
+            self.CountStat(f'rejected_{reason}', 1, forward)
+            print(f"Connection {addr[0]}:{addr[1]} to forward {forward.Id} rejected: {reason}")
+            return None
+        stream = self.Registry.AddStream(forward, conn)
+        if not stream:
+            self.ReleaseConnection(forward.LimitChain)
+            conn.close()
+            return None
+        self.CountStat('accepted_connections', 1, forward)
+        if self.Tracing:
+            now = time.monotonic()
+            stream.Trace = {'peer': f"{addr[0]}:{addr[1]}", 'events': {'accept': acceptedAt or now, 'admitted': now}}
+        return stream
+
+    def GrabEarlyData(self, stream):
+        # Whatever the visitor has already sent rides along with the announcement, so the
+        # client can start on the request as soon as its target connects
+        conn = stream.Socket
+        if not stream.EarlyData and conn.fileno() >= 0:
+            try:
+                stream.EarlyData = conn.recv(self.EarlyDataSize, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                # Leave the error for ForwardToClient to run into
+                pass
+        if stream.EarlyData:
+            self.MarkTrace(stream, 'first_byte_in')
+
+    def AnnounceStreams(self, client, streams):
+        extra = {'trace': True} if self.Tracing else {}
+        early = 'early_data' in client.Features
+        for stream in streams:
+            self.GrabEarlyData(stream)
+        if len(streams) > 1 and 'new_connections' in client.Features:
+            entries = []
+            for stream in streams:
+                self.MarkTrace(stream, 'announce')
+                entry = [stream.Forward.Id, stream.Id]
+                if early and stream.EarlyData:
+                    entry.append(stream.EarlyData.hex())
+                entries.append(entry)
+            self.SendToClient(client, dict({'type': 'new_connections', 'streams': entries}, **extra))
+            for stream in streams:
+                self.MarkTrace(stream, 'announced')
+            return
+        for stream in streams:
+            self.MarkTrace(stream, 'announce')
+            message = dict({
+                'type': 'new_connection',
+                'forward_id': stream.Forward.Id,
+                'stream_id': stream.Id
+            }, **extra)
+            if early and stream.EarlyData:
+                message['data'] = stream.EarlyData.hex()
+            self.SendToClient(client, message)
+            self.MarkTrace(stream, 'announced')
+
+    def OpenStream(self, forward, conn, addr, initialData=b'', acceptedAt=None):
+        stream = self.AdmitStream(forward, conn, addr, acceptedAt)
+        if not stream:
+            return
+        stream.EarlyData = initialData
+        print(f"New connection {stream.Id} to forward {forward.Id} from {addr[0]}:{addr[1]}")
+        self.AnnounceStreams(forward.Client, [stream])
+        threading.Thread(target=self.ForwardToClient, args=(stream,), daemon=True).start()
+
+    def OpenStreams(self, group, accepted):
+        if len(accepted) == 1:
+            conn, addr = accepted[0]
+            forward = group.Pick(addr[0])
+            if forward:
+                self.OpenStream(forward, conn, addr)
+            else:
+                conn.close()
+            return
+        # Register a whole accept batch first, then announce it with one frame per client
+        batches = {}
+        for conn, addr in accepted:
+            forward = group.Pick(addr[0])
+            if not forward:
+                conn.close()
+                continue
+            stream = self.AdmitStream(forward, conn, addr)
+            if stream:
+                batches.setdefault(forward.Client, []).append(stream)
+        for client, streams in batches.items():
+            print(f"New connections {streams[0].Id}-{streams[-1].Id} ({len(streams)}) on port {group.Port}")
+            self.AnnounceStreams(client, streams)
+            for stream in streams:
+                threading.Thread(target=self.ForwardToClient, args=(stream,), daemon=True).start()
+
+    def ForwardToClient(self, stream):
+        forward = stream.Forward
+        client = forward.Client
+        conn = stream.Socket
+        memory = forward.Limits.SendMemory
+        stopping = lambda: not self.Running or stream.Id not in client.Streams
+        cutter = StreamCutter(self.Chunker) if forward.Dedup and client.Encoder else None
+        readSize = self.DedupReadSize if cutter else 4096
         try:
+            if stream.EarlyData:
+                self.ThrottleBytes(forward, len(stream.EarlyData))
+                if 'early_data' in client.Features:
+                    self.CountStat('early_data_bytes', len(stream.EarlyData), forward)
+                else:
+                    self.SendToClient(client, {'type': 'data', 'stream_id': stream.Id, 'data': stream.EarlyData.hex()})
+                stream.EarlyData = b''
+            conn.settimeout(1)
             while self.Running:
-                conn.settimeout(1)
+                if not memory.WaitForRoom(stopping):
+                    break
                 try:
-                    data = conn.recv(4096)
+                    data = conn.recv(readSize)
                     if not data:
+                        if cutter:
+                            self.SendChunks(client, stream.Id, cutter.Flush())
                         break
-                    self.SendToClient(clientId, {
-                        'type': 'data',
-                        'forward_id': forwardId,
-                        'conn_id': connId,
-                        'data': data.hex()
-                    })
+                    self.MarkTrace(stream, 'first_byte_in')
+                    memory.Charge(len(data))
+                    try:
+                        self.ThrottleBytes(forward, len(data))
+                        if cutter:
+                            self.SendChunks(client, stream.Id, cutter.Feed(data, Queued(conn)))
+                        else:
+                            self.SendToClient(client, {'type': 'data', 'stream_id': stream.Id, 'data': data.hex()})
+                    finally:
+                        memory.Release(len(data))
                 except socket.timeout:
-                    if not self.Running or clientId not in self.Clients:
+                    if not self.Running or stream.Id not in client.Streams:
                         break
                     continue
                 except Exception as e:
-                    print(f"Forward to client error: {e}")
-                    traceback.print_exc()
+                    if stream.Id in client.Streams:
+                        print(f"Forward to client error: {e}")
+                        traceback.print_exc()
                     break
         finally:
+            if stream.Writer:
+                stream.Outbox.put(None)
+                stream.Writer.join()
             try:
                 conn.close()
             except:
                 pass
-            with self.ClientLocks[clientId]:
-                clientData = self.Clients.get(clientId)
-                if clientData and forwardId in clientData['forwards']:
-                    if connId in clientData['forwards'][forwardId]['connections']:
-                        del clientData['forwards'][forwardId]['connections'][connId]
-            self.SendToClient(clientId, {
-                'type': 'close_connection',
-                'forward_id': forwardId,
-                'conn_id': connId
-            })
-            print(f"Connection {connId} to forward {forwardId} closed")
-
-    def HandleData(self, clientId, message):
-        forwardId = message.get('forward_id')
-        connId = message.get('conn_id')
-        dataHex = message.get('data')
-        if not all([forwardId, connId, dataHex]):
-            return
+            self.ReleaseConnection(forward.LimitChain)
+            if self.Registry.RemoveStream(stream):
+                self.SendToClient(client, {'type': 'close_connection', 'stream_id': stream.Id})
+            self.MarkTrace(stream, 'close')
+            self.FinishTrace(stream)
+            print(f"Connection {stream.Id} to forward {forward.Id} closed")
+
+    def SendChunks(self, client, streamId, chunks):
+        if chunks:
+            self.SendToClient(client, *DataMessage(streamId, chunks))
+
+    def DropUndecodable(self, client, stream):
+        print(f"Client {client.Id} referenced a chunk it never sent")
+        if stream and self.Registry.RemoveStream(stream):
+            try:
+                stream.Socket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            self.SendToClient(client, {'type': 'close_connection', 'stream_id': stream.Id})
+
+    def HandleData(self, client, message):
+        stream = client.Streams.get(message.get('stream_id'))
         try:
-            data = bytes.fromhex(dataHex)
-            with self.ClientLocks[clientId]:
-                clientData = self.Clients.get(clientId)
-                if not clientData or forwardId not in clientData['forwards']:
-                    return
-                forwardData = clientData['forwards'][forwardId]
-                if connId not in forwardData['connections']:
-                    return
-                conn = forwardData['connections'][connId]
-                conn.sendall(data)
+            data = MessageData(message, client.Decoder)
+            if data is None:
+                self.DropUndecodable(client, stream)
+                return
+            if not stream or not data:
+                return
+            if stream.Outbox is not None or any(limits.Bytes for limits in stream.Forward.LimitChain):
+                self.QueueToStream(stream, data)
+                return
+            stream.Socket.sendall(data)
+            self.MarkTrace(stream, 'first_byte_out')
         except Exception as e:
             print(f"Data handling error: {e}")
             traceback.print_exc()
 
-    def HandleCloseForward(self, clientId, message):
+    def QueueToStream(self, stream, data):
+        # A bandwidth-limited stream is paced on its own writer thread, so its delay
+        # holds up neither the tunnel reader nor the client's other streams
+        stream.Forward.Limits.Memory.Charge(len(data))
+        if stream.Outbox is None:
+            stream.Outbox = queue.SimpleQueue()
+            stream.Writer = threading.Thread(target=self.DrainStream, args=(stream,), daemon=True)
+            stream.Writer.start()
+        stream.Outbox.put(data)
+
+    def DrainStream(self, stream):
+        memory = stream.Forward.Limits.Memory
+        failed = False
+        while True:
+            try:
+                data = stream.Outbox.get(timeout=1)
+            except queue.Empty:
+                if stream.Id in stream.Forward.Client.Streams:
+                    continue
+                break
+            if data is None:
+                break
+            try:
+                if not failed:
+                    self.ThrottleBytes(stream.Forward, len(data))
+                    stream.Socket.sendall(data)
+                    self.MarkTrace(stream, 'first_byte_out')
+            except OSError:
+                failed = True
+            finally:
+                memory.Release(len(data))
+        try:
+            stream.Socket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+    def HandleCloseConnection(self, client, message):
+        stream = client.Streams.get(message.get('stream_id'))
+        if stream and self.Registry.RemoveStream(stream):
+            if stream.Outbox is not None:
+                # The writer shuts the socket down once the queued data is out
+                stream.Outbox.put(None)
+                return
+            try:
+                stream.Socket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
+    def MarkTrace(self, stream, event):
+        # setdefault keeps the first mark when two threads race on the same event
+        if stream.Trace is not None:
+            stream.Trace['events'].setdefault(event, time.monotonic())
+
+    def FinishTrace(self, stream):
+        trace = stream.Trace
+        if trace is None:
+            return
+        events = trace['events']
+        start = events['accept']
+        key = (stream.Forward.Client.Id, stream.Id)
+        # Slow means a long wait for the first response byte, or a long life without one
+        if (events.get('first_byte_out', events.get('close', start)) - start) * 1000 < self.TraceSlowMs:
+            with self.TraceLock:
+                self.TraceParts.pop(key, None)
+            return
+        self.CountStat('slow_streams', 1, stream.Forward)
+        entry = {
+            'stream_id': stream.Id,
+            'forward_id': stream.Forward.Id,
+            'client_id': stream.Forward.Client.Id,
+            'peer': trace['peer'],
+            'started': round(time.time() - (time.monotonic() - start), 3),
+            'server': {name: round((when - start) * 1000, 2) for name, when in events.items()}
+        }
+        with self.TraceLock:
+            part = self.TraceParts.pop(key, None)
+            if part is not None:
+                entry['client'] = part
+            self.Traces[key] = entry
+            while len(self.Traces) > self.TraceBuffer:
+                self.Traces.popitem(last=False)
+
+    def HandleTrace(self, client, message):
+        events = message.get('events')
+        if not isinstance(events, dict):
+            return
+        key = (client.Id, message.get('stream_id'))
+        with self.TraceLock:
+            # The client reports after its side closes, which may be before or after ours
+            if key in self.Traces:
+                self.Traces[key]['client'] = events
+                return
+            self.TraceParts[key] = events
+            while len(self.TraceParts) > self.TraceBuffer * 4:
+                self.TraceParts.popitem(last=False)
+
+    def GetTraces(self):
+        with self.TraceLock:
+            entries = [dict(entry) for entry in self.Traces.values()]
+        return [StitchTrace(entry) for entry in entries]
+
+    def DumpTraces(self, path=None):
+        traces = self.GetTraces()
+        if not path:
+            print(json.dumps(traces, indent=2))
+            return
+        with open(path, 'w') as f:
+            json.dump(traces, f, indent=2)
+        print(f"Wrote {len(traces)} traces to {path}")
+
+    def HandleCloseForward(self, client, message):
         forwardId = message.get('forward_id')
         if not forwardId:
             return
-        with self.ClientLocks[clientId]:
-            clientData = self.Clients.get(clientId)
-            if clientData and forwardId in clientData['forwards']:
-                try:
-                    clientData['forwards'][forwardId]['server'].close()
-                except:
-                    pass
-                del clientData['forwards'][forwardId]
-        with self.ForwardLocks[clientId]:
-            if forwardId in self.ForwardMap:
-                del self.ForwardMap[forwardId]
+        forward, streams = self.Registry.RemoveForward(client, forwardId)
+        if not forward:
+            return
+        self.ReleaseForward(forward)
+        for stream in streams:
+            try:
+                stream.Socket.close()
+            except:
+                pass
         print(f"Forward {forwardId} closed by client")
 
-    def SendToClient(self, clientId, message):
+    def SendToClient(self, client, message, chunks=None):
         try:
-            with self.ClientLocks[clientId]:
-                clientData = self.Clients.get(clientId)
-                if not clientData or not clientData['socket']:
-                    return
-                clientSocket = clientData['socket']
-                data = json.dumps(message).encode('utf-8') + self.MessageSeparator
-                clientSocket.sendall(data)
+            if chunks is None:
+                frame = json.dumps(message).encode('utf-8')
+            with client.SendLock:
+                if chunks is not None:
+                    frame = client.Encoder.Frame(message, chunks)
+                if self.Capture:
+                    self.Capture.Write(CaptureOut, client.Serial, frame)
+                client.Socket.sendall(frame + self.MessageSeparator)
         except Exception as e:
-            print(f"Error sending to client {clientId}: {e}")
-            traceback.print_exc()
+            if client.Id in self.Registry.Clients:
+                print(f"Error sending to client {client.Id}: {e}")
+                traceback.print_exc()
 
 def main():
     config = {
         "InternalDataPort": 5000,
         "AllowedPortRange": "5001-5500",
         "MaxPortsPerClient": 5,
-        "Key": "07A36AEF1907843"
+        "Key": "07A36AEF1907843",
+        "Keys": [],
+        "Limits": {},
+        "ClientLimits": {},
+        "ForwardLimits": {},
+        "VhostPort": 0,
+        "StickyTimeout": 300,
+        "Capture": None,
+        "AcceptBacklog": 1024,
+        "DeferAccept": 0,
+        "FastOpen": 0,
+        "RendezvousPort": 0,
+        "HttpCache": {},
+        "Tracing": None,
+        "BindAddress": "0.0.0.0",
+        "Cluster": None,
+        "UnixSocketPath": None,
+        "Handshake": {},
+        "Dedup": {}
     }
     if len(sys.argv) > 1:
         try:
@@ -335,7 +1872,25 @@ def main():
         InternalDataPort=int(config["InternalDataPort"]),
         AllowedPortRange=config["AllowedPortRange"],
         MaxPortsPerClient=int(config["MaxPortsPerClient"]),
-        Key=config["Key"]
+        Key=config["Key"],
+        Limits=config["Limits"],
+        ClientLimits=config["ClientLimits"],
+        ForwardLimits=config["ForwardLimits"],
+        VhostPort=int(config["VhostPort"]),
+        StickyTimeout=int(config["StickyTimeout"]),
+        Capture=config["Capture"],
+        AcceptBacklog=int(config["AcceptBacklog"]),
+        DeferAccept=int(config["DeferAccept"]),
+        FastOpen=int(config["FastOpen"]),
+        RendezvousPort=int(config["RendezvousPort"]),
+        HttpCache=config["HttpCache"],
+        Tracing=config["Tracing"],
+        BindAddress=config["BindAddress"],
+        Cluster=config["Cluster"],
+        UnixSocketPath=config["UnixSocketPath"],
+        Handshake=config["Handshake"],
+        Dedup=config["Dedup"],
+        Keys=config["Keys"]
     )
     server.Start()
 
@@ -0,0 +1,468 @@
+import os
+import socket
+import threading
+import errno
+import itertools
+import time
+import struct
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+class MemoryChannel:
+    def __init__(self, Name, Capacity=1048576):
+        self.Name = Name
+        self.Capacity = Capacity
+        self.Peer = None
+        self.Chunks = deque()
+        self.Queued = 0
+        self.Timeout = None
+        self.Closed = False
+        self.ReadShut = False
+        self.WriteShut = False
+        self.Condition = threading.Condition()
+
+    def __repr__(self):
+        return f"<MemoryChannel {self.Name}>"
+
+    def fileno(self):
+        return -1
+
+    def getpeername(self):
+        return (self.Peer.Name, 0)
+
+    def settimeout(self, timeout):
+        self.Timeout = timeout
+
+    def gettimeout(self):
+        return self.Timeout
+
+    def setblocking(self, flag):
+        self.Timeout = None if flag else 0.0
+
+    def Wait(self, condition, predicate, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout('timed out')
+            condition.wait(remaining)
+
+    def recv(self, bufsize, flags=0):
+        with self.Condition:
+            self.Wait(self.Condition, lambda: self.Chunks or self.ReadShut or self.Closed, self.Timeout)
+            if self.Closed:
+                raise OSError(errno.EBADF, 'Bad file descriptor')
+            if not self.Chunks:
+                return b''
+            chunk = self.Chunks.popleft()
+            if len(chunk) > bufsize:
+                self.Chunks.appendleft(chunk[bufsize:])
+                chunk = chunk[:bufsize]
+            self.Queued -= len(chunk)
+            self.Condition.notify_all()
+            return chunk
+
+    def sendall(self, data, flags=0):
+        if self.Closed:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+        if self.WriteShut:
+            raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+        peer = self.Peer
+        data = bytes(data)
+        with peer.Condition:
+            # Behaves like a full socket buffer: block the writer until the reader catches up
+            self.Wait(peer.Condition, lambda: peer.Queued < self.Capacity or peer.Closed or peer.ReadShut, self.Timeout)
+            if peer.Closed or peer.ReadShut:
+                raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+            peer.Chunks.append(data)
+            peer.Queued += len(data)
+            peer.Condition.notify_all()
+
+    def send(self, data, flags=0):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            with self.Condition:
+                self.ReadShut = True
+                self.Condition.notify_all()
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self.WriteShut = True
+            with self.Peer.Condition:
+                self.Peer.ReadShut = True
+                self.Peer.Condition.notify_all()
+
+    def close(self):
+        if self.Closed:
+            return
+        with self.Condition:
+            self.Closed = True
+            self.Chunks.clear()
+            self.Condition.notify_all()
+        with self.Peer.Condition:
+            self.Peer.ReadShut = True
+            self.Peer.Condition.notify_all()
+
+MemoryPipeIds = itertools.count(1)
+MemoryPipeLock = threading.Lock()
+
+def MemoryPipe(Capacity=1048576):
+    with MemoryPipeLock:
+        pipeId = next(MemoryPipeIds)
+    left = MemoryChannel(f"memory-{pipeId}a", Capacity)
+    right = MemoryChannel(f"memory-{pipeId}b", Capacity)
+    left.Peer = right
+    right.Peer = left
+    return left, right
+
+class MemoryBudget:
+    def __init__(self, Limit=0, Parent=None):
+        self.Limit = int(Limit or 0)
+        self.Parent = Parent
+        self.Used = 0
+        self.Peak = 0
+        self.Pauses = 0
+        # Each level has its own lock, so streams under different clients and forwards only
+        # meet on the levels they share; a waiter sleeps on the level that is full
+        self.Lock = threading.Lock()
+        self.Condition = threading.Condition(self.Lock)
+
+    def Chain(self):
+        budget = self
+        while budget:
+            yield budget
+            budget = budget.Parent
+
+    def Full(self):
+        return self.Limit and self.Used >= self.Limit
+
+    def Exhausted(self):
+        return any(budget.Full() for budget in self.Chain())
+
+    def WaitForRoom(self, cancel=None):
+        paused = False
+        while True:
+            full = next((budget for budget in self.Chain() if budget.Full()), None)
+            if full is None:
+                return True
+            with full.Condition:
+                if not full.Full():
+                    continue
+                if not paused:
+                    full.Pauses += 1
+                    paused = True
+                if cancel and cancel():
+                    return False
+                full.Condition.wait(1)
+
+    def Charge(self, amount):
+        if not amount:
+            return
+        for budget in self.Chain():
+            with budget.Lock:
+                budget.Used += amount
+                if budget.Used > budget.Peak:
+                    budget.Peak = budget.Used
+
+    def Release(self, amount):
+        if not amount:
+            return
+        for budget in self.Chain():
+            with budget.Lock:
+                full = budget.Full()
+                budget.Used -= amount
+                # Waiters only sleep on a full level, so only a drop below the limit wakes them
+                if full and not budget.Full():
+                    budget.Condition.notify_all()
+
+    def Reserve(self, amount, minimum=1):
+        """Charges as much of amount as every level has room for, without waiting.
+        Returns what was charged, or 0 (charging nothing) if that is under minimum."""
+        chain = list(self.Chain())
+        # Locks are always nested from the leaf up, so two reservations cannot deadlock
+        for budget in chain:
+            budget.Lock.acquire()
+        try:
+            for budget in chain:
+                if budget.Limit:
+                    amount = min(amount, budget.Limit - budget.Used)
+            if amount < max(minimum, 1):
+                return 0
+            for budget in chain:
+                budget.Used += amount
+                budget.Peak = max(budget.Peak, budget.Used)
+            return amount
+        finally:
+            for budget in reversed(chain):
+                budget.Lock.release()
+
+    def Resize(self, old, new):
+        if new > old:
+            self.Charge(new - old)
+        else:
+            self.Release(old - new)
+        return new
+
+    def Snapshot(self):
+        return {'used': self.Used, 'limit': self.Limit, 'peak': self.Peak, 'pauses': self.Pauses}
+
+# Shared-memory tunnel: one single-producer/single-consumer ring per direction, with
+# the Unix socket the tunnel was negotiated on kept as a doorbell for sleeping peers.
+# Native format on purpose: both ends share one machine, and native fields are copied whole
+# while the standard '<' formats assemble them byte by byte, letting a reader see a torn head.
+RingHeader = struct.Struct('QQII')  # head, tail, reader waiting, writer waiting
+RingHeaderSize = 64
+DoorbellData = b'd'
+DoorbellSpace = b's'
+# time.sleep(0) costs a timer-slack wakeup (~50us on Linux); sched_yield just gives up the CPU
+Yield = getattr(os, 'sched_yield', lambda: time.sleep(0))
+
+class SharedRing:
+    def __init__(self, Buffer, Offset, Capacity):
+        self.Header = Buffer[Offset:Offset + RingHeaderSize]
+        self.Data = Buffer[Offset + RingHeaderSize:Offset + RingHeaderSize + Capacity]
+        self.Capacity = Capacity
+
+    def State(self):
+        return RingHeader.unpack_from(self.Header)
+
+    def SetHead(self, head):
+        struct.pack_into('Q', self.Header, 0, head)
+
+    def SetTail(self, tail):
+        struct.pack_into('Q', self.Header, 8, tail)
+
+    def SetReaderWaiting(self, flag):
+        struct.pack_into('I', self.Header, 16, flag)
+
+    def SetWriterWaiting(self, flag):
+        struct.pack_into('I', self.Header, 20, flag)
+
+    def Write(self, data):
+        head, tail, readerWaiting, _ = self.State()
+        count = min(len(data), self.Capacity - (head - tail))
+        if count:
+            start = head % self.Capacity
+            first = min(count, self.Capacity - start)
+            self.Data[start:start + first] = data[:first]
+            self.Data[:count - first] = data[first:count]
+            # The head only moves once the bytes are in place
+            self.SetHead(head + count)
+        return count, readerWaiting
+
+    def Read(self, size):
+        head, tail, _, writerWaiting = self.State()
+        count = min(size, head - tail)
+        if not count:
+            return b'', writerWaiting
+        start = tail % self.Capacity
+        first = min(count, self.Capacity - start)
+        data = bytes(self.Data[start:start + first])
+        if first < count:
+            data += bytes(self.Data[:count - first])
+        self.SetTail(tail + count)
+        return data, writerWaiting
+
+    def Release(self):
+        self.Header.release()
+        self.Data.release()
+
+class SharedMemoryChannel:
+    """Socket-like tunnel end over two shared-memory rings.
+
+    Bytes never cross the kernel; the Unix socket only carries one-byte
+    doorbells when the other side is asleep, and its EOF signals close.
+    """
+
+    def __init__(self, Memory, Doorbell, Capacity, Client):
+        self.Memory = Memory
+        self.Doorbell = Doorbell
+        upstream = SharedRing(Memory.buf, 0, Capacity)
+        downstream = SharedRing(Memory.buf, RingHeaderSize + Capacity, Capacity)
+        self.Outbound, self.Inbound = (upstream, downstream) if Client else (downstream, upstream)
+        self.Timeout = None
+        self.SpinTime = 0.0005
+        self.Closed = False
+        self.PeerClosed = False
+        self.WriteShut = False
+        self.Condition = threading.Condition()
+        self.SendLock = threading.Lock()
+        self.DoorbellLock = threading.Lock()
+        threading.Thread(target=self.ListenDoorbell, daemon=True).start()
+
+    def __repr__(self):
+        return f"<SharedMemoryChannel {self.Memory.name}>"
+
+    def fileno(self):
+        return -1
+
+    def getpeername(self):
+        return ('shm', self.Memory.name)
+
+    def settimeout(self, timeout):
+        self.Timeout = timeout
+
+    def gettimeout(self):
+        return self.Timeout
+
+    def setblocking(self, flag):
+        self.Timeout = None if flag else 0.0
+
+    def Ring(self, kind):
+        try:
+            with self.DoorbellLock:
+                self.Doorbell.sendall(kind)
+        except OSError:
+            pass
+
+    def ListenDoorbell(self):
+        try:
+            while True:
+                data = self.Doorbell.recv(4096)
+                if not data:
+                    break
+                with self.Condition:
+                    self.Condition.notify_all()
+        except OSError:
+            pass
+        with self.Condition:
+            self.PeerClosed = True
+            self.Condition.notify_all()
+
+    def Sleep(self, setWaiting, ready, deadline):
+        # Poll briefly first: a reply that lands within the spin never costs a doorbell.
+        # Then announce the wait, re-check and sleep; the short timeout covers a doorbell
+        # lost between the check and the flag becoming visible to the other process.
+        try:
+            spinUntil = time.monotonic() + self.SpinTime
+            while time.monotonic() < spinUntil:
+                if ready() or self.Closed or self.PeerClosed:
+                    return
+                Yield()
+            setWaiting(1)
+            try:
+                with self.Condition:
+                    if ready() or self.Closed or self.PeerClosed:
+                        return
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise socket.timeout('timed out')
+                    self.Condition.wait(0.05 if remaining is None else min(remaining, 0.05))
+            finally:
+                setWaiting(0)
+        except ValueError:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+
+    def recv(self, bufsize, flags=0):
+        deadline = None if self.Timeout is None else time.monotonic() + self.Timeout
+        ring = self.Inbound
+        while True:
+            if self.Closed:
+                raise OSError(errno.EBADF, 'Bad file descriptor')
+            try:
+                data, writerWaiting = ring.Read(bufsize)
+            except ValueError:
+                # The rings were released by a concurrent close()
+                raise OSError(errno.EBADF, 'Bad file descriptor')
+            if data:
+                if writerWaiting:
+                    self.Ring(DoorbellSpace)
+                return data
+            if self.PeerClosed:
+                return b''
+            self.Sleep(ring.SetReaderWaiting, lambda: ring.State()[0] != ring.State()[1], deadline)
+
+    def sendall(self, data, flags=0):
+        if self.Closed:
+            raise OSError(errno.EBADF, 'Bad file descriptor')
+        if self.WriteShut:
+            raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+        data = memoryview(data).cast('B')
+        ring = self.Outbound
+        deadline = None if self.Timeout is None else time.monotonic() + self.Timeout
+        with self.SendLock:
+            while data:
+                if self.PeerClosed or self.Closed:
+                    raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+                try:
+                    written, readerWaiting = ring.Write(data)
+                except ValueError:
+                    raise OSError(errno.EBADF, 'Bad file descriptor')
+                data = data[written:]
+                if readerWaiting and written:
+                    self.Ring(DoorbellData)
+                if data and not written:
+                    self.Sleep(ring.SetWriterWaiting, lambda: ring.State()[0] - ring.State()[1] < ring.Capacity, deadline)
+
+    def send(self, data, flags=0):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self.WriteShut = True
+            try:
+                self.Doorbell.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            with self.Condition:
+                self.PeerClosed = True
+                self.Condition.notify_all()
+
+    def close(self):
+        if self.Closed:
+            return
+        self.Closed = True
+        with self.Condition:
+            self.Condition.notify_all()
+        try:
+            # Shut down first: the doorbell thread is blocked in recv and would keep the
+            # socket open, so the peer would never see EOF
+            self.Doorbell.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.Doorbell.close()
+        with self.SendLock:
+            self.Outbound.Release()
+            self.Inbound.Release()
+            try:
+                self.Memory.close()
+            except BufferError:
+                pass
+
+def OfferSharedMemory(sock, Capacity=4194304):
+    """Client side of the handshake on a fresh Unix tunnel socket."""
+    memory = shared_memory.SharedMemory(create=True, size=2 * (RingHeaderSize + Capacity))
+    try:
+        sock.sendall(f"SHM {memory.name} {Capacity}\n".encode('ascii'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = sock.recv(64)
+            if not data:
+                break
+            reply += data
+    finally:
+        # Both sides hold a mapping by now (or never will), so the name can go
+        memory.unlink()
+    if reply != b'OK\n':
+        memory.close()
+        raise ConnectionError(f"Server refused shared memory: {reply.decode('ascii', 'replace').strip()}")
+    return SharedMemoryChannel(memory, sock, Capacity, True)
+
+def AcceptSharedMemory(sock, line):
+    """Server side: attach to the segment named in the client's SHM line."""
+    try:
+        _, name, capacity = line.decode('ascii').split()
+        memory = shared_memory.SharedMemory(name=name)
+        # The client owns the segment; keep this process's tracker from unlinking it again
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        capacity = int(capacity)
+        if memory.size < 2 * (RingHeaderSize + capacity):
+            raise ValueError('segment too small')
+    except (ValueError, OSError) as e:
+        sock.sendall(f"ERR {e}\n".encode('ascii', 'replace'))
+        return None
+    sock.sendall(b'OK\n')
+    return SharedMemoryChannel(memory, sock, capacity, False)